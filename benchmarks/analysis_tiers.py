@@ -0,0 +1,193 @@
+# PyViz, a Python music visualizer.
+# Program by Austin Pringle, Caleb Rachocki, & Caleb Ruby
+# Pennsylvania Western University, California
+#
+# benchmarks/analysis_tiers.py
+# This file is the analysis tier benchmark.
+# It analyzes a few made-up songs at every one of the analyzer's tiers (`ANALYSIS_TIERS` in `visualizerengine.py`),
+# and measures, for each tier:
+#
+# - how long the analysis takes,
+# - the most memory it used at once, using `tracemalloc`,
+# - and how different the bars look from the "high" tier, as a percentage of the bars' full height.
+#
+# The made-up songs are written out as 44100Hz .wav files first, like a real download, so resampling is included.
+# Passing `--max-diff` makes it exit with an error if any tier looks more different than that.
+#
+# Run it from anywhere, like so:
+#   python benchmarks/analysis_tiers.py --seconds 60 --runs 3
+
+# `argparse` reads the command-line options.
+import argparse
+
+# Results can be written out as JSON.
+import json
+
+# `os` is used to access files in a system-independent way.
+import os
+
+# `statistics` gives us the median.
+import statistics
+
+# The made-up songs are written to a temporary folder.
+import tempfile
+from shutil import rmtree
+
+# `sys` lets us find the rest of PyViz.
+import sys
+
+# For measuring time.
+import time
+
+# For measuring memory.
+import tracemalloc
+
+# The made-up songs are written as .wav files.
+import wave
+
+# The top folder of the repository, where all of PyViz's files are.
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The sample rate of the made-up songs. Most downloads come in at this rate.
+SAMPLE_RATE = 44100
+
+# The bars are compared this many times per second of song, like a visualizer running at 60 frames per second.
+COMPARE_RATE = 60
+
+# The tier everything is compared against.
+REFERENCE_TIER = "high"
+
+
+# The made-up songs. Each one takes the times of every sample, in seconds, and returns the samples.
+# - "sweep" is one tone gliding all the way across the bars and back.
+# - "chords" is a few tones moving around, with a beat.
+# - "noise" is bursts of noise, which lights up every bar at once.
+def _sweep(np, times):
+    frequency = 100 + 7800 * (0.5 - 0.5 * np.cos(2 * np.pi * times / times[-1]))
+    return 0.5 * np.sin(2 * np.pi * np.cumsum(frequency) / SAMPLE_RATE)
+
+def _chords(np, times):
+    signal = np.zeros_like(times)
+    for base, speed in ((220, 0.1), (880, 0.23), (3000, 0.37)):
+        frequency = base * (1.5 + np.sin(2 * np.pi * speed * times))
+        signal += 0.2 * np.sin(2 * np.pi * np.cumsum(frequency) / SAMPLE_RATE)
+    return signal * (0.6 + 0.4 * (np.sin(2 * np.pi * 2 * times) > 0))
+
+def _noise(np, times):
+    bursts = np.sin(2 * np.pi * 0.5 * times) > 0.3
+    return 0.3 * np.random.default_rng(0).standard_normal(len(times)) * bursts
+
+SIGNALS = {
+    "sweep": _sweep,
+    "chords": _chords,
+    "noise": _noise,
+}
+
+
+# Write one of the made-up songs to a .wav file.
+def write_signal(path, name, seconds):
+    import numpy as np
+
+    times = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    samples = (np.clip(SIGNALS[name](np, times), -1, 1) * 32767).astype(np.int16)
+    with wave.open(path, "wb") as writer:
+        writer.setnchannels(1)
+        writer.setsampwidth(2)
+        writer.setframerate(SAMPLE_RATE)
+        writer.writeframes(samples.tobytes())
+
+
+# How tall every bar would be at every frame, from 0 (silent) to 1 (full height).
+# It asks the analyzer exactly what the visualizer would, and turns decibels into heights the same way `AudioBar` does,
+# just without the smoothing.
+def bar_heights(visualizerengine, analyzer, seconds):
+    import numpy as np
+
+    frequencies = np.arange(100, 8000, 100)
+    frames = int(seconds * COMPARE_RATE)
+    heights = np.empty((frames, len(frequencies)))
+    for frame in range(frames):
+        for index, frequency in enumerate(frequencies):
+            heights[frame, index] = analyzer.get_decibel(frame / COMPARE_RATE, frequency)
+    return (np.clip(heights, -80, 0) + 80) / 80
+
+
+# Analyze one song at one tier, and return the analyzer along with the time it took and the most memory it used.
+# Memory is measured in a run of its own, because `tracemalloc` slows everything down.
+def measure_tier(visualizerengine, path, tier, runs):
+    times = []
+    for run in range(runs):
+        start = time.perf_counter()
+        analyzer = visualizerengine.AudioAnalyzer(path, tier)
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    visualizerengine.AudioAnalyzer(path, tier)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return analyzer, statistics.median(times), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the cost and the look of the analyzer's tiers.")
+    parser.add_argument("--seconds", type=float, default=60, help="how long each made-up song is")
+    parser.add_argument("--runs", type=int, default=3, help="how many timing runs to take the median of")
+    parser.add_argument("--max-diff", type=float, default=None, help="fail if any tier's bars differ from \"high\" by more than this many percent, on average")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_DIRECTORY)
+    import visualizerengine
+    import numpy as np
+
+    # Get the loading and setting up out of the way, so it doesn't count against whichever tier runs first.
+    visualizerengine.warm_up()
+
+    directory = tempfile.mkdtemp(prefix="pyviz-tiers-")
+    results = []
+    try:
+        for signal in SIGNALS:
+            path = os.path.join(directory, signal + ".wav")
+            write_signal(path, signal, args.seconds)
+
+            measured = {tier: measure_tier(visualizerengine, path, tier, args.runs) for tier in visualizerengine.ANALYSIS_TIERS}
+            reference = bar_heights(visualizerengine, measured[REFERENCE_TIER][0], args.seconds)
+            for tier, (analyzer, seconds, peak) in measured.items():
+                difference = abs(bar_heights(visualizerengine, analyzer, args.seconds) - reference)
+                results.append({
+                    "signal": signal,
+                    "tier": tier,
+                    "seconds": seconds,
+                    "speedup": measured[REFERENCE_TIER][1] / seconds,
+                    "peak_mb": peak / 1048576,
+                    "mean_diff_percent": float(difference.mean()) * 100,
+                    "p99_diff_percent": float(np.percentile(difference, 99)) * 100,
+                })
+    finally:
+        rmtree(directory, ignore_errors=True)
+
+    print("signal".ljust(8) + "tier".ljust(10) + "time (s)".rjust(10) + "speedup".rjust(9) + "peak (MB)".rjust(11)
+        + "mean diff".rjust(11) + "p99 diff".rjust(10))
+    for result in results:
+        print(result["signal"].ljust(8) + result["tier"].ljust(10) + format(result["seconds"], "10.3f")
+            + format(result["speedup"], "8.1f") + "x" + format(result["peak_mb"], "11.1f")
+            + format(result["mean_diff_percent"], "10.2f") + "%" + format(result["p99_diff_percent"], "9.2f") + "%")
+
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=2)
+
+    if args.max_diff is not None:
+        failures = [result for result in results if result["mean_diff_percent"] > args.max_diff]
+        for result in failures:
+            print("FAIL: the \"" + result["tier"] + "\" tier differs by " + format(result["mean_diff_percent"], ".2f")
+                + "% on \"" + result["signal"] + "\"")
+        if len(failures) > 0:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
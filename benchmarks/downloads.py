@@ -0,0 +1,253 @@
+# PyViz, a Python music visualizer.
+# Program by Austin Pringle, Caleb Rachocki, & Caleb Ruby
+# Pennsylvania Western University, California
+#
+# benchmarks/downloads.py
+# This file is the download benchmark.
+# It runs the downloader service (see `pyvizdownloader.py`) against a little HTTP server of its own, on this computer,
+# serving a made-up song, and checks that:
+#
+# - a download that gets cut off halfway picks up where it left off, instead of starting over,
+# - a song that was already downloaded comes out of the download cache, without asking the server again,
+#   even when it is reached through a different link,
+# - a song that fails to convert is never left in the cache as if it were a whole one,
+# - progress is reported, but not too often,
+# - and the bandwidth limit holds.
+#
+# yt-dlp treats a plain link to a .wav file like any other video, so nothing here needs YouTube, or the internet.
+# It does need ffmpeg, just like a real download.
+# If any check fails, it exits with an error, so the problem gets noticed.
+#
+# Run it from anywhere, like so:
+#   python benchmarks/downloads.py --seconds 30 --limit-kb 2048
+
+# `argparse` reads the command-line options.
+import argparse
+
+# The made-up song is a sine wave.
+import math
+import struct
+
+# `os` is used to access files in a system-independent way.
+import os
+
+# The downloads, and the download cache, go to a temporary folder.
+import tempfile
+from shutil import rmtree
+
+# `sys` lets us find the rest of PyViz.
+import sys
+
+# The HTTP server runs on a thread of its own.
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# For measuring time.
+import time
+
+# The made-up song is written as a .wav file.
+import io
+import wave
+
+# The top folder of the repository, where all of PyViz's files are.
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The sample rate of the made-up song. Most downloads come in at this rate.
+SAMPLE_RATE = 44100
+
+# Like flaky Wi-Fi, the server hangs up partway through every try at the whole of a "flaky" file,
+# after sending this much of it. Only a download that picks up where it left off ever gets the rest.
+CUT_FRACTION = 0.4
+
+
+# Make a made-up song: a few seconds of a 440Hz beep, as the bytes of a 16-bit stereo .wav file.
+def make_song(seconds):
+    frames = bytearray()
+    for index in range(int(seconds * SAMPLE_RATE)):
+        sample = int(12000 * math.sin(2 * math.pi * 440 * index / SAMPLE_RATE))
+        frames += struct.pack("<hh", sample, sample)
+
+    song = io.BytesIO()
+    with wave.open(song, "wb") as song_file:
+        song_file.setnchannels(2)
+        song_file.setsampwidth(2)
+        song_file.setframerate(SAMPLE_RATE)
+        song_file.writeframes(bytes(frames))
+    return song.getvalue()
+
+
+# The audio of a .wav file, without its header. ffmpeg writes headers its own way, but must leave the audio alone.
+def song_frames(data):
+    with wave.open(io.BytesIO(data), "rb") as song_file:
+        return song_file.readframes(song_file.getnframes())
+
+
+# The little HTTP server. It serves `files` (file name to bytes), understands "Range" requests
+# (which is how a download picks up where it left off), and counts how many requests it got.
+# Files named in `flaky` get cut off partway. See `CUT_FRACTION`.
+class SongServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, files, flaky=()):
+        super().__init__(("127.0.0.1", 0), SongRequestHandler)
+        self.files = files
+        self.flaky = set(flaky)
+        self.requests = 0
+
+        # Where each request that picked up partway through a file started, by file name.
+        self.resumed_from = {}
+        self.lock = threading.Lock()
+
+    def url(self, name):
+        return "http://127.0.0.1:" + str(self.server_address[1]) + "/" + name
+
+
+class SongRequestHandler(BaseHTTPRequestHandler):
+
+    # Keep quiet. The benchmark prints what matters.
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def _respond(self, send_body):
+        name = self.path.split("?")[0].lstrip("/")
+        data = self.server.files.get(name)
+        with self.server.lock:
+            self.server.requests += 1
+        if data is None:
+            self.send_error(404)
+            return
+
+        # "Range: bytes=<start>-" asks for the rest of the file from <start> on.
+        start = 0
+        range_header = self.headers.get("Range")
+        if range_header is not None and range_header.startswith("bytes="):
+            start = int(range_header[len("bytes="):].split("-")[0] or 0)
+        if start > 0 and send_body:
+            with self.server.lock:
+                self.server.resumed_from.setdefault(name, []).append(start)
+
+        if start > 0:
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes " + str(start) + "-" + str(len(data) - 1) + "/" + str(len(data)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "audio/wav")
+        self.send_header("Content-Length", str(len(data) - start))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        if not send_body:
+            return
+
+        # Every try at the whole of a flaky file gets cut off partway.
+        end = len(data)
+        if start == 0 and name in self.server.flaky:
+            end = int(len(data) * CUT_FRACTION)
+
+        position = start
+        try:
+            while position < end:
+                chunk = data[position:min(end, position + 65536)]
+                self.wfile.write(chunk)
+                position += len(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            # The downloader hung up on us. That's fine.
+            return
+        self.close_connection = True
+
+
+# One check: its name, whether it passed, and what we saw.
+def report(name, passed, details):
+    print(("ok    " if passed else "FAIL  ") + name.ljust(14) + details)
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check PyViz's downloads against a local HTTP server.")
+    parser.add_argument("--seconds", type=float, default=30, help="how long the made-up song is")
+    parser.add_argument("--limit-kb", type=int, default=2048, help="the bandwidth limit to check, in kilobytes per second")
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_DIRECTORY)
+    import pyvizdownloader
+
+    song = make_song(args.seconds)
+    server = SongServer({
+        "song.wav": song,
+        "throttled.wav": song,
+
+        # Not a song at all, so converting it fails.
+        "broken.wav": os.urandom(256 * 1024),
+    }, flaky=["song.wav"])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    directory = tempfile.mkdtemp(prefix="pyviz-downloads-")
+    results = []
+    try:
+        downloader = pyvizdownloader.DownloaderService(bandwidth_limit=None, cache_directory=os.path.join(directory, "cache"))
+
+        # Cut off partway, and picked up again.
+        progress = []
+        info = pyvizdownloader.VideoInfo({"id": "song", "extractor_key": "Generic", "webpage_url": server.url("song.wav?from=search")})
+        start = time.perf_counter()
+        path = downloader.download_audio(info.url, directory, "first",
+            on_progress=lambda fraction, downloaded, total: progress.append(time.perf_counter()), info=info)
+        elapsed = time.perf_counter() - start
+        with open(path, "rb") as song_file:
+            same = song_frames(song_file.read()) == song_frames(song)
+        resumed_from = server.resumed_from.get("song.wav", [])
+        results.append(report("resume", same and len(resumed_from) > 0,
+            format(len(song) / 1048576, ".1f") + " MB song, picked up at " + ", ".join(format(start / 1048576, ".1f") + " MB" for start in resumed_from)
+            + " in " + format(elapsed, ".2f") + " s" + ("" if same else ", but the audio came out different")))
+
+        # Progress: some, but no more than `PROGRESS_INTERVAL` allows (plus the last update, which always goes through).
+        allowed = elapsed / pyvizdownloader.PROGRESS_INTERVAL + 2
+        results.append(report("progress", 0 < len(progress) <= allowed,
+            str(len(progress)) + " updates in " + format(elapsed, ".2f") + " s (at most " + str(int(allowed)) + " allowed)"))
+
+        # The same song again, and the same video through another link: both come out of the cache.
+        requests = server.requests
+        downloader.download_audio(info.url, directory, "again", info=info)
+        other_link = pyvizdownloader.VideoInfo(dict(info.info, webpage_url=server.url("song.wav?from=playlist")))
+        downloader.download_audio(other_link.url, directory, "other-link", info=other_link)
+        results.append(report("cache", server.requests == requests, str(server.requests - requests) + " requests for songs already downloaded"))
+
+        # A song that fails to convert must not be left in the cache. Trying again has to fail again.
+        failures = 0
+        for attempt in range(2):
+            try:
+                downloader.download_audio(server.url("broken.wav"), directory, "broken")
+            except Exception:
+                failures += 1
+        cached = [name for name in os.listdir(downloader.cache_directory)
+            if os.path.exists(os.path.join(downloader.cache_directory, name, pyvizdownloader.CACHED_NAME))]
+        results.append(report("broken", failures == 2 and len(cached) == 1,
+            str(failures) + " of 2 tries failed, " + str(len(cached)) + " songs in the cache (1 expected)"))
+
+        # The bandwidth limit. The limiter lets a second's worth through right away, then holds to the limit.
+        limit = args.limit_kb * 1024
+        throttled = pyvizdownloader.DownloaderService(bandwidth_limit=limit, cache_directory=os.path.join(directory, "throttled-cache"))
+        start = time.perf_counter()
+        throttled.download_audio(server.url("throttled.wav"), directory, "throttled")
+        elapsed = time.perf_counter() - start
+        expected = max(0.0, (len(song) - limit) / limit)
+        results.append(report("throttle", elapsed >= expected * 0.9,
+            format(elapsed, ".2f") + " s for the song (at least " + format(expected, ".2f") + " s expected), "
+            + format(len(song) / 1024 / elapsed, ".0f") + " KB/s against a limit of " + str(args.limit_kb) + " KB/s"))
+
+        downloader.close()
+        throttled.close()
+    finally:
+        server.shutdown()
+        rmtree(directory, ignore_errors=True)
+
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
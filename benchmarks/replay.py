@@ -0,0 +1,350 @@
+# PyViz, a Python music visualizer.
+# Program by Austin Pringle, Caleb Rachocki, & Caleb Ruby
+# Pennsylvania Western University, California
+#
+# benchmarks/replay.py
+# This file is the frame loop benchmark.
+# It runs the built-in visualizer's frame loop (`run_audio_visualizer` in `visualizerengine.py`) off-screen,
+# on a made-up clock, with a script of window events (resizes, and finally closing the window).
+# Every run draws exactly the same frames, so runs can be compared with each other. It measures:
+#
+# - how long the work of each frame takes (what the frame governor sees), and how long each whole trip
+#   around the loop takes, as percentiles,
+# - and how much memory each frame allocates, using `tracemalloc`.
+#
+# Timing and memory are measured in separate runs, because `tracemalloc` slows everything down.
+# The results can be saved as a baseline, and later runs compared against it.
+# If a later run is slower (or allocates more) than the baseline by more than the thresholds allow,
+# it exits with an error, so the problem gets noticed.
+#
+# Run it from anywhere, like so:
+#   python benchmarks/replay.py --save-baseline benchmarks/baseline.json
+#   python benchmarks/replay.py --baseline benchmarks/baseline.json --max-slowdown 0.25
+#
+# `--bar-style` picks how the bars look (see `BAR_STYLES`), so a styled run can be held up against a flat baseline:
+#   python benchmarks/replay.py --bar-style neon --baseline benchmarks/baseline.json
+#
+# An event script is JSON, like so. The window is closed after the last frame.
+#   {"frames": 900, "events": [{"frame": 300, "type": "resize", "w": 1280, "h": 720}]}
+#
+# Event scripts can also be recorded from a real, on-screen run: resize the window however you like, then close it.
+#   python benchmarks/replay.py --record script.json --song song.wav
+
+# `argparse` reads the command-line options.
+import argparse
+
+# Scripts, baselines and results are all JSON.
+import json
+
+# `os` is used to access files in a system-independent way.
+import os
+
+# `statistics` gives us the median.
+import statistics
+
+# `sys` lets us count allocated memory blocks, and find the rest of PyViz.
+import sys
+
+# For measuring time.
+import time
+
+# For measuring how much memory each frame allocates.
+import tracemalloc
+
+# `io` and `wave` let us build the test song in memory.
+import io
+import wave
+
+# The top folder of the repository, where all of PyViz's files are.
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The made-up clock moves forward by exactly one frame at this rate, no matter how long the frame really took.
+FRAME_RATE = 60
+
+# The script used when none is given: 15 seconds, with a few resizes along the way.
+DEFAULT_SCRIPT = {
+    "frames": 900,
+    "events": [
+        {"frame": 300, "type": "resize", "w": 1280, "h": 720},
+        {"frame": 600, "type": "resize", "w": 640, "h": 480},
+        {"frame": 750, "type": "resize", "w": 1920, "h": 1080},
+    ],
+}
+
+# The first frames of a run are left out of the results, since they include one-time setup.
+WARM_UP_FRAMES = 30
+
+# The percentiles we report, and compare against the baseline.
+PERCENTILES = [50, 95, 99]
+
+# The sample rate and length of the made-up test song.
+TEST_SONG_SAMPLE_RATE = 22050
+TEST_SONG_SECONDS = 20
+
+
+# Make the test song: a few tones sweeping up and down, with a beat and a little noise, as a .wav file in memory.
+# The noise is seeded, so it is the same song every time.
+def make_test_song(seconds=TEST_SONG_SECONDS, sample_rate=TEST_SONG_SAMPLE_RATE):
+    import numpy as np
+
+    times = np.arange(seconds * sample_rate) / sample_rate
+    signal = np.zeros_like(times)
+    for base, speed in ((220, 0.1), (880, 0.23), (3000, 0.37)):
+        frequency = base * (1.5 + np.sin(2 * np.pi * speed * times))
+        signal += 0.2 * np.sin(2 * np.pi * np.cumsum(frequency) / sample_rate)
+    signal *= 0.6 + 0.4 * (np.sin(2 * np.pi * 2 * times) > 0)
+    signal += 0.05 * np.random.default_rng(0).standard_normal(len(times))
+    samples = (np.clip(signal, -1, 1) * 32767).astype(np.int16)
+
+    wav_file = io.BytesIO()
+    with wave.open(wav_file, "wb") as writer:
+        writer.setnchannels(1)
+        writer.setsampwidth(2)
+        writer.setframerate(sample_rate)
+        writer.writeframes(samples.tobytes())
+    wav_file.seek(0)
+    return wav_file
+
+
+# Stands in for the clock, the song and the window, all at once.
+# It counts frames, and makes up the time, the song position and the window events from the frame number.
+class ScriptedRun:
+    def __init__(self, script, trace_allocations=False):
+        self.frames = script["frames"]
+        self.events = {}
+        for event in script["events"]:
+            self.events.setdefault(event["frame"], []).append(event)
+        self.trace_allocations = trace_allocations
+
+        self.frame = 0
+        self.work_times = []
+        self.loop_times = []
+        self.allocated_bytes = []
+        self.allocated_blocks = []
+        self.last_frame_end = None
+
+    # The made-up clock, in milliseconds.
+    def ticks(self):
+        return int(self.frame * 1000 / FRAME_RATE)
+
+    # The window events for the current frame.
+    def get_events(self):
+        import pygame
+
+        # Let pygame handle its own events as usual. We just don't pass them on.
+        pygame.event.get()
+
+        events = []
+        for event in self.events.get(self.frame, []):
+            if event["type"] == "resize":
+                events.append(pygame.event.Event(pygame.VIDEORESIZE, w=event["w"], h=event["h"], size=(event["w"], event["h"])))
+            elif event["type"] == "quit":
+                events.append(pygame.event.Event(pygame.QUIT))
+        if self.frame >= self.frames:
+            events.append(pygame.event.Event(pygame.QUIT))
+        return events
+
+    # Called by the frame loop after every frame.
+    def on_frame(self, frame_time):
+        now = time.perf_counter()
+        if self.frame >= WARM_UP_FRAMES:
+            self.work_times.append(frame_time)
+            self.loop_times.append(now - self.last_frame_end)
+            if self.trace_allocations:
+                current, peak = tracemalloc.get_traced_memory()
+                self.allocated_bytes.append(peak - self.start_memory)
+                self.allocated_blocks.append(sys.getallocatedblocks() - self.start_blocks)
+        self.frame += 1
+
+        # Start counting for the next frame.
+        if self.trace_allocations:
+            tracemalloc.reset_peak()
+            self.start_memory = tracemalloc.get_traced_memory()[0]
+            self.start_blocks = sys.getallocatedblocks()
+        self.last_frame_end = time.perf_counter()
+
+
+# Plays the "song" along the made-up clock, without making any sound.
+class ScriptedPlayback:
+    def __init__(self, run):
+        self.run = run
+
+    def play(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def get_position(self):
+        return self.run.frame / FRAME_RATE
+
+    def is_playing(self):
+        return True
+
+
+# Run the real frame loop once, along a script. Returns the `ScriptedRun`, with everything it measured.
+# `level` pins the quality to one of `QUALITY_LEVELS`, so the governor can't change what gets drawn from run to run.
+# `bar_style` is one of the `BAR_STYLES`, or `None` for the default one.
+def replay(script, analyzer, level=0, streaming=False, trace_allocations=False, bar_style=None):
+    import visualizerengine
+
+    # A governor that never changes its mind.
+    class PinnedGovernor(visualizerengine.FrameGovernor):
+        def record(self, frame_time):
+            return False
+
+    governor = PinnedGovernor()
+    governor.level = level
+
+    # Streaming draws through the frame buffer. This stands in for the streamer, without the web server.
+    class NullStreamer:
+        def publish(self, framebuffer, position):
+            pass
+
+    run = ScriptedRun(script, trace_allocations)
+    if trace_allocations:
+        tracemalloc.start()
+    try:
+        run.last_frame_end = time.perf_counter()
+        visualizerengine.run_audio_visualizer(None, (0.2, 0.8, 1.0, 1.0), (0.0, 0.0, 0.0, 1.0),
+            streamer=NullStreamer() if streaming else None, analyzer=analyzer, playback=ScriptedPlayback(run), bar_style=bar_style,
+            clock=run.ticks, events=run.get_events, governor=governor, on_frame=run.on_frame)
+    finally:
+        if trace_allocations:
+            tracemalloc.stop()
+    return run
+
+
+# The given percentiles of a list of numbers, by the "nearest rank" method.
+def percentiles(values, wanted=PERCENTILES):
+    ordered = sorted(values)
+    result = {}
+    for percent in wanted:
+        rank = max(1, int(round(percent / 100 * len(ordered))))
+        result["p" + str(percent)] = ordered[rank - 1]
+    result["max"] = ordered[-1]
+    return result
+
+
+# Run the script several times, and boil the measurements down to one set of results.
+# Each timing percentile is the median of that percentile across the runs.
+def measure(script, analyzer, runs, level, streaming, bar_style=None):
+    timing_runs = [replay(script, analyzer, level, streaming, bar_style=bar_style) for run in range(runs)]
+
+    results = {}
+    for key in ("work_times", "loop_times"):
+        per_run = [percentiles(getattr(run, key)) for run in timing_runs]
+        results[key.replace("_times", "_ms")] = {name: statistics.median(run[name] for run in per_run) * 1000 for name in per_run[0]}
+
+    allocation_run = replay(script, analyzer, level, streaming, trace_allocations=True, bar_style=bar_style)
+    results["alloc_bytes_per_frame"] = statistics.mean(allocation_run.allocated_bytes)
+    results["alloc_blocks_per_frame"] = statistics.mean(allocation_run.allocated_blocks)
+    results["frames"] = len(allocation_run.allocated_bytes)
+    return results
+
+
+# Compare results against a baseline. Returns a list of everything that got worse by more than allowed.
+# Times are allowed to grow by `max_slowdown` (0.25 is 25%), and by at least `min_delta_ms`,
+# so tiny numbers bouncing around don't fail the run. Memory is allowed to grow by `max_alloc_growth`.
+def compare(results, baseline, max_slowdown, max_alloc_growth, min_delta_ms):
+    failures = []
+    for key in ("work_ms", "loop_ms"):
+        for name in ["p" + str(percent) for percent in PERCENTILES]:
+            old, new = baseline[key][name], results[key][name]
+            if new > old * (1 + max_slowdown) and new - old > min_delta_ms:
+                failures.append(key + " " + name + ": " + format(new, ".3f") + " ms, baseline " + format(old, ".3f") + " ms")
+
+    old, new = baseline["alloc_bytes_per_frame"], results["alloc_bytes_per_frame"]
+    if new > old * (1 + max_alloc_growth) and new - old > 1024:
+        failures.append("alloc_bytes_per_frame: " + format(new, ".0f") + ", baseline " + format(old, ".0f"))
+    return failures
+
+
+# Run the visualizer for real, on screen, and write down every resize and when the window was closed, as a script.
+def record(path, song):
+    import pygame
+    import visualizerengine
+
+    script = {"frames": 0, "events": []}
+    frame = [0]
+
+    def _get_events():
+        events = pygame.event.get()
+        for event in events:
+            if event.type == pygame.VIDEORESIZE:
+                script["events"].append({"frame": frame[0], "type": "resize", "w": event.w, "h": event.h})
+            elif event.type == pygame.QUIT:
+                script["frames"] = frame[0]
+        return events
+
+    def _on_frame(frame_time):
+        frame[0] += 1
+
+    visualizerengine.run_audio_visualizer(song, (0.2, 0.8, 1.0, 1.0), (0.0, 0.0, 0.0, 1.0), events=_get_events, on_frame=_on_frame)
+
+    with open(path, "w") as script_file:
+        json.dump(script, script_file, indent=2)
+    print("Recorded " + str(script["frames"]) + " frames and " + str(len(script["events"])) + " events to " + path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay the visualizer's frame loop off-screen, and measure it.")
+    parser.add_argument("--script", help="the event script to replay (default: a built-in one)")
+    parser.add_argument("--song", help="a .wav file to visualize (default: a made-up test song)")
+    parser.add_argument("--runs", type=int, default=3, help="how many timing runs to take the median of")
+    parser.add_argument("--quality", type=int, default=0, help="which quality level to draw at, 0 being the best")
+    parser.add_argument("--streaming", action="store_true", help="draw through the frame buffer, like when streaming")
+    parser.add_argument("--bar-style", help="how the bars look, one of the visualizer's bar styles (default: the usual one)")
+    parser.add_argument("--baseline", help="compare against the results in this file, and fail if they got worse")
+    parser.add_argument("--save-baseline", help="save the results to this file")
+    parser.add_argument("--max-slowdown", type=float, default=0.25, help="how much slower than the baseline is allowed (0.25 is 25%%)")
+    parser.add_argument("--max-alloc-growth", type=float, default=0.25, help="how much more memory per frame than the baseline is allowed")
+    parser.add_argument("--min-delta-ms", type=float, default=0.1, help="time differences smaller than this never fail")
+    parser.add_argument("--record", help="run on screen and record the window events to this script file instead")
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_DIRECTORY)
+
+    if args.record:
+        if not args.song:
+            parser.error("--record needs a --song to play")
+        record(args.record, args.song)
+        return 0
+
+    # No window and no sound. This has to be set before pygame starts up.
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+    import visualizerengine
+
+    script = DEFAULT_SCRIPT
+    if args.script:
+        with open(args.script) as script_file:
+            script = json.load(script_file)
+
+    analyzer = visualizerengine.AudioAnalyzer(args.song if args.song else make_test_song())
+    results = measure(script, analyzer, args.runs, args.quality, args.streaming, args.bar_style)
+
+    for key in ("work_ms", "loop_ms"):
+        print(key.ljust(8) + "   ".join(name + " " + format(value, "8.3f") for name, value in results[key].items()))
+    print("alloc    " + format(results["alloc_bytes_per_frame"], ".0f") + " bytes/frame, "
+        + format(results["alloc_blocks_per_frame"], ".1f") + " blocks/frame kept, over " + str(results["frames"]) + " frames")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        failures = compare(results, baseline, args.max_slowdown, args.max_alloc_growth, args.min_delta_ms)
+        for failure in failures:
+            print("FAIL: " + failure)
+        if len(failures) > 0:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+# PyViz, a Python music visualizer.
+# Program by Austin Pringle, Caleb Rachocki, & Caleb Ruby
+# Pennsylvania Western University, California
+#
+# benchmarks/startup.py
+# This file is the startup benchmark.
+# It starts PyViz several times, each in a fresh Python process, and measures:
+#
+# - how long it takes to import the application module,
+# - how long it takes for the first window to actually appear on screen,
+# - and which slow-to-load libraries were loaded by then (ideally, none of them).
+#
+# If startup goes over the time budget, or a slow library sneaks back into startup,
+# it exits with an error, so the problem gets noticed.
+#
+# Run it from anywhere, like so:
+#   python benchmarks/startup.py --runs 5 --budget-ms 1500
+
+# `argparse` reads the command-line options.
+import argparse
+
+# Results are passed from each child process back to us as JSON.
+import json
+
+# `os` is used to access files in a system-independent way.
+import os
+
+# `statistics` gives us the median.
+import statistics
+
+# Each measurement runs in its own process, started with `subprocess`.
+import subprocess
+import sys
+
+# For measuring time.
+import time
+
+# The top folder of the repository, where all of PyViz's files are.
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# These libraries are slow to load, and have no business being loaded before the first window shows up.
+HEAVY_MODULES = [
+    "yt_dlp",
+    "validators",
+    "PIL",
+    "librosa",
+    "numpy",
+    "pygame",
+    "gi.repository.Gst",
+]
+
+
+# This is what runs inside each child process.
+# It starts the application, waits for the first window to be shown, and then quits right away.
+def run_child():
+    start = time.perf_counter()
+
+    # PyViz loads its logo using a relative path, so we need to be in the repository folder.
+    os.chdir(REPO_DIRECTORY)
+    sys.path.insert(0, REPO_DIRECTORY)
+
+    import pyvizapp
+    imported = time.perf_counter()
+
+    from gi.repository import GLib, Gio
+
+    # Normally, starting PyViz a second time just brings the first copy to the front.
+    # We want a brand new copy every time, so we make it "non-unique".
+    app = pyvizapp.PyVizApplication()
+    app.set_flags(app.get_flags() | Gio.ApplicationFlags.NON_UNIQUE)
+
+    result = {}
+
+    # Once the window has been drawn for the first time, write down the time and the loaded modules,
+    # and then quit.
+    def _window_mapped(window):
+        result["window_ms"] = (time.perf_counter() - start) * 1000
+        result["import_ms"] = (imported - start) * 1000
+        result["heavy_modules"] = [name for name in HEAVY_MODULES if name in sys.modules]
+        GLib.idle_add(app.quit)
+
+    app.connect("window-added", lambda app, window: window.connect("map", _window_mapped))
+    app.run([sys.argv[0]])
+
+    print(json.dumps(result))
+
+
+# Start one child process, and return its measurements.
+# `process_ms` also includes starting up the Python interpreter itself.
+# The background warm-up (see `_start_warm_up` in `pyvizapp.py`) is turned off in the child,
+# since it would race the `HEAVY_MODULES` check, and isn't part of startup anyway.
+def measure_once():
+    environment = dict(os.environ, PYVIZ_NO_WARMUP="1")
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child"], capture_output=True, text=True, check=True,
+        env=environment).stdout
+    total = (time.perf_counter() - start) * 1000
+
+    # The application might print things of its own. Our result is the last line.
+    result = json.loads(output.strip().splitlines()[-1])
+    result["process_ms"] = total
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how long PyViz takes to start.")
+    parser.add_argument("--runs", type=int, default=5, help="how many times to start PyViz")
+    parser.add_argument("--budget-ms", type=float, default=None, help="fail if the median time to the first window is over this")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child()
+        return 0
+
+    results = [measure_once() for run in range(args.runs)]
+
+    # Report the median and the worst of each measurement.
+    for key in ("import_ms", "window_ms", "process_ms"):
+        values = [result[key] for result in results]
+        print(key.ljust(12) + "median " + format(statistics.median(values), "8.1f") + "   max " + format(max(values), "8.1f"))
+
+    failed = False
+
+    heavy_modules = sorted(set(name for result in results for name in result["heavy_modules"]))
+    if len(heavy_modules) > 0:
+        print("FAIL: loaded before the first window: " + ", ".join(heavy_modules))
+        failed = True
+
+    window_ms = statistics.median(result["window_ms"] for result in results)
+    if args.budget_ms is not None and window_ms > args.budget_ms:
+        print("FAIL: time to first window " + format(window_ms, ".1f") + " ms is over the budget of " + format(args.budget_ms, ".1f") + " ms")
+        failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,233 @@
+# PyViz, a Python music visualizer.
+# Program by Austin Pringle, Caleb Rachocki, & Caleb Ruby
+# Pennsylvania Western University, California
+#
+# benchmarks/stream.py
+# This file is the frame streamer benchmark.
+# It starts the frame streamer (see `pyvizstream.py`) on this computer, hooks up a few screens to it,
+# and publishes made-up frames at a steady rate, like the visualizer would. The screens are:
+#
+# - a few motion JPEG screens that read every frame as fast as they can,
+# - one motion JPEG screen that never reads anything at all, like a screen on a hopeless Wi-Fi connection,
+# - and one WebSocket screen that follows the song position.
+#
+# Then it checks that:
+#
+# - `publish` never holds up the visualizer, even with the stuck screen,
+# - every frame is turned into a JPEG only once, no matter how many screens are watching,
+# - the stuck screen just misses frames, while the others keep getting them,
+# - and the song position keeps coming through the WebSocket.
+#
+# If any check fails, it exits with an error, so the problem gets noticed.
+#
+# Run it from anywhere, like so:
+#   python benchmarks/stream.py --seconds 5 --screens 3
+
+# `argparse` reads the command-line options.
+import argparse
+
+# For the WebSocket handshake, and for reading the position messages.
+import base64
+import json
+
+# `os` is used to access files in a system-independent way. The made-up frames are random noise.
+import os
+
+# The screens talk to the streamer over plain sockets, each on a thread of its own.
+import socket
+import threading
+
+# `sys` lets us find the rest of PyViz.
+import sys
+
+# For measuring time.
+import time
+
+# The top folder of the repository, where all of PyViz's files are.
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# How many different made-up frames to cycle through.
+# Noise makes big JPEGs, so the stuck screen's connection fills up quickly.
+FRAME_VARIETY = 8
+
+
+# A made-up frame. The streamer only looks at these three things of a `visualizerengine.FrameBuffer`.
+class Frame:
+    def __init__(self, width, height):
+        self.width, self.height = width, height
+        self.pixels = bytearray(os.urandom(width * height * 4))
+
+
+# Connect to the streamer and ask for `path`. The stuck screen asks for a tiny receive buffer, so it fills up fast.
+def connect(port, path, headers=b"", receive_buffer=None):
+    connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if receive_buffer is not None:
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+    connection.connect(("127.0.0.1", port))
+    connection.sendall(b"GET " + path + b" HTTP/1.1\r\nHost: 127.0.0.1\r\n" + headers + b"\r\n")
+    return connection
+
+
+# A motion JPEG screen that reads every frame as fast as it can. It counts the frames it got.
+class VideoScreen(threading.Thread):
+    def __init__(self, port, boundary):
+        super().__init__(daemon=True)
+        self.connection = connect(port, b"/stream.mjpg")
+        self.boundary = b"--" + boundary
+        self.frames = 0
+
+    def run(self):
+        # A boundary can be split between two reads, so the end of each read is kept for the next one.
+        leftover = b""
+        try:
+            while True:
+                data = self.connection.recv(1 << 16)
+                if len(data) == 0:
+                    return
+                data = leftover + data
+                self.frames += data.count(self.boundary)
+                leftover = data[-(len(self.boundary) - 1):]
+                if self.boundary in leftover:
+                    leftover = b""
+        except OSError:
+            return
+
+
+# A WebSocket screen that follows the song position. It keeps the last position it got.
+class PositionScreen(threading.Thread):
+    def __init__(self, port):
+        super().__init__(daemon=True)
+        key = base64.b64encode(os.urandom(16))
+        self.connection = connect(port, b"/position",
+            b"Upgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Version: 13\r\nSec-WebSocket-Key: " + key + b"\r\n")
+        self.messages = 0
+        self.last = None
+
+    def _read(self, size):
+        data = b""
+        while len(data) < size:
+            piece = self.connection.recv(size - len(data))
+            if len(piece) == 0:
+                raise EOFError()
+            data += piece
+        return data
+
+    def run(self):
+        try:
+            # Skip the handshake's reply.
+            reply = b""
+            while not reply.endswith(b"\r\n\r\n"):
+                reply += self._read(1)
+
+            # Then read messages. The streamer only ever sends short text ones.
+            while True:
+                header = self._read(2)
+                size = header[1] & 0x7F
+                if size == 126:
+                    size = int.from_bytes(self._read(2), "big")
+                elif size == 127:
+                    size = int.from_bytes(self._read(8), "big")
+                payload = self._read(size)
+                if header[0] & 0x0F == 0x8:
+                    return
+                self.last = json.loads(payload)
+                self.messages += 1
+        except (EOFError, OSError, ValueError):
+            return
+
+
+# One check: its name, whether it passed, and what we saw.
+def report(name, passed, details):
+    print(("ok    " if passed else "FAIL  ") + name.ljust(14) + details)
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that PyViz's frame streamer never holds up the visualizer.")
+    parser.add_argument("--seconds", type=float, default=5, help="how long to publish frames for")
+    parser.add_argument("--fps", type=float, default=60, help="how many frames per second to publish")
+    parser.add_argument("--width", type=int, default=640, help="the width of the made-up frames")
+    parser.add_argument("--height", type=int, default=360, help="the height of the made-up frames")
+    parser.add_argument("--screens", type=int, default=3, help="how many motion JPEG screens keep up")
+    parser.add_argument("--max-publish-ms", type=float, default=20, help="the longest a single publish may take")
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_DIRECTORY)
+    import pyvizstream
+
+    frames = [Frame(args.width, args.height) for index in range(FRAME_VARIETY)]
+
+    # Port 0 lets the operating system pick a free one. We look up which afterwards.
+    # The frame rate limit is set above what we publish, so every frame we publish is taken.
+    streamer = pyvizstream.FrameStreamer(port=0, max_fps=args.fps * 4)
+    streamer.start()
+    results = []
+    try:
+        port = streamer.server.sockets[0].getsockname()[1]
+        screens = [VideoScreen(port, pyvizstream.BOUNDARY) for index in range(args.screens)]
+        position_screen = PositionScreen(port)
+        stuck = connect(port, b"/stream.mjpg", receive_buffer=4096)
+        for screen in screens + [position_screen]:
+            screen.start()
+
+        # Give every screen a moment to connect.
+        deadline = time.monotonic() + 5
+        while len(streamer.video_clients) < args.screens + 1 or len(streamer.position_clients) < 1:
+            if time.monotonic() > deadline:
+                break
+            time.sleep(0.01)
+
+        # Publish frames at a steady rate, timing every call.
+        publish_times = []
+        published = 0
+        start = time.perf_counter()
+        next_frame = start
+        while time.perf_counter() - start < args.seconds:
+            before = time.perf_counter()
+            last_publish = streamer.last_publish
+            streamer.publish(frames[published % FRAME_VARIETY], before - start)
+            publish_times.append(time.perf_counter() - before)
+            if streamer.last_publish != last_publish:
+                published += 1
+            next_frame += 1.0 / args.fps
+            time.sleep(max(0.0, next_frame - time.perf_counter()))
+
+        # Let the screens catch up with the last frame.
+        time.sleep(0.5)
+        encoded = streamer.frames_encoded
+        dropped = sorted(client.dropped for client in streamer.video_clients)
+
+        # Publishing has to be quick every time, not just on average.
+        publish_times.sort()
+        slowest = publish_times[-1] * 1000
+        median = publish_times[len(publish_times) // 2] * 1000
+        results.append(report("publish", slowest <= args.max_publish_ms,
+            str(len(publish_times)) + " calls, median " + format(median, ".2f") + " ms, slowest " + format(slowest, ".2f")
+            + " ms (at most " + format(args.max_publish_ms, ".0f") + " ms allowed)"))
+
+        # Each frame is encoded once for everyone, so there can't be more JPEGs than frames, and no screen can get more than were made.
+        received = [screen.frames for screen in screens]
+        results.append(report("encode once", 0 < encoded <= published and max(received) <= encoded,
+            str(encoded) + " JPEGs for " + str(published) + " frames and " + str(args.screens + 1) + " screens, "
+            + "most any screen got: " + str(max(received))))
+
+        # The stuck screen misses frames. The others get most of them.
+        keeping_up = min(received) >= encoded * 0.5
+        results.append(report("stuck screen", len(dropped) > 0 and dropped[-1] > 0 and keeping_up,
+            str(dropped[-1] if len(dropped) > 0 else 0) + " frames dropped for the stuck screen, the others got "
+            + ", ".join(str(count) for count in received) + " of " + str(encoded)))
+
+        # The position keeps coming, and it's the newest one.
+        last_position = position_screen.last["position"] if position_screen.last is not None else None
+        results.append(report("position", position_screen.messages > 0 and last_position is not None and last_position >= args.seconds * 0.9,
+            str(position_screen.messages) + " positions, the last at " + (format(last_position, ".2f") + " s" if last_position is not None else "nothing")))
+
+        stuck.close()
+    finally:
+        streamer.stop()
+
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
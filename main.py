@@ -12,15 +12,20 @@ import sys
 # Importing the app.
 import pyvizapp
 
-# Instantiate the `PyVizApplication` object
-app = pyvizapp.PyVizApplication()
+# The visualizer and its analysis run in processes of their own (see `pyvizvisprocess.py`).
+# Those processes load this file too, but they must not start another copy of the app,
+# so the app only runs when this file is the program itself.
+if __name__ == "__main__":
 
-# Call the `run` method on the newly-created app.
-# We also pass command line arguments to the `run` method via `sys.argv`
-# We don't use  these command line arguments.
-# However, gtk requires access to them.
-# Then, we save the exit status of the app to the variable `exit_status`
-exit_status = app.run(sys.argv)
+    # Instantiate the `PyVizApplication` object
+    app = pyvizapp.PyVizApplication()
 
-# After the app is done running, we exit the interpreter and raise the exit status via a method. 
-sys.exit(exit_status)
\ No newline at end of file
+    # Call the `run` method on the newly-created app.
+    # We also pass command line arguments to the `run` method via `sys.argv`
+    # We don't use  these command line arguments.
+    # However, gtk requires access to them.
+    # Then, we save the exit status of the app to the variable `exit_status`
+    exit_status = app.run(sys.argv)
+
+    # After the app is done running, we exit the interpreter and raise the exit status via a method. 
+    sys.exit(exit_status)
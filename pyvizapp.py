@@ -12,6 +12,9 @@
 # `os` is used to access files in a system-independent way.
 import os
 
+# `sys` lets us check which modules have already been loaded.
+import sys
+
 # The explanation of these next libraries is a bit complicated.
 
 # GObject is a library for the C language that adds Object-Oriented features.
@@ -41,32 +44,39 @@ gi.require_version("Adw", "1")
 #   libadwaita extends the Gtk library with a few fancy new widgets.
 from gi.repository import GLib, Gtk, Adw
 
-# `yt_dlp` is an incredibly useful command-line tool for downloading content from YouTube.
-# `yt_dlp` also provides a Python package. Here, we import yt_dlp's 'YoutubeDL' class.
-# This class provides the actual downloader function, as well as the DownloadError error,
-# for error-handling purposes.
-from yt_dlp import YoutubeDL, DownloadError
-
-# We use the `validators` package to check that the URL that the user enters into the program
-# is actually a valid URL.
-import validators
+# !Important! Everything above this point is all the program needs to put the first window on screen.
+# Some of the libraries we use are very slow to load (yt_dlp, librosa, numpy, pygame, GStreamer...),
+# so this file only imports the lightweight ones up here.
+# The heavy ones are imported inside the functions that first need them, after the window is already up.
+# Python only really loads a module the first time it is imported. Importing it again is nearly free.
+#
+# Here is what gets loaded later on, and where:
+#
+# - `yt_dlp` is an incredibly useful command-line tool for downloading content from YouTube.
+#   `yt_dlp` also provides a Python package. We use its DownloadError error for error-handling purposes.
+#   The actual `YoutubeDL` objects live in `pyvizdownloader.py`, our shared downloader service.
+#
+# - We use the `validators` package to check that the URL that the user enters into the program
+#   is actually a valid URL.
+#
+# - The search results page and the customizer page pop up on the navigation
+#   depending on what the user does. More explanation in their own files.
 
 # Downloading a video is a long operation. By default, using YoutubeDL will freeze the GUI
 # until the video is done downloading, making the user think something is broken.
-# To do this, we perform the download operation asynchronously using this `threading` package.
-import threading
+# To avoid this, we hand the download operation to the background job scheduler.
+import pyvizscheduler
 
-# This lets us nuke a directory and all of its contents.
-# Used to give us a fresh .tmp directory ever time.
-from shutil import rmtree
+# Searches and visualizations each run in their own session. See `pyvizsession.py` for more information.
+import pyvizsession
 
-# Used to guarantee image format
-from PIL import Image
+# Every stage between "Submit" and the first visualizer frame is timed. See `pyviztelemetry.py`.
+import pyviztelemetry
 
-# These pages pop up on the navigation depending on what the user does.
-# More explanation in their own files.
-import pyvizsearchresultspage
-import pyvizcustomizerpage
+# The songs of a playlist, from its info dictionary. Anything that isn't a playlist has none.
+# yt-dlp leaves an empty spot for songs it couldn't read (say, a deleted video), so we skip those.
+def playlist_entries(info):
+    return [entry for entry in info.get("entries") or [] if entry and entry.get("id")]
 
 # THE APPLICATION CLASS
 
@@ -88,6 +98,29 @@ class PyVizApplication (Adw.Application):
         # Set the user-facing application name as "PyViz"
         GLib.set_application_name("PyViz")
 
+    # When the application is shutting down, this function is automatically called.
+    def do_shutdown(self):
+
+        # Cancel any background jobs that are still going,
+        # and clean up the private folders of any sessions that are still open.
+        pyvizscheduler.scheduler.shutdown()
+        pyvizsession.close_all_sessions()
+
+        # Stop the analysis processes, if any were started.
+        if "pyvizvisprocess" in sys.modules:
+            sys.modules["pyvizvisprocess"].shutdown()
+
+        # Write out the last telemetry snapshot.
+        pyviztelemetry.telemetry.close()
+
+        # Close the shared downloader sessions, along with their network connections.
+        # If nothing was ever downloaded, the downloader was never loaded, and there is nothing to close.
+        if "pyvizdownloader" in sys.modules:
+            sys.modules["pyvizdownloader"].downloader.close()
+
+        # Use the shutdown logic from the parent class.
+        Adw.Application.do_shutdown(self)
+
     # On activation of the application, this function is automatically called.
     # We build the UI on activation of the application.
     def do_activate(self):
@@ -206,6 +239,10 @@ class PyVizApplication (Adw.Application):
         # Present the window
         window.present()
 
+        # Once the window is up and the GUI has nothing better to do, start warming up the visualizer
+        # in the background. See `_warm_up` below.
+        GLib.idle_add(self._start_warm_up, priority=GLib.PRIORITY_LOW)
+
         # Connect the submit button's "clicked" signal to the appropriate function.
         # This means that the `_submit_clicked` method will be called
         # whenever the submit button is clicked
@@ -215,6 +252,25 @@ class PyVizApplication (Adw.Application):
         # in order to indicate to the user that something is happening.
         submit_button.connect("clicked", self._submit_clicked, url_entry, feedback_text_spinner, feedback_text, navigation_view)
 
+    # Hand the visualizer warm-up to the background job scheduler.
+    # It is only done "just in case", so it has the lowest priority, and real work pushes it aside.
+    # Setting the `PYVIZ_NO_WARMUP` environment variable skips it entirely.
+    def _start_warm_up(self):
+        if not os.environ.get("PYVIZ_NO_WARMUP"):
+            pyvizscheduler.scheduler.submit("analysis", self._warm_up, priority=pyvizscheduler.PRIORITY_PREFETCH)
+        return GLib.SOURCE_REMOVE
+
+    # The first visualization in a program pays for loading librosa, numpy and pygame,
+    # and for setting up the audio decoder, resampler and FFT.
+    # That's several seconds, right after the user clicks "Visualize!"
+    # Instead, we pay for it here, in the background, while the user is still searching and customizing.
+    # The analysis runs in a process of its own (see `pyvizvisprocess.py`), so that's the one that gets warmed up.
+    # None of those libraries are loaded into this process: they would only slow down the GUI.
+    def _warm_up(self, job):
+        job.check()
+        import pyvizvisprocess
+        pyvizvisprocess.warm_up(job.check)
+
     # This is a callback function, activated whenever the user clicks "submit".
     def _submit_clicked(self, button, url_entry, spinner, feedback_text, navigation_view):
             
@@ -225,128 +281,119 @@ class PyVizApplication (Adw.Application):
         # Further, we haven't actually checked if it's a URL or a query at this point!
         url = [url_entry.get_text()]
 
-        # Create a new thread in which we can download from YouTube asynchronously.
-        # We pass the Application object's "get_audio" method (defined below)
-        # as the target of the thread.
-        # We then pass the URL (it might be a query but we call the variable `url`).
-        # Also, we further pass along all of the UI elements we wish to change.
-        audioDlThread = threading.Thread(target=self.get_data, args=(url, button, spinner, feedback_text, navigation_view))
-        audioDlThread.start()
-    
-    # This function downloads the data from YouTube. It is run asynchronously in a thread.
-    def get_data(self, url, submit_button, spinner, feedback_text, navigation_view):
-
         # We make some UI changes to indicate to the user that the program is working.
         # Namely, make the submit button insensitive to input and change the feedback text.
         # Also, show the spinner.
-        submit_button.set_sensitive(False)
+        button.set_sensitive(False)
         feedback_text.set_label("The program is fetching content from YouTube");
         spinner.start()
 
+        # Everything that follows from this press of "Submit", up to the first visualizer frame, is one trace.
+        trace_id = pyviztelemetry.telemetry.new_trace()
+
+        # Hand the download off to the background job scheduler, so the GUI doesn't freeze.
+        # We pass the Application object's "get_data" method (defined below) as the job.
+        # We then pass the URL (it might be a query but we call the variable `url`).
+        # The user is staring at a spinner until this comes back, so it gets top priority.
+        # When the job is done, the scheduler calls one of the two callbacks on the GUI's main loop,
+        # and we pass along all of the UI elements we wish to change to them.
+        pyvizscheduler.scheduler.submit("search", self.get_data, url, trace_id,
+            priority=pyvizscheduler.PRIORITY_USER,
+            on_done=lambda info: self._data_fetched(info, trace_id, button, spinner, feedback_text, navigation_view),
+            on_error=lambda error: self._data_failed(error, url, trace_id, button, spinner, feedback_text, navigation_view))
+    
+    # This function downloads the data from YouTube. It is run in the background by the scheduler.
+    # Whatever it returns is handed to `_data_fetched`.
+    # If it raises an error, the error is handed to `_data_failed` instead.
+    def get_data(self, job, url, trace_id):
+
+        # Load the downloader (and yt_dlp along with it) the first time we need it.
+        import pyvizdownloader
+        import pyvizthumbnails
+
         # We don't download the actual audio now. That comes later.
         # Instead, we just want metadata about the video,
         # in order to show  the user what result we came back with for their query.
         # However, how do we tell if the input is a URL or a search?
-        # Here, we `try` to treat it as a URL before anything else:
-        try:
-            
-            # This is weird, but basically, nuke the .tmp directory,
-            # And then recreate it.
-            # Then, if we get any error, just create it instead.
-            # Technically, we don't need to create the .tmp directory here,
-            # because the YouTube downloader does it automatically.
-            # Better to be safe than sorry.
-            try:
-                rmtree(".tmp")
-                os.mkdir(".tmp")
-            except: 
-                os.mkdir(".tmp")
-
-            # Instead of having one method with a Buuuuunch of params,
-            # yt_dlp's YoutubeDL object takes a dictionary of potential arguments.
-            # `ydl_opts` defines our download arguments
-            ydl_opts = {
-
-                # Save the downloads to a directory called .tmp\1\
-                'paths': {
-                    'home' : os.path.join(".",".tmp", str(1))  
-                },
-
-                # Don't actually download the video itself at all.
-                # Remember, right now, we just want metadata.
-                'skip_download' : 'true',
-
-                # Write the thumbnail to file
-                'writethumbnail' : 'true',
-
-
-                # We set the name of the output thumbnail as:
-                # <title> (SPACE) <url>
-                # We are actually using the filename to store the URL
-                # for when we need it later.
-                'outtmpl' : {
-                    'default' : '%(title)s %(id)s'
-                }
-            }
-
-            # Instantiate a `YoutubeDL` object, using `ydl_opts` as the parameter.
-            # Then, call the `download` method, passing `url` as a parameter.
-            # This treats all user entries as URLs.
-            # If YoutubeDL throws an error, the flow won't continue past this statement,
-            # and we will end up at the "except" block
-            YoutubeDL(ydl_opts).download(url)
-
-            # Declare a variable which will hold the path to the downloaded thumbnail.
-            # Ignore how ugly this line of code is. It basically grabs the first file
-            # in the tmp\1\ directory, which should be the download.
-            thumbnail_path = os.path.join(".tmp", str(1), os.listdir(os.path.join(".tmp",str(1)))[0])
-
-            # Google invented a wacky file format called .webp,
-            # which is the format that they use to store YouTube thumbnails.
-            # Gtk doesn't play well with .webp sometimes, so let's make the images .png!
-            # We're going to convert the image to .png using PIL (the Pillow package)
-            # Here, we open the image we just found, as an image object,
-            # Then split the filename and extension, in order to remove the .webp extension.
-            # Then we save it as .png
-            Image.open(thumbnail_path).save(os.path.splitext(thumbnail_path)[0] + ".png")
-
-            # Delete the original unconverted thumbnail
-            os.remove(thumbnail_path)
-
-            # Update the thumbnail path to point to the new .png version
-            thumbnail_path = os.path.splitext(thumbnail_path)[0] + ".png"
-
-            # If we get here, it means that the download was successful.
-            # After YoutubeDL finishes, we revert the UI changes on the splash page:
-            feedback_text.set_label("")
+        # Here, we try to treat it as a URL before anything else.
+        #
+        # Borrow a long-lived `YoutubeDL` session from the shared downloader service.
+        # It already knows not to download the video itself. Remember, right now, we just want metadata.
+        # Then, call the `extract_info` method, passing the URL as a parameter.
+        # This treats all user entries as URLs.
+        # If YoutubeDL throws an error, the flow won't continue past this statement,
+        # and we will end up in `_data_failed`.
+        #
+        # If the URL is a playlist, we only want the list of its songs for now, not the full details of every one.
+        # That's what "extract_flat" does.
+        telemetry = pyviztelemetry.telemetry
+        with pyvizdownloader.downloader.metadata_session(extract_flat="in_playlist") as ydl:
+            with telemetry.span("probe", trace=trace_id):
+                info = ydl.extract_info(url[0], download=False)
+            job.check()
+
+            # Fetch the thumbnail into the shared thumbnail cache.
+            # It is decoded and shrunk to display size in memory, right here in the background,
+            # so the customizer page can draw it without ever touching the disk.
+            # For a playlist, that's the thumbnail of its first song.
+            entries = playlist_entries(info)
+            with telemetry.span("thumbnail", trace=trace_id):
+                pyvizthumbnails.thumbnail_cache.load(entries[0] if len(entries) > 0 else info, ydl)
+
+        return info
+
+    # If `get_data` was successful, we end up here, back on the GUI's main loop.
+    def _data_fetched(self, info, trace_id, submit_button, spinner, feedback_text, navigation_view):
+        import pyvizcustomizerpage
+
+        # We revert the UI changes on the splash page:
+        feedback_text.set_label("")
+        submit_button.set_sensitive(True)
+        spinner.stop()
+
+        import pyvizdownloader
+
+        # Hold on to everything the probe found out, so the download doesn't have to find it all out again.
+        # A playlist starts with its first song, and the rest of them are queued up behind it.
+        entries = playlist_entries(info)
+        video = pyvizdownloader.VideoInfo(entries[0] if len(entries) > 0 else info)
+        playlist = [pyvizdownloader.VideoInfo(entry) for entry in entries[1:]]
+
+        # Now that we know which video we want, we can continue.
+        # Push the visualizer customizer page to the navigation stack.
+        navigation_view.push(pyvizcustomizerpage.PyVizCustomizerPage(video, navigation_view, trace_id, playlist))
+
+    # If `get_data` fails, we end up down here, back on the GUI's main loop.
+    def _data_failed(self, error, url, trace_id, submit_button, spinner, feedback_text, navigation_view):
+        from yt_dlp import DownloadError
+        import validators
+        import pyvizsearchresultspage
+
+        # Something other than a download error means something is actually broken.
+        # We tell the user, and let them try again.
+        if not isinstance(error, DownloadError):
+            feedback_text.set_label("Something went wrong. Please try again.")
             submit_button.set_sensitive(True)
             spinner.stop()
 
-            # Now that we know which video we want, we can continue.
-            # Push the visualizer customizer page to the navigation stack.
-            navigation_view.push(pyvizcustomizerpage.PyVizCustomizerPage(thumbnail_path, navigation_view))
-        
-        # If the above `try` block fails (download error), we end up down here.
-        except DownloadError:
-            # We check if the user input is a URL at all, using the `validators` package.
-            if validators.url(url[0]):
-                # If it is a URL, we tell the user that the URL was unable to parse.
-                feedback_text.set_label("The program was unable to parse the URL.")
-
-                # Make the submit button sensitive again, and stop the spinner.
-                # However, do not hide the feedback text
-                submit_button.set_sensitive(True)
-                spinner.stop()
-
-            # However, if we get down here, it means that both...
-            # 1) The download failed
-            # 2) The entry doesn't validate as a URL
-            # ...and now we can treat the entry as a search query instead.
-            else:
-                # We create the search results page, passing...
-                # 1) the UI elements we want to change
-                # 2) The user input
-                # ...as parameters to the constructor.
-                # After it is created, it is pushed to the navigation view. 
-                navigation_view.push(pyvizsearchresultspage.PyVizSearchResultsPage(url, feedback_text, submit_button, spinner, navigation_view))
-        return
\ No newline at end of file
+        # We check if the user input is a URL at all, using the `validators` package.
+        elif validators.url(url[0]):
+            # If it is a URL, we tell the user that the URL was unable to parse.
+            feedback_text.set_label("The program was unable to parse the URL.")
+
+            # Make the submit button sensitive again, and stop the spinner.
+            # However, do not hide the feedback text
+            submit_button.set_sensitive(True)
+            spinner.stop()
+
+        # However, if we get down here, it means that both...
+        # 1) The download failed
+        # 2) The entry doesn't validate as a URL
+        # ...and now we can treat the entry as a search query instead.
+        else:
+            # We create the search results page, passing...
+            # 1) the UI elements we want to change
+            # 2) The user input
+            # ...as parameters to the constructor.
+            # After it is created, it is pushed to the navigation view. 
+            navigation_view.push(pyvizsearchresultspage.PyVizSearchResultsPage(url, feedback_text, submit_button, spinner, navigation_view, trace_id))
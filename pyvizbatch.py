@@ -0,0 +1,497 @@
+# PyViz, a Python music visualizer.
+# Program by Austin Pringle, Caleb Rachocki, & Caleb Ruby
+# Pennsylvania Western University, California
+#
+# pyvizbatch.py
+# This file contains the batch renderer.
+# It renders visualizations to video files without any windows or clicking around.
+# Render jobs come from a job file, or from a folder that we keep an eye on for new job files.
+#
+# A job is a small JSON object, like so:
+#   {"id": "my-song", "source": "song.mp3", "style": "bars", "fg": [53, 132, 228], "bg": [255, 255, 255],
+#    "output": "my-song.mp4", "width": 1280, "height": 720, "framerate": 30}
+#
+# - "source" is an audio file, or anything the YouTube downloader understands (a URL or a video ID).
+# - "style" is "bars" (the built-in visualizer) or "goom".
+# - "fg" and "bg" are the bar and background colors. They only matter for "bars".
+# - "id", "width", "height" and "framerate" are optional.
+# - "tier" (optional) is how carefully "bars" analyzes the song: "fast", "balanced" or "high".
+# - "bar_style" (optional) is how the "bars" look: "flat", "gradient" or "neon".
+# - "visual" (optional) is the look of "bars": one of `visualizerengine.VISUALS`, "bars" (the default) or "pulse".
+# - "extra_outputs" (optional) are more videos to render from the same analysis, at the same time, like so:
+#     [{"output": "my-song-pulse.mp4", "visual": "pulse", "width": 640, "height": 640}]
+#   Each can have its own "visual", "bar_style", "fg", "bg", "width" and "height". Anything left out comes from the job.
+#   Only "bars" jobs have them.
+# - "analysis_memory_mb" (optional) is how much memory the "bars" analysis may use, in megabytes.
+#   The analysis picks a cheaper way of working to fit, or the job fails if it can't. See `ANALYSIS_STRATEGIES`.
+#
+# A job file holds one job per line. A watched folder holds one job per .json file,
+# and the file's name is the job's ID unless it says otherwise.
+# Relative paths in a job ("source", "output", and each extra "output") are taken from the folder the job file is in.
+# Job IDs end up in the names of files and folders, so they may only use letters, digits, "-" and "_".
+#
+# Each job runs in its own process, with limits on how much memory and CPU time it may use.
+# Only a few of them run at once. A job that fails is tried again, up to a limit.
+# Everything we know about every job is saved to a state file after each change,
+# so if the batch renderer is stopped, it picks up right where it left off.
+# When a job is done, a report with how long each step took (and, for "bars", how much memory the analysis used)
+# is written next to the state file.
+#
+# Run it like so:
+#   python pyvizbatch.py --jobs jobs.jsonl --once
+#   python pyvizbatch.py --watch incoming/
+
+# `argparse` reads the command-line options.
+import argparse
+
+# Jobs, state and reports are all JSON.
+import json
+
+# `os` is used to access files in a system-independent way.
+import os
+
+# `shutil` cleans up each job's scratch folder.
+import shutil
+
+import sys
+
+# Each job gets its own scratch folder, made with `tempfile`.
+import tempfile
+
+# For measuring time, and for waiting between checks.
+import time
+
+# For sending the details of a failure back from a job's process.
+import traceback
+
+# Job IDs are checked with a regular expression.
+import re
+
+# Each job runs in its own process, so a job that crashes, or hits its limits, can't take the others down with it.
+# "spawn" starts each process fresh, instead of copying this one.
+import multiprocessing
+
+# The visual styles a job can ask for.
+STYLES = ["bars", "goom"]
+
+# What a job ID may look like. Anything else (a "/" or a "..", say) could put its files outside of where they belong.
+JOB_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]+")
+
+# Defaults for the command-line options.
+DEFAULT_WORKERS = 2
+DEFAULT_RETRIES = 2
+DEFAULT_MEMORY_MB = 4096
+DEFAULT_CPU_SECONDS = 3600
+DEFAULT_STATE_FILE = "pyviz-batch-state.json"
+
+# How often we check on running jobs and the watched folder, in seconds.
+POLL_INTERVAL = 0.5
+
+
+# Make a job out of what was read from a job file, filling in defaults and checking it makes sense.
+# Relative paths are taken from `directory`, the folder the job file is in.
+# Raises a `ValueError` if it doesn't make sense.
+def make_job(spec, default_id, directory="."):
+    if not isinstance(spec, dict):
+        raise ValueError("a job must be a JSON object")
+    if not isinstance(spec.get("source"), str) or not isinstance(spec.get("output"), str):
+        raise ValueError("a job needs a \"source\" and an \"output\"")
+    extra_outputs = spec.get("extra_outputs", [])
+    if not isinstance(extra_outputs, list) or not all(isinstance(output, dict) and isinstance(output.get("output"), str) for output in extra_outputs):
+        raise ValueError("\"extra_outputs\" must be a list of JSON objects, each with an \"output\"")
+
+    job = {
+        "id": str(spec.get("id", default_id)),
+        "source": spec["source"],
+        "style": spec.get("style", "bars"),
+        "fg": spec.get("fg", [53, 132, 228]),
+        "bg": spec.get("bg", [255, 255, 255]),
+        "output": os.path.abspath(os.path.join(directory, spec["output"])),
+        "width": int(spec.get("width", 1280)),
+        "height": int(spec.get("height", 720)),
+        "framerate": int(spec.get("framerate", 30)),
+
+        # One of `visualizerengine.ANALYSIS_TIERS`, or `None` for the default one. Only the "bars" style uses it.
+        "tier": spec.get("tier"),
+
+        # One of `visualizerengine.BAR_STYLES`, or `None` for the default one. Only the "bars" style uses it.
+        "bar_style": spec.get("bar_style"),
+
+        # The analysis memory budget, or `None` for the default one. Only the "bars" style uses it.
+        "analysis_memory_mb": spec.get("analysis_memory_mb"),
+
+        # One of `visualizerengine.VISUALS`, or `None` for the default one, and more videos to render alongside.
+        # Only the "bars" style uses them.
+        "visual": spec.get("visual"),
+        "extra_outputs": [dict(output, output=os.path.abspath(os.path.join(directory, output["output"]))) for output in extra_outputs],
+    }
+    if not JOB_ID_PATTERN.fullmatch(job["id"]):
+        raise ValueError("a job ID may only use letters, digits, \"-\" and \"_\", not \"" + job["id"] + "\"")
+    if job["style"] not in STYLES:
+        raise ValueError("unknown style \"" + job["style"] + "\"")
+
+    # Local audio files are looked up relative to where the job came from, so make them absolute now.
+    # Anything else is left for the YouTube downloader.
+    source = os.path.join(directory, job["source"])
+    if os.path.exists(source):
+        job["source"] = os.path.abspath(source)
+
+    return job
+
+
+# Read every job out of a job file, one JSON object per line.
+# Jobs without an ID of their own are named after the file, with anything an ID can't have swapped for "_".
+def read_job_file(path):
+    jobs = []
+    name = re.sub(r"[^A-Za-z0-9_-]", "_", os.path.splitext(os.path.basename(path))[0])
+    directory = os.path.dirname(os.path.abspath(path))
+    with open(path) as job_file:
+        for line_number, line in enumerate(job_file, start=1):
+            if line.strip() == "":
+                continue
+            jobs.append(make_job(json.loads(line), name + "-" + str(line_number), directory))
+    return jobs
+
+
+# The state of every job the batch renderer knows about, saved to a file.
+# `jobs` maps a job ID to a record of the job itself, its status, how many attempts it took,
+# what went wrong last, and its report.
+# A status is "pending", "running", "done" or "failed".
+class BatchState:
+
+    # Constructor function
+    # If there is a state file from last time, pick up where it left off.
+    def __init__(self, path):
+        self.path = path
+        self.jobs = {}
+        if os.path.exists(path):
+            with open(path) as state_file:
+                self.jobs = json.load(state_file)["jobs"]
+
+        # Anything that was running when we were stopped never finished. It gets another go.
+        for record in self.jobs.values():
+            if record["status"] == "running":
+                record["status"] = "pending"
+
+    # Add a job, unless we already know about it.
+    def add(self, job):
+        if job["id"] in self.jobs:
+            return False
+        self.jobs[job["id"]] = {"job": job, "status": "pending", "attempts": 0, "error": None, "report": None}
+        return True
+
+    # The IDs of all jobs waiting to run, oldest first.
+    def pending(self):
+        return [job_id for job_id, record in self.jobs.items() if record["status"] == "pending"]
+
+    # Save the state.
+    # We write it to a separate file first, and then swap it in, so a crash halfway through
+    # can never leave a broken state file behind.
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        descriptor, temporary_path = tempfile.mkstemp(prefix=".pyviz-batch-", dir=directory)
+        with os.fdopen(descriptor, "w") as state_file:
+            json.dump({"jobs": self.jobs}, state_file, indent=2)
+        os.replace(temporary_path, self.path)
+
+
+# Limit how much memory and CPU time the current process may use.
+# If it goes over, the operating system stops it.
+#
+# The memory limit is a limit on "address space", which programs started from this process inherit.
+# Some programs reserve a lot more address space than they ever use (ffmpeg's threads, for one),
+# and fail in odd ways under a tight limit. So `run_job` only sets the memory limit once the song has been fetched,
+# after yt-dlp and ffmpeg are done extracting the audio. The ffmpeg that encodes the video still runs under it,
+# so `--memory-mb` should leave it some room.
+def limit_resources(memory_mb, cpu_seconds):
+    try:
+        import resource
+    except ImportError:
+        # Not every system has these limits (Windows doesn't). Run without them.
+        return
+
+    if memory_mb is not None:
+        memory = memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    if cpu_seconds is not None:
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds))
+
+
+# Render the built-in visualizer for a song. Returns how long analyzing and rendering took, in seconds,
+# and how much memory the analysis used (see `AudioAnalyzer`).
+def render_bars(job, audio_path):
+    import visualizerengine
+
+    start = time.perf_counter()
+    analyzer = visualizerengine.AudioAnalyzer(audio_path, job.get("tier"), job.get("analysis_memory_mb"))
+    analyzed = time.perf_counter()
+
+    # The extra videos share the job's analysis and frame rate. See `FeatureBus`.
+    extra_outputs = []
+    try:
+        for output in job.get("extra_outputs", []):
+            os.makedirs(os.path.dirname(output["output"]), exist_ok=True)
+            width, height = int(output.get("width", job["width"])), int(output.get("height", job["height"]))
+            visual = visualizerengine.create_visual(output.get("visual", job.get("visual")), analyzer,
+                tuple(output.get("fg", job["fg"])), tuple(output.get("bg", job["bg"])), width, height, output.get("bar_style", job.get("bar_style")))
+            extra_outputs.append(visualizerengine.VideoOutput(visual, audio_path, output["output"], width, height, job["framerate"]))
+    except BaseException:
+        for output in extra_outputs:
+            output.close()
+        raise
+
+    visualizerengine.render_audio_visualizer(analyzer, audio_path, job["output"], tuple(job["fg"]), tuple(job["bg"]),
+        job["width"], job["height"], job["framerate"], job.get("bar_style"), job.get("visual"), extra_outputs)
+
+    return {"analyze": analyzed - start, "render": time.perf_counter() - analyzed}, analyzer.memory
+
+
+# Render GOOM for a song. Returns how long rendering took, in seconds.
+# GOOM doesn't analyze the song ahead of time, so there is no analysis memory to report.
+# The exporter reports back through the main loop, so we run one until it is done.
+def render_goom(job, audio_path):
+    from gi.repository import GLib
+    import pyvizgoomexport
+
+    start = time.perf_counter()
+    loop = GLib.MainLoop()
+    errors = []
+
+    def _failed(message):
+        errors.append(message)
+        loop.quit()
+
+    exporter = pyvizgoomexport.GoomExporter(audio_path, job["output"], job["width"], job["height"], job["framerate"],
+        on_done=lambda output_path: loop.quit(),
+        on_error=_failed)
+    exporter.start()
+    loop.run()
+
+    if len(errors) > 0:
+        raise RuntimeError(errors[0])
+
+    return {"render": time.perf_counter() - start}, None
+
+
+# Run one job, start to finish. This runs in the job's own process.
+# `connection` is how we send the report (or what went wrong) back to the batch renderer.
+def run_job(job, memory_mb, cpu_seconds, connection):
+    limit_resources(None, cpu_seconds)
+
+    # There is no screen and no speakers here.
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+    work_directory = tempfile.mkdtemp(prefix="pyviz-batch-" + job["id"] + "-")
+    try:
+        start = time.perf_counter()
+
+        # Get the audio: either it is right here already, or we download it.
+        if os.path.exists(job["source"]):
+            audio_path = job["source"]
+        else:
+            import pyvizdownloader
+            audio_path = pyvizdownloader.downloader.download_audio(job["source"], work_directory, "audio")
+        timings = {"fetch": time.perf_counter() - start}
+
+        # Only the rendering runs under the memory limit. See `limit_resources`.
+        limit_resources(memory_mb, None)
+
+        os.makedirs(os.path.dirname(job["output"]), exist_ok=True)
+        if job["style"] == "goom":
+            render_timings, memory = render_goom(job, audio_path)
+        else:
+            render_timings, memory = render_bars(job, audio_path)
+        timings.update(render_timings)
+        timings["total"] = time.perf_counter() - start
+
+        connection.send(("done", {"seconds": timings, "memory": memory}))
+    except BaseException:
+        connection.send(("error", traceback.format_exc()))
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+        connection.close()
+
+
+# A job that is running right now, in its own process.
+class RunningJob:
+    def __init__(self, job_id, process, connection):
+        self.job_id = job_id
+        self.process = process
+        self.connection = connection
+        self.started = time.time()
+
+
+# The batch renderer itself.
+class BatchRunner:
+
+    # Constructor function
+    def __init__(self, state, workers=DEFAULT_WORKERS, retries=DEFAULT_RETRIES, memory_mb=DEFAULT_MEMORY_MB,
+                 cpu_seconds=DEFAULT_CPU_SECONDS, watch_directory=None, reports_directory=None):
+        self.state = state
+        self.workers = workers
+        self.retries = retries
+        self.memory_mb = memory_mb
+        self.cpu_seconds = cpu_seconds
+        self.watch_directory = watch_directory
+        self.reports_directory = reports_directory or os.path.join(os.path.dirname(os.path.abspath(state.path)), "pyviz-batch-reports")
+        self.running = {}
+        self.context = multiprocessing.get_context("spawn")
+
+    # Add jobs, skipping any we already know about.
+    def add_jobs(self, jobs):
+        added = [job for job in jobs if self.state.add(job)]
+        if len(added) > 0:
+            self.state.save()
+        for job in added:
+            print("queued " + job["id"])
+
+    # Look for job files in the watched folder that we haven't seen before.
+    def scan_watch_directory(self):
+        if self.watch_directory is None:
+            return
+
+        for file_name in sorted(os.listdir(self.watch_directory)):
+            if not file_name.endswith(".json"):
+                continue
+            job_id = os.path.splitext(file_name)[0]
+            if job_id in self.state.jobs:
+                continue
+
+            # The file might still be in the middle of being written. If so, we'll try again next time.
+            try:
+                with open(os.path.join(self.watch_directory, file_name)) as job_file:
+                    spec = json.load(job_file)
+            except (OSError, json.JSONDecodeError):
+                continue
+
+            try:
+                self.add_jobs([make_job(spec, job_id, self.watch_directory)])
+            except ValueError as error:
+                print("skipping " + file_name + ": " + str(error), file=sys.stderr)
+                self.state.jobs[job_id] = {"job": None, "status": "failed", "attempts": 0, "error": str(error), "report": None}
+                self.state.save()
+
+    # Start as many waiting jobs as there is room for.
+    def start_jobs(self):
+        for job_id in self.state.pending():
+            if len(self.running) >= self.workers:
+                return
+
+            record = self.state.jobs[job_id]
+            record["status"] = "running"
+            record["attempts"] += 1
+            self.state.save()
+
+            receiver, sender = self.context.Pipe(duplex=False)
+            process = self.context.Process(target=run_job, args=(record["job"], self.memory_mb, self.cpu_seconds, sender),
+                name="pyviz-batch-" + job_id, daemon=True)
+            process.start()
+
+            # Only the job's process writes to its end of the pipe. Closing our copy of it means
+            # we notice if the process dies without saying anything.
+            sender.close()
+
+            self.running[job_id] = RunningJob(job_id, process, receiver)
+            print("started " + job_id + " (attempt " + str(record["attempts"]) + ")")
+
+    # See which running jobs have finished, one way or the other.
+    def check_jobs(self):
+        for job_id, running in list(self.running.items()):
+            if running.connection.poll():
+                try:
+                    outcome, result = running.connection.recv()
+                except EOFError:
+                    # The process died without telling us anything. It was most likely killed for going over its limits.
+                    running.process.join()
+                    outcome, result = "error", "the job's process exited with code " + str(running.process.exitcode)
+            elif not running.process.is_alive():
+                outcome, result = "error", "the job's process exited with code " + str(running.process.exitcode)
+            else:
+                continue
+
+            running.process.join()
+            running.connection.close()
+            del self.running[job_id]
+            self.finish_job(job_id, outcome, result, time.time() - running.started)
+
+    # Write down how a job went, and try it again if it failed and has attempts left.
+    def finish_job(self, job_id, outcome, result, elapsed):
+        record = self.state.jobs[job_id]
+
+        if outcome == "done":
+            record["status"] = "done"
+            record["error"] = None
+            record["report"] = {"job": job_id, "attempts": record["attempts"], "seconds": result["seconds"], "wall_seconds": elapsed,
+                "analysis_memory": result["memory"]}
+            self.write_report(job_id, record["report"])
+            print("finished " + job_id + " in " + format(elapsed, ".1f") + " s")
+        else:
+            record["error"] = result
+            if record["attempts"] <= self.retries:
+                record["status"] = "pending"
+                print("failed " + job_id + ", will try again", file=sys.stderr)
+            else:
+                record["status"] = "failed"
+                print("failed " + job_id + ", giving up:\n" + result, file=sys.stderr)
+
+        self.state.save()
+
+    # Write a job's timing report to its own file.
+    def write_report(self, job_id, report):
+        os.makedirs(self.reports_directory, exist_ok=True)
+        with open(os.path.join(self.reports_directory, job_id + ".json"), "w") as report_file:
+            json.dump(report, report_file, indent=2)
+
+    # Keep running jobs until there are none left.
+    # When watching a folder, there is always the chance of more, so keep going until we are stopped,
+    # unless `once` is true.
+    def run(self, once=False):
+        try:
+            while True:
+                self.scan_watch_directory()
+                self.start_jobs()
+                self.check_jobs()
+
+                if once and len(self.running) == 0 and len(self.state.pending()) == 0:
+                    return
+
+                time.sleep(POLL_INTERVAL)
+        finally:
+            # Jobs cut short here are marked as running in the state file, so they start over next time.
+            for running in self.running.values():
+                running.process.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render PyViz visualizations to video files, without the GUI.")
+    parser.add_argument("--jobs", action="append", default=[], help="a job file, with one JSON job per line (can be given more than once)")
+    parser.add_argument("--watch", default=None, help="a folder to watch for new .json job files")
+    parser.add_argument("--state", default=DEFAULT_STATE_FILE, help="where to save the state of every job")
+    parser.add_argument("--reports", default=None, help="where to write the timing reports (next to the state file by default)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="how many jobs to run at once")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES, help="how many more times to try a job that failed")
+    parser.add_argument("--memory-mb", type=int, default=DEFAULT_MEMORY_MB, help="how much memory each job may use")
+    parser.add_argument("--cpu-seconds", type=int, default=DEFAULT_CPU_SECONDS, help="how much CPU time each job may use")
+    parser.add_argument("--once", action="store_true", help="exit once there are no jobs left, even when watching a folder")
+    args = parser.parse_args()
+
+    if len(args.jobs) == 0 and args.watch is None:
+        parser.error("give at least one --jobs file, or a --watch folder")
+
+    state = BatchState(args.state)
+    runner = BatchRunner(state, args.workers, args.retries, args.memory_mb, args.cpu_seconds, args.watch, args.reports)
+    for path in args.jobs:
+        runner.add_jobs(read_job_file(path))
+
+    try:
+        runner.run(once=args.once or args.watch is None)
+    except KeyboardInterrupt:
+        pass
+
+    failed = [job_id for job_id, record in state.jobs.items() if record["status"] == "failed"]
+    return 1 if len(failed) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
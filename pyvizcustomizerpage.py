@@ -15,15 +15,40 @@ gi.require_version("Gtk", "4.0")
 gi.require_version("Adw", "1")
 from gi.repository import GLib, Gtk, Gdk, Adw
 
-# This is the next page in the navigation progression.
-import pyvizvispage
-import pyvizgoompage
+# Thumbnails are decoded in memory and shared between pages through this cache.
+import pyvizthumbnails
+
+# While the user customizes, the song is downloaded in the background, in its own session,
+# so we can show its waveform. See `pyvizwaveform.py`.
+import pyvizdownloader
+import pyvizscheduler
+import pyvizsession
+import pyvizwaveform
+
+# The next page in the navigation progression is either `pyvizvispage` or `pyvizgoompage`.
+# They pull in some very slow-to-load libraries, so we only import them when the user clicks "Visualize!"
+
+# The video sizes and framerates GOOM can be exported at. See `pyvizgoomexport.py`.
+from pyvizgoomexport import EXPORT_RESOLUTIONS, EXPORT_FRAMERATES
+
+# The ways the built-in visualizer can analyze the song, as (backend, what we call it in the UI).
+# The backends are the ones in `visualizerengine.ANALYSIS_BACKENDS`.
+ANALYSIS_CHOICES = [("librosa", "Before playing"), ("gstreamer", "Live, while playing")]
+
+# How the built-in visualizer's bars can look, as (style, what we call it in the UI).
+# The styles are the ones in `visualizerengine.BAR_STYLES`.
+BAR_STYLE_CHOICES = [("flat", "Flat"), ("gradient", "Gradient"), ("neon", "Neon glow")]
+
+# The port the visualizer is streamed on, if the user turns streaming on. See `pyvizstream.py`.
+from pyvizstream import DEFAULT_PORT as STREAM_PORT
 
 # Inherit from AdNavigationPage.
 class PyVizCustomizerPage(Adw.NavigationPage):
 
-    # Constructor function. We get the thumbnail path and the nav view
-    def __init__(self, thumbnail_path, navigation_view):
+    # Constructor function. We get what we know about the video (a `pyvizdownloader.VideoInfo`), the nav view,
+    # and the trace of the press of "Submit" that led here (see `pyviztelemetry.py`).
+    # If the user picked a playlist, `playlist` holds the rest of its songs, as more `VideoInfo`s.
+    def __init__(self, video, navigation_view, trace_id=None, playlist=()):
 
         # Use the parent constructor function
         super().__init__()
@@ -31,6 +56,9 @@ class PyVizCustomizerPage(Adw.NavigationPage):
         # Set the title to appear at the top of the screen.
         self.set_title("Customize the Visualizer")
 
+        self.trace_id = trace_id
+        self.playlist = list(playlist)
+
         # Explanation for how these widgets work can be found in `pyvizapp.py`
         toolbar_view = Adw.ToolbarView()
         header_bar = Adw.HeaderBar()
@@ -52,11 +80,16 @@ class PyVizCustomizerPage(Adw.NavigationPage):
         selected_video_box.set_hexpand(True)
 
         # Create an image to prominently display the video thumbnail
-        # Set it based on the thumbnail path
+        # The previous page already put it in the shared thumbnail cache, so we just look it up.
+        # If for some reason it isn't there, we show a placeholder image instead.
         # Add it to the `selected_video_box`
         thumbnail_image = Gtk.Image()
         thumbnail_image.set_size_request(352,240)
-        thumbnail_image.set_from_file(thumbnail_path)
+        thumbnail = pyvizthumbnails.thumbnail_cache.get(video.id)
+        if thumbnail is not None:
+            thumbnail_image.set_from_paintable(thumbnail)
+        else:
+            thumbnail_image.set_from_file(os.path.join("data", "imageNotFound.svg"))
         selected_video_box.append(thumbnail_image)
 
         # Now, we have a sub-box that will hold two text labels...
@@ -74,26 +107,21 @@ class PyVizCustomizerPage(Adw.NavigationPage):
         # We use a special style class for this one.
         video_title_text = Gtk.Label()
 
-        # In this super fun block of code we isolate the video title from the rest of
-        # the thumbnail path.
-        # First, we split the filename from the path
-        video_title_inprogress = os.path.split(thumbnail_path)[1]
-        # Then, we excise the file extension
-        video_title_inprogress = os.path.splitext(video_title_inprogress)[0]
-        # Then, we tokenize the string, and remove the last token.
-        # (The URL would be the last token)
-        video_title_inprogress = video_title_inprogress.split()[0:len(video_title_inprogress.split())-1]
-        # Then we re-unite the tokens into a string containing just the video title.
-        video_title = ""
-        for word in video_title_inprogress:
-            video_title = video_title + word + " "
-        video_title_text.set_label(video_title)
+        video_title_text.set_label(video.title)
         video_title_text.set_halign(Gtk.Align.START)
         video_title_text.set_justify(Gtk.Justification.LEFT)
         video_title_text.set_hexpand(True)
         video_title_text.set_wrap(True)
         video_title_text.add_css_class("title-1")
         selected_video_text_box.append(video_title_text)
+
+        # For a playlist, a third label says how many more songs follow the first one.
+        # Only our visualizer plays the whole playlist. GOOM sticks to the first song.
+        if len(self.playlist) > 0:
+            playlist_text = Gtk.Label()
+            playlist_text.set_halign(Gtk.Align.START)
+            playlist_text.set_label("...and " + str(len(self.playlist)) + " more songs from the playlist.")
+            selected_video_text_box.append(playlist_text)
     
         # Append the box with both labels to the selected video box
         selected_video_box.append(selected_video_text_box)
@@ -101,6 +129,13 @@ class PyVizCustomizerPage(Adw.NavigationPage):
         # Append the completed selected_video_box to the mainbox
         mainbox.append(selected_video_box)
 
+        # The song's waveform goes under the thumbnail and title. It shows up once the song is downloaded.
+        self.waveform = pyvizwaveform.PyVizWaveform(64)
+        self.waveform.set_margin_start(16)
+        self.waveform.set_margin_end(16)
+        self.waveform.set_visible(False)
+        mainbox.append(self.waveform)
+
         # We will soon have a box to hold visualizer settings.
         # This element strictly restricts it to a certain size
         settingsbox_clamp = Adw.Clamp()
@@ -128,13 +163,6 @@ class PyVizCustomizerPage(Adw.NavigationPage):
         # "views" to switch between.
         visualizer_options_stack = Adw.ViewStack()
 
-        # Retrieve the URL from the thumbnail, 
-        # by taking the last token of the extensionless, pathless, file name
-        url = os.path.split(thumbnail_path)[1]
-        url = os.path.splitext(url)[0]
-        url = url.split()
-        url = url[len(url)-1]
-
         # The views can be any widget, but in this case,
         # we present a box with settings for the selected visualizer
         # Here is the pyviz settings page.
@@ -192,6 +220,68 @@ class PyVizCustomizerPage(Adw.NavigationPage):
         pyviz_settings_color_disclaimer.add_css_class("caption")
         pyviz_settings_page.append(pyviz_settings_color_disclaimer)
 
+        # The visualizer can either be shown right inside the PyViz window, or pop out in its own window.
+        # This switch lets the user pick.
+        embed_selection_box = Gtk.Box(orientation = Gtk.Orientation.HORIZONTAL, spacing=16)
+        embed_selection_box.set_halign(Gtk.Align.CENTER)
+
+        embed_selection_label = Gtk.Label()
+        embed_selection_label.set_label("Show inside the PyViz window:")
+        embed_selection_box.append(embed_selection_label)
+
+        embed_selection_switch = Gtk.Switch()
+        embed_selection_switch.set_active(True)
+        embed_selection_switch.set_valign(Gtk.Align.CENTER)
+        embed_selection_box.append(embed_selection_switch)
+
+        pyviz_settings_page.append(embed_selection_box)
+
+        # The song can either be analyzed all at once before it starts, or live as it plays.
+        analysis_selection_box = Gtk.Box(orientation = Gtk.Orientation.HORIZONTAL, spacing=16)
+        analysis_selection_box.set_halign(Gtk.Align.CENTER)
+
+        analysis_selection_label = Gtk.Label()
+        analysis_selection_label.set_label("Analyze the song:")
+        analysis_selection_box.append(analysis_selection_label)
+
+        analysis_selection_dropdown = Gtk.DropDown.new_from_strings([label for (backend, label) in ANALYSIS_CHOICES])
+        analysis_selection_box.append(analysis_selection_dropdown)
+
+        pyviz_settings_page.append(analysis_selection_box)
+
+        # The bars can be plain, or fancier.
+        bar_style_selection_box = Gtk.Box(orientation = Gtk.Orientation.HORIZONTAL, spacing=16)
+        bar_style_selection_box.set_halign(Gtk.Align.CENTER)
+
+        bar_style_selection_label = Gtk.Label()
+        bar_style_selection_label.set_label("Bar style:")
+        bar_style_selection_box.append(bar_style_selection_label)
+
+        bar_style_selection_dropdown = Gtk.DropDown.new_from_strings([label for (style, label) in BAR_STYLE_CHOICES])
+        bar_style_selection_box.append(bar_style_selection_dropdown)
+
+        pyviz_settings_page.append(bar_style_selection_box)
+
+        # The visualizer can also be shared with other screens, through a little web server.
+        stream_selection_box = Gtk.Box(orientation = Gtk.Orientation.HORIZONTAL, spacing=16)
+        stream_selection_box.set_halign(Gtk.Align.CENTER)
+
+        stream_selection_label = Gtk.Label()
+        stream_selection_label.set_label("Stream to other screens:")
+        stream_selection_box.append(stream_selection_label)
+
+        stream_selection_switch = Gtk.Switch()
+        stream_selection_switch.set_valign(Gtk.Align.CENTER)
+        stream_selection_box.append(stream_selection_switch)
+
+        pyviz_settings_page.append(stream_selection_box)
+
+        stream_disclaimer = Gtk.Label()
+        stream_disclaimer.set_label("Open http://localhost:" + str(STREAM_PORT) + "/ in a web browser to watch.")
+        stream_disclaimer.set_justify(Gtk.Justification.CENTER)
+        stream_disclaimer.add_css_class("caption")
+        pyviz_settings_page.append(stream_disclaimer)
+
         vis_visualize_button = Gtk.Button()
         vis_visualize_button.set_margin_start(64)
         vis_visualize_button.set_margin_end(64)
@@ -202,8 +292,9 @@ class PyVizCustomizerPage(Adw.NavigationPage):
         vis_visualize_button.add_css_class("suggested-action")
 
         # When the goom visualize button is clicked, we add a new page to the navigation.
-        # We pass the url and the nav view to the new page.
-        vis_visualize_button.connect("clicked", self._vis_clicked, url, navigation_view, bg_color_selection_button, fg_color_selection_button)
+        # We pass the video and the nav view to the new page.
+        # The new page gets everything we know about the video, so its download can skip looking it up again.
+        vis_visualize_button.connect("clicked", self._vis_clicked, video, navigation_view, bg_color_selection_button, fg_color_selection_button, embed_selection_switch, analysis_selection_dropdown, stream_selection_switch, bar_style_selection_dropdown)
 
         # Add the button to the page.
         pyviz_settings_page.append(vis_visualize_button)
@@ -233,12 +324,58 @@ class PyVizCustomizerPage(Adw.NavigationPage):
         goom_visualize_button.add_css_class("suggested-action")
 
         # When the goom visualize button is clicked, we add a new page to the navigation.
-        # We pass the url and the nav view to the new page.
-        goom_visualize_button.connect("clicked", self._goom_clicked, url, navigation_view)
+        # We pass the video and the nav view to the new page.
+        goom_visualize_button.connect("clicked", self._goom_clicked, video, navigation_view)
 
         # Add the button to the page.
         goom_settings_page.append(goom_visualize_button)
 
+        # GOOM can also be rendered straight to a video file, much faster than playing it.
+        goom_export_label = Gtk.Label()
+        goom_export_label.set_label("Save to a Video File:")
+        goom_export_label.add_css_class("title-2")
+        goom_settings_page.append(goom_export_label)
+
+        # The size of the video.
+        goom_resolution_box = Gtk.Box(orientation = Gtk.Orientation.HORIZONTAL, spacing=16)
+        goom_resolution_box.set_halign(Gtk.Align.CENTER)
+
+        goom_resolution_label = Gtk.Label()
+        goom_resolution_label.set_label("Resolution:")
+        goom_resolution_box.append(goom_resolution_label)
+
+        goom_resolution_dropdown = Gtk.DropDown.new_from_strings([str(width) + " x " + str(height) for (width, height) in EXPORT_RESOLUTIONS])
+        goom_resolution_dropdown.set_selected(1)
+        goom_resolution_box.append(goom_resolution_dropdown)
+
+        goom_settings_page.append(goom_resolution_box)
+
+        # The framerate of the video.
+        goom_framerate_box = Gtk.Box(orientation = Gtk.Orientation.HORIZONTAL, spacing=16)
+        goom_framerate_box.set_halign(Gtk.Align.CENTER)
+
+        goom_framerate_label = Gtk.Label()
+        goom_framerate_label.set_label("Framerate:")
+        goom_framerate_box.append(goom_framerate_label)
+
+        goom_framerate_dropdown = Gtk.DropDown.new_from_strings([str(framerate) + " fps" for framerate in EXPORT_FRAMERATES])
+        goom_framerate_dropdown.set_selected(1)
+        goom_framerate_box.append(goom_framerate_dropdown)
+
+        goom_settings_page.append(goom_framerate_box)
+
+        goom_export_button = Gtk.Button()
+        goom_export_button.set_margin_start(64)
+        goom_export_button.set_margin_end(64)
+        goom_export_button.set_margin_bottom(16)
+        goom_export_button.set_label("Export...")
+        goom_export_button.add_css_class("pill")
+
+        # When the export button is clicked, we first ask the user where to save the video.
+        goom_export_button.connect("clicked", self._goom_export_clicked, video, navigation_view, goom_resolution_dropdown, goom_framerate_dropdown)
+
+        goom_settings_page.append(goom_export_button)
+
         # Add the page to the stack
         visualizer_options_stack.add_titled_with_icon (goom_settings_page, "goom-settings-page", "GOOM", "folder-music-symbolic")
 
@@ -263,14 +400,80 @@ class PyVizCustomizerPage(Adw.NavigationPage):
         # Set the toolbarview as the child of this navigation view
         self.set_child(toolbar_view)
 
+        # Download the song while the user is busy picking colors, and summarize it for the waveform.
+        # Nobody is waiting on this, so it has the lowest priority. The download lands in the shared
+        # download cache, so when the user clicks "Visualize!", the song is already there.
+        # The session ends when the user goes back to the previous page.
+        self.session = pyvizsession.PyVizSession(trace_id)
+        self.session.submit("download", self.prefetch, video,
+            priority=pyvizscheduler.PRIORITY_PREFETCH,
+            on_done=self._prefetched)
+        self.popped_handler = navigation_view.connect("popped", self._popped)
+
+    # Download the song. It is run in the background by the scheduler.
+    def prefetch(self, job, video):
+        with self.session.span("prefetch_download"):
+            return pyvizdownloader.downloader.download_audio(video.url, self.session.folder(), "audio", info=video)
+
+    # The song is downloaded, and we're back on the GUI's main loop.
+    # Building the envelope is quick, but it is still background work, so it goes on the low-priority "prepare" worker.
+    def _prefetched(self, path):
+        self.session.submit("prepare", self.build_envelope, path,
+            priority=pyvizscheduler.PRIORITY_PREFETCH,
+            on_done=self._envelope_ready)
+
+    # Summarize the song into an envelope pyramid. It is run in the background by the scheduler.
+    def build_envelope(self, job, path):
+        import pyvizenvelope
+        with self.session.span("envelope"):
+            return pyvizenvelope.build_envelope(path, job.check)
+
+    # Show the waveform.
+    def _envelope_ready(self, envelope):
+        self.waveform.set_envelope(envelope)
+        self.waveform.set_visible(True)
+
+    # When this page is taken off the navigation view, stop downloading and end the session.
+    def _popped(self, navigation_view, page):
+        if page is self:
+            navigation_view.disconnect(self.popped_handler)
+            self.session.close()
+
     # When the "visualize" button on the pyviz page is clicked, we come down here
-    def _vis_clicked(self, button, url, navigation_view, bg_color, fg_color):
+    def _vis_clicked(self, button, video, navigation_view, bg_color, fg_color, embed_switch, analysis_dropdown, stream_switch, bar_style_dropdown):
+        import pyvizvispage
+
+        backend = ANALYSIS_CHOICES[analysis_dropdown.get_selected()][0]
+        bar_style = BAR_STYLE_CHOICES[bar_style_dropdown.get_selected()][0]
+
         # This nav page handles all the logic of making PyViz happen
-        navigation_view.push(pyvizvispage.PyVizVisPage(url, navigation_view, fg_color.get_rgba(), bg_color.get_rgba(),))
+        navigation_view.push(pyvizvispage.PyVizVisPage(video, navigation_view, fg_color.get_rgba(), bg_color.get_rgba(), embed_switch.get_active(), backend, stream_switch.get_active(), self.trace_id, self.playlist, bar_style))
 
     # When the "visualize" button on the goom page is clicked, we come down here
-    def _goom_clicked(self, button, url, navigation_view):
-        # This nav page handles all the logic of making GOOM happen
-        navigation_view.push(pyvizgoompage.PyVizGoomPage(url, navigation_view))
+    def _goom_clicked(self, button, video, navigation_view):
+        import pyvizgoompage
 
-        
\ No newline at end of file
+        # This nav page handles all the logic of making GOOM happen
+        navigation_view.push(pyvizgoompage.PyVizGoomPage(video, navigation_view, trace_id=self.trace_id))
+
+    # When the "export" button on the goom page is clicked, we come down here.
+    # Ask the user where to save the video. This returns right away, and `_goom_export_chosen` is called later.
+    def _goom_export_clicked(self, button, video, navigation_view, resolution_dropdown, framerate_dropdown):
+        file_dialog = Gtk.FileDialog()
+        file_dialog.set_title("Export GOOM Video")
+        file_dialog.set_initial_name(video.title + ".mkv")
+        file_dialog.save(self.get_root(), None, self._goom_export_chosen, video, navigation_view,
+            EXPORT_RESOLUTIONS[resolution_dropdown.get_selected()], EXPORT_FRAMERATES[framerate_dropdown.get_selected()])
+
+    # The user picked a file (or cancelled).
+    def _goom_export_chosen(self, file_dialog, result, video, navigation_view, export_size, export_framerate):
+        try:
+            file = file_dialog.save_finish(result)
+        except GLib.Error:
+            # The user cancelled. That's fine.
+            return
+
+        import pyvizgoompage
+
+        # The GOOM page renders the video instead of playing it when it is given a file to save to.
+        navigation_view.push(pyvizgoompage.PyVizGoomPage(video, navigation_view, file.get_path(), export_size, export_framerate, self.trace_id))
@@ -0,0 +1,460 @@
+# PyViz, a Python music visualizer.
+# Program by Austin Pringle, Caleb Rachocki, & Caleb Ruby
+# Pennsylvania Western University, California
+#
+# pyvizdownloader.py
+# This file contains the shared YouTube downloader service.
+# Instead of every page building its own `YoutubeDL` object (and paying for extractor setup and
+# brand new HTTPS connections every time), the whole program borrows long-lived ones from here.
+
+# `os` is used to access files in a system-independent way.
+import os
+
+# Finished downloads are copied out of the download cache with `shutil`,
+# and cache folders are named with a hash of what was downloaded.
+import shutil
+import hashlib
+
+# The pools are shared between threads, so we need a thread-safe queue and a lock.
+import queue
+import threading
+
+# For the bandwidth limit, and for spacing out progress updates.
+import time
+
+# Lets us write `with downloader.metadata_session() as ydl:`
+from contextlib import contextmanager
+
+# Hey it's the YouTube downloader again! See `pyvizapp.py` for more information.
+from yt_dlp import YoutubeDL, DownloadError
+
+# Downloads are run as scheduler jobs, and we need to stop them when their job is cancelled.
+import pyvizscheduler
+
+
+# yt-dlp calls this over and over while it downloads.
+# If the download is running as part of a job that has since been cancelled,
+# this raises `JobCancelled`, which stops the download right where it is.
+def _check_cancelled(*args):
+    job = pyvizscheduler.current_job()
+    if job is not None:
+        job.check()
+
+
+# These options are baked into every metadata session when it is created.
+# Remember, for metadata we never want the video itself.
+METADATA_OPTIONS = {
+    'skip_download' : 'true',
+}
+
+# These options are baked into every audio session when it is created.
+# yt-dlp decides how to pick formats and which postprocessors to run when the object is created,
+# so audio downloads need their own sessions.
+AUDIO_OPTIONS = {
+    # Ask youtube to output a high-quality .wav file
+    'format': 'wav/bestaudio/best',
+
+    # Videos that come in pieces ("fragments") download several pieces at once.
+    'concurrent_fragment_downloads': 4,
+
+    # Pick up a half-finished download where it left off, instead of starting over.
+    # Flaky connections get retried plenty of times before we give up.
+    'continuedl': True,
+    'retries': 10,
+    'fragment_retries': 10,
+
+    # Sometimes YouTube fails to properly give us the file we asked for.
+    # Just to be safe, we attempt to convert the output to .wav
+    'postprocessors': [{  # Extract audio using ffmpeg
+        'key': 'FFmpegExtractAudio',
+        'preferredcodec': 'wav',
+    }],
+
+    # Check for cancellation while the download is in progress, and while ffmpeg is converting it.
+    'progress_hooks': [_check_cancelled],
+    'postprocessor_hooks': [_check_cancelled],
+}
+
+# Used to tell "this option was never set" apart from "this option was set to None".
+_UNSET = object()
+
+# Downloads are kept here, one folder per song, so a download that was cut short can be picked up again later,
+# and a song that was already downloaded doesn't need downloading again.
+# The `PYVIZ_DOWNLOAD_CACHE` environment variable puts it somewhere else.
+DOWNLOAD_CACHE_DIRECTORY = os.environ.get("PYVIZ_DOWNLOAD_CACHE") or os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "pyviz", "downloads")
+
+# Once the download cache holds more than this many bytes, the songs that were used longest ago are thrown out.
+DOWNLOAD_CACHE_LIMIT = 2 * 1024 * 1024 * 1024
+
+# How many audio downloads may run at once, across the whole program.
+MAX_DOWNLOADS = 2
+
+# The most bytes per second all downloads together may use, or `None` for no limit.
+# The `PYVIZ_BANDWIDTH_LIMIT` environment variable sets it, in kilobytes per second.
+BANDWIDTH_LIMIT = int(os.environ["PYVIZ_BANDWIDTH_LIMIT"]) * 1024 if os.environ.get("PYVIZ_BANDWIDTH_LIMIT") else None
+
+# Progress is reported to the page at most this often, in seconds.
+PROGRESS_INTERVAL = 0.25
+
+# How often, in seconds, a download waiting on another download of the same song checks whether it has been cancelled.
+LOCK_POLL_INTERVAL = 0.1
+
+# Inside a song's cache folder, the song is downloaded (and converted) under this name,
+# and only renamed to `CACHED_NAME` once all of that has worked out.
+# So if `CACHED_NAME` is there, it's a whole song, never one that was cut short.
+DOWNLOAD_NAME = "download"
+CACHED_NAME = "audio.wav"
+
+
+# Keeps all downloads together under one bandwidth limit.
+# Every download tells it how many bytes it just got, and it makes the download wait if we are going too fast.
+# (It is a "token bucket": the bucket refills at the limit, and a download takes bytes out of it.
+# If there aren't enough, the download sleeps until there are.)
+class BandwidthLimiter:
+
+    # Constructor function
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.available = float(bytes_per_second)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, count):
+        with self.lock:
+            now = time.monotonic()
+            self.available = min(self.bytes_per_second, self.available + (now - self.updated) * self.bytes_per_second)
+            self.updated = now
+            self.available -= count
+            wait = -self.available / self.bytes_per_second if self.available < 0 else 0
+
+        if wait > 0:
+            time.sleep(wait)
+
+
+# Keeps track of one download's progress, and passes it on to whoever is interested, but not too often.
+class DownloadProgress:
+
+    # Constructor function
+    # `on_progress` is called with (fraction done, bytes so far, total bytes), from the download's thread.
+    # The fraction and total are `None` while we don't know how big the file is.
+    def __init__(self, on_progress=None, limiter=None):
+        self.on_progress = on_progress
+        self.limiter = limiter
+        self.downloaded = {}
+        self.last_report = 0.0
+
+        # When pieces download at once, yt-dlp may call us from several threads.
+        self.lock = threading.Lock()
+
+    # yt-dlp calls this over and over while it downloads.
+    def update(self, status):
+        # yt-dlp reports the total so far for each file, so work out how much is new since last time.
+        file_name = status.get("tmpfilename") or status.get("filename")
+        downloaded = status.get("downloaded_bytes") or 0
+        with self.lock:
+            new_bytes = downloaded - self.downloaded.get(file_name, downloaded)
+            self.downloaded[file_name] = downloaded
+
+        if self.limiter is not None and new_bytes > 0:
+            self.limiter.consume(new_bytes)
+
+        if self.on_progress is None:
+            return
+        now = time.monotonic()
+        with self.lock:
+            if status.get("status") != "finished" and now - self.last_report < PROGRESS_INTERVAL:
+                return
+            self.last_report = now
+
+        total = status.get("total_bytes") or status.get("total_bytes_estimate")
+        fraction = min(1.0, downloaded / total) if total else None
+        self.on_progress(fraction, downloaded, total)
+
+
+# yt-dlp calls this for every audio session, over and over while it downloads.
+# It hands the news to whichever download is using that session right now.
+def _report_progress(ydl, status):
+    progress = getattr(ydl, "pyviz_progress", None)
+    if progress is not None:
+        progress.update(status)
+
+
+# How much space the files in a folder take up.
+# A download running in there can rename or remove its files while we look, so any that are gone don't count.
+def _folder_size(path):
+    size = 0
+    for entry in os.scandir(path):
+        try:
+            if entry.is_file():
+                size += entry.stat().st_size
+        except FileNotFoundError:
+            pass
+    return size
+
+
+# A small pool of `YoutubeDL` objects that all share the same base options.
+# Each object keeps its own HTTP connections open between requests,
+# so handing the same objects out over and over means we keep reusing those connections.
+class SessionPool:
+
+    # Constructor function
+    # `on_create`, if given, is called with every new session, to finish setting it up.
+    def __init__(self, options, size, on_create=None):
+        self.options = options
+        self.size = size
+        self.on_create = on_create
+
+        # Sessions that nobody is using right now.
+        # It is last-in-first-out, so the most recently used session (the one most likely to
+        # still have a live connection) is handed out first.
+        self.idle = queue.LifoQueue()
+
+        # Every session we have ever created, so we can close them all at the end.
+        self.sessions = []
+        self.lock = threading.Lock()
+
+    # Get a session, creating one if we are still allowed to.
+    # If every session is busy and we can't create any more, wait for one to come back.
+    def _checkout(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            if len(self.sessions) < self.size:
+                ydl = YoutubeDL(dict(self.options))
+                if self.on_create is not None:
+                    self.on_create(ydl)
+                self.sessions.append(ydl)
+                return ydl
+
+        return self.idle.get()
+
+    # Borrow a session for the duration of a `with` block.
+    # Any keyword arguments are extra yt-dlp options that only apply to this one use.
+    # They are put back the way they were before the session goes back into the pool.
+    @contextmanager
+    def session(self, **overrides):
+        ydl = self._checkout()
+        saved = {key: ydl.params.get(key, _UNSET) for key in overrides}
+        ydl.params.update(overrides)
+        try:
+            yield ydl
+        finally:
+            for key, value in saved.items():
+                if value is _UNSET:
+                    ydl.params.pop(key, None)
+                else:
+                    ydl.params[key] = value
+            self.idle.put(ydl)
+
+    # Close every session, which also closes their network connections.
+    def close(self):
+        with self.lock:
+            for ydl in self.sessions:
+                ydl.close()
+            self.sessions = []
+            self.idle = queue.LifoQueue()
+
+
+# What we know about one video: its ID, title, length, and where to find it.
+# `info` is yt-dlp's info dictionary for it. When the video was probed (see `get_data` in `pyvizapp.py`),
+# that includes every format YouTube offers, so the download can go straight to the audio,
+# without asking YouTube about the video all over again.
+# Search results and playlist songs only come with the basics. Their downloads look the rest up themselves.
+class VideoInfo:
+    def __init__(self, info):
+        self.info = info
+        self.id = info["id"]
+        self.title = info.get("title") or self.id
+        self.duration = info.get("duration")
+        self.url = info.get("webpage_url") or info.get("url") or self.id
+
+    # Whether we know the video's formats, so the download doesn't have to look them up.
+    def has_formats(self):
+        return len(self.info.get("formats") or []) > 0
+
+
+# The downloader service. It has one pool for metadata (probes, searches and thumbnails),
+# and one pool for audio downloads.
+class DownloaderService:
+
+    # Constructor function
+    # There is one audio session per download that may run at once, so `audio_sessions` is also the limit
+    # on how many downloads run at once. Any more wait their turn for a session.
+    def __init__(self, metadata_sessions=3, audio_sessions=MAX_DOWNLOADS, bandwidth_limit=BANDWIDTH_LIMIT, cache_directory=DOWNLOAD_CACHE_DIRECTORY):
+        self.metadata = SessionPool(METADATA_OPTIONS, metadata_sessions)
+        self.audio = SessionPool(AUDIO_OPTIONS, audio_sessions, on_create=self._setup_audio_session)
+        self.limiter = BandwidthLimiter(bandwidth_limit) if bandwidth_limit else None
+        self.cache_directory = cache_directory
+
+        # Only one download of the same song at a time. The second one just waits, and then uses the first one's file.
+        # Each song's cache folder maps to its lock, and how many are holding or waiting on it. See `_song_lock`.
+        self.song_locks = {}
+        self.song_locks_lock = threading.Lock()
+
+    # Every audio session reports its progress through `_report_progress`.
+    def _setup_audio_session(self, ydl):
+        ydl.pyviz_progress = None
+        ydl.add_progress_hook(lambda status: _report_progress(ydl, status))
+
+    # Borrow a metadata session. Use this when you need to do more than one thing with it,
+    # like extracting a video's info and then fetching its thumbnail.
+    def metadata_session(self, **overrides):
+        return self.metadata.session(**overrides)
+
+    # Get the info dictionary of a video (or a search) without downloading anything.
+    def extract_info(self, url, **overrides):
+        with self.metadata.session(**overrides) as ydl:
+            return ydl.extract_info(url, download=False)
+
+    # Download the audio of a video as a .wav file.
+    # `directory` is where it goes, and `name` is the file name, without the extension.
+    # `on_progress`, if given, is called now and then with the download's progress. See `DownloadProgress`.
+    # `info`, if given, is the song's `VideoInfo`. If it knows the formats, they are used instead of looking the song up again.
+    #
+    # The song is actually downloaded into the download cache, and copied over once it is finished.
+    # If the download is interrupted, the partial download (yt-dlp's ".part" file) stays in the cache,
+    # and the next try picks it up from there. A song only counts as downloaded once it has been converted, too.
+    def download_audio(self, url, directory, name, on_progress=None, info=None):
+        song_directory = os.path.join(self.cache_directory, self._cache_key(url, info))
+        cached_path = os.path.join(song_directory, CACHED_NAME)
+
+        self._acquire_song_lock(song_directory)
+        try:
+            if not os.path.exists(cached_path):
+                self._download_to_cache(url, song_directory, on_progress, info)
+
+            # Mark the song as just used, so it is the last to be thrown out of the cache.
+            os.utime(song_directory)
+
+            # A hard link costs nothing, but only works on the same drive. Otherwise, we copy.
+            path = os.path.join(directory, name + ".wav")
+            try:
+                os.link(cached_path, path)
+            except OSError:
+                shutil.copyfile(cached_path, path)
+        finally:
+            self._release_song_lock(song_directory)
+
+        self._trim_cache()
+        return path
+
+    # The name of a song's cache folder.
+    # When we know the video's ID, that's what it's named after, so the same video reached through a different link
+    # (a "youtu.be" one, say, or one with a playlist or a start time tacked on) is still found in the cache.
+    def _cache_key(self, url, info):
+        if info is not None:
+            extractor = info.info.get("extractor_key") or info.info.get("ie_key") or ""
+            key = extractor + ":" + info.id
+        else:
+            key = url
+        return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+    # Download and convert a song into its cache folder. See `DOWNLOAD_NAME`.
+    def _download_to_cache(self, url, song_directory, on_progress, info):
+        os.makedirs(song_directory, exist_ok=True)
+        downloaded_path = os.path.join(song_directory, DOWNLOAD_NAME + ".wav")
+        overrides = {
+            'paths': {'home' : song_directory},
+            'outtmpl' : {'default' : DOWNLOAD_NAME},
+        }
+        with self.audio.session(**overrides) as ydl:
+            ydl.pyviz_progress = DownloadProgress(on_progress, self.limiter)
+            try:
+                if info is not None and info.has_formats():
+                    self._download_from_info(ydl, url, info)
+                else:
+                    ydl.download([url])
+                os.replace(downloaded_path, os.path.join(song_directory, CACHED_NAME))
+            except BaseException:
+                # If the conversion was cut short, its half-written file must not be mistaken for a whole one next time.
+                # The ".part" file of the download itself is kept, so the next try can pick up from there.
+                try:
+                    os.remove(downloaded_path)
+                except OSError:
+                    pass
+                raise
+            finally:
+                ydl.pyviz_progress = None
+
+    # Download a song from the info we already have about it, the same way yt-dlp's own "--load-info-json" does.
+    # The choices the metadata session made (which formats it would have wanted) are cleaned out first,
+    # so the audio session picks the audio format it wants.
+    def _download_from_info(self, ydl, url, info):
+        try:
+            ydl.process_ie_result(YoutubeDL.sanitize_info(info.info, remove_private_keys=True), download=True)
+        except DownloadError:
+            # The format links YouTube hands out stop working after a few hours.
+            # If the info is that old, there's nothing for it but to look the song up again.
+            _check_cancelled()
+            ydl.download([url])
+
+    # Get the lock for one song's cache folder. Everyone who gets it must hand it back with `_release_song_lock`,
+    # whether they managed to lock it or not. Once nobody needs it anymore, it is forgotten,
+    # so `song_locks` doesn't keep a lock for every song ever downloaded.
+    def _song_lock(self, song_directory):
+        with self.song_locks_lock:
+            entry = self.song_locks.setdefault(song_directory, [threading.Lock(), 0])
+            entry[1] += 1
+            return entry[0]
+
+    # Hand back the lock for one song's cache folder, unlocking it first if `locked`.
+    def _release_song_lock(self, song_directory, locked=True):
+        with self.song_locks_lock:
+            entry = self.song_locks[song_directory]
+            if locked:
+                entry[0].release()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.song_locks[song_directory]
+
+    # Wait for the lock for one song's cache folder. Release it with `_release_song_lock` when you are done.
+    # Waiting on another download of the same song can take a while, so if our job is cancelled in the meantime,
+    # this stops waiting, and raises `JobCancelled`.
+    def _acquire_song_lock(self, song_directory):
+        lock = self._song_lock(song_directory)
+        try:
+            while not lock.acquire(timeout=LOCK_POLL_INTERVAL):
+                _check_cancelled()
+        except BaseException:
+            self._release_song_lock(song_directory, locked=False)
+            raise
+
+    # Throw out the songs that were used longest ago, until the cache fits under its limit.
+    # Songs that are being downloaded right now are left alone.
+    # Other downloads can throw songs out too, at the same time, so any that are already gone are skipped.
+    def _trim_cache(self):
+        songs = []
+        total = 0
+        for entry in os.scandir(self.cache_directory):
+            try:
+                if not entry.is_dir():
+                    continue
+                size = _folder_size(entry.path)
+                songs.append((entry.stat().st_mtime, entry.path, size))
+            except FileNotFoundError:
+                continue
+            total += size
+
+        for modified, path, size in sorted(songs):
+            if total <= DOWNLOAD_CACHE_LIMIT:
+                return
+            locked = self._song_lock(path).acquire(blocking=False)
+            try:
+                if locked:
+                    shutil.rmtree(path, ignore_errors=True)
+                    total -= size
+            finally:
+                self._release_song_lock(path, locked)
+
+    # Close all of the sessions. Called when the application shuts down.
+    def close(self):
+        self.metadata.close()
+        self.audio.close()
+
+
+# The one downloader service that every page shares.
+downloader = DownloaderService()
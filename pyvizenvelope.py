@@ -0,0 +1,193 @@
+# PyViz, a Python music visualizer.
+# Program by Austin Pringle, Caleb Rachocki, & Caleb Ruby
+# Pennsylvania Western University, California
+#
+# pyvizenvelope.py
+# This file contains the envelope pyramid: a cheap summary of how loud a song is over time,
+# for drawing its waveform (see `pyvizwaveform.py`).
+#
+# The song is cut into blocks of `BASE_BLOCK` samples, and for each block we keep just three numbers:
+# the lowest sample, the highest sample, and the RMS (the "loudness").
+# That's the bottom level of the pyramid. Each level above it joins pairs of blocks from the level below,
+# so it has half as many blocks, each covering twice as much of the song.
+#
+# To draw the waveform at any width, we pick the level whose blocks are about one pixel wide,
+# and combine just the few blocks under each pixel. However long the song is, that's only as much work
+# as there are pixels to draw.
+#
+# The pyramid is built in one pass over the .wav file, a piece at a time, so even an hour-long song
+# takes about a second and never has to be loaded into memory all at once.
+# Everything is stored as 16-bit floats: the whole pyramid for an hour of audio is about 2MB.
+
+# `numpy` does all of the number crunching.
+import numpy as np
+
+# For reading .wav files.
+import wave
+
+# How many samples (per channel) go into each block of the bottom level.
+# At 44100Hz, that's about 23 milliseconds of song, which is plenty for a waveform.
+BASE_BLOCK = 1024
+
+# How many blocks are read from the file at once.
+READ_BLOCKS = 256
+
+
+# Joins blocks into a pyramid, as they come in.
+class EnvelopeBuilder:
+    def __init__(self, sample_rate):
+        self.sample_rate = sample_rate
+        self.frames = 0
+        self.mins, self.maxs, self.mean_squares = [], [], []
+
+    # Add some blocks. `blocks` is a 2D array of samples, scaled from -1 to 1, with one block per row.
+    def add_blocks(self, blocks, frames):
+        self.frames += frames
+        self.mins.append(blocks.min(axis=1))
+        self.maxs.append(blocks.max(axis=1))
+        self.mean_squares.append(np.einsum("ij,ij->i", blocks, blocks) / blocks.shape[1])
+
+    # Build the pyramid out of everything that was added.
+    def finish(self):
+        level = [np.concatenate(values).astype(np.float32) if len(values) > 0 else np.zeros(1, np.float32)
+            for values in (self.mins, self.maxs, self.mean_squares)]
+        levels = [level]
+        while len(level[0]) > 1:
+            # If there is an odd block out at the end, it carries on up by itself.
+            count = len(level[0]) // 2 * 2
+            mins, maxs, mean_squares = level
+            level = [
+                np.minimum(mins[0:count:2], mins[1:count:2]),
+                np.maximum(maxs[0:count:2], maxs[1:count:2]),
+                (mean_squares[0:count:2] + mean_squares[1:count:2]) / 2,
+            ]
+            if count < len(mins):
+                level = [np.append(level[0], mins[-1]), np.append(level[1], maxs[-1]), np.append(level[2], mean_squares[-1])]
+            levels.append(level)
+
+        # The levels are joined using the mean squares, but store the RMS. It keeps better in 16 bits.
+        return Envelope(self.sample_rate, self.frames,
+            [[mins.astype(np.float16), maxs.astype(np.float16), np.sqrt(mean_squares).astype(np.float16)] for mins, maxs, mean_squares in levels])
+
+
+# The envelope pyramid of one song.
+class Envelope:
+    def __init__(self, sample_rate, frames, levels):
+        self.sample_rate = sample_rate
+        self.frames = frames
+
+        # Each level is [lowest samples, highest samples, RMS], bottom level first.
+        self.levels = levels
+
+        # How long the song is, in seconds.
+        self.duration = frames / sample_rate
+
+    # How much memory the pyramid takes up, in bytes.
+    def size(self):
+        return sum(values.nbytes for level in self.levels for values in level)
+
+    # Save the pyramid to a file, so another process can load it with `load_envelope`.
+    def save(self, path):
+        arrays = {}
+        for index, (mins, maxs, rms) in enumerate(self.levels):
+            arrays["mins" + str(index)] = mins
+            arrays["maxs" + str(index)] = maxs
+            arrays["rms" + str(index)] = rms
+        np.savez(path, sample_rate=self.sample_rate, frames=self.frames, **arrays)
+
+    # Summarize the song from `start` to `end` (in seconds) in `pixels` columns.
+    # Returns three arrays with one number per column: the lowest sample, the highest sample, and the RMS.
+    def query(self, start, end, pixels):
+        pixels = max(1, int(pixels))
+        empty = np.zeros(pixels, np.float32)
+        if end <= start or self.frames == 0:
+            return empty, empty, empty
+
+        # Go up the pyramid while the blocks still fit inside one pixel.
+        samples_per_pixel = (end - start) * self.sample_rate / pixels
+        level_index, block = 0, BASE_BLOCK
+        while level_index + 1 < len(self.levels) and block * 2 <= samples_per_pixel:
+            level_index += 1
+            block *= 2
+        mins, maxs, rms = self.levels[level_index]
+
+        first = max(0, int(start * self.sample_rate / block))
+        last = min(len(mins), int(np.ceil(end * self.sample_rate / block)))
+        if last <= first:
+            return empty, empty, empty
+
+        # Where each pixel's blocks start. When zoomed in past the bottom level,
+        # several pixels start on the same block, and they all just show that block.
+        edges = np.linspace(0, last - first, pixels + 1).astype(np.int64)
+        starts = np.minimum(edges[:-1], last - first - 1)
+        counts = np.maximum(edges[1:] - edges[:-1], 1)
+
+        low = np.minimum.reduceat(mins[first:last], starts).astype(np.float32)
+        high = np.maximum.reduceat(maxs[first:last], starts).astype(np.float32)
+        squares = np.square(rms[first:last].astype(np.float32))
+        return low, high, np.sqrt(np.add.reduceat(squares, starts) / counts)
+
+
+# Read the samples of a .wav file's frames as numbers from -1 to 1.
+# Every channel is kept. The waveform shows the lowest and highest of any channel, which is what you'd expect to see.
+def _decode(data, sample_width):
+    if sample_width == 1:
+        return (np.frombuffer(data, np.uint8).astype(np.float32) - 128) / 128
+    if sample_width == 2:
+        return np.frombuffer(data, np.int16).astype(np.float32) / 32768
+    if sample_width == 3:
+        raw = np.frombuffer(data, np.uint8).reshape(-1, 3).astype(np.int32)
+        samples = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        samples = np.where(samples >= 1 << 23, samples - (1 << 24), samples)
+        return samples.astype(np.float32) / (1 << 23)
+    return np.frombuffer(data, np.int32).astype(np.float32) / 2147483648
+
+
+# Build the envelope pyramid of a .wav file, in one pass.
+# `check` is called between pieces, so whoever started it can stop it early.
+def build_envelope(filename, check=None):
+    with wave.open(filename, "rb") as reader:
+        channels = reader.getnchannels()
+        sample_width = reader.getsampwidth()
+        builder = EnvelopeBuilder(reader.getframerate())
+
+        while True:
+            data = reader.readframes(BASE_BLOCK * READ_BLOCKS)
+            if len(data) == 0:
+                break
+            samples = _decode(data, sample_width)
+            frames = len(samples) // channels
+
+            # Only the very last piece can end on a partial block. It becomes a smaller block of its own.
+            whole = frames // BASE_BLOCK * BASE_BLOCK
+            if whole > 0:
+                builder.add_blocks(samples[:whole * channels].reshape(-1, BASE_BLOCK * channels), whole)
+            if whole < frames:
+                builder.add_blocks(samples[whole * channels:].reshape(1, -1), frames - whole)
+
+            if check is not None:
+                check()
+
+    return builder.finish()
+
+
+# Build the envelope pyramid of a song that is already loaded, as one channel of samples from -1 to 1.
+# This is how an analysis that loaded the song anyway (see `AudioAnalyzer`) gets one for nearly free.
+def envelope_from_samples(samples, sample_rate):
+    builder = EnvelopeBuilder(sample_rate)
+    whole = len(samples) // BASE_BLOCK * BASE_BLOCK
+    if whole > 0:
+        builder.add_blocks(np.asarray(samples[:whole], np.float32).reshape(-1, BASE_BLOCK), whole)
+    if whole < len(samples):
+        builder.add_blocks(np.asarray(samples[whole:], np.float32).reshape(1, -1), len(samples) - whole)
+    return builder.finish()
+
+
+# Load a pyramid that `Envelope.save` saved.
+def load_envelope(path):
+    with np.load(path) as arrays:
+        levels = []
+        while "mins" + str(len(levels)) in arrays:
+            index = str(len(levels))
+            levels.append([arrays["mins" + index], arrays["maxs" + index], arrays["rms" + index]])
+        return Envelope(int(arrays["sample_rate"]), int(arrays["frames"]), levels)
@@ -0,0 +1,123 @@
+# PyViz, a Python music visualizer.
+# Program by Austin Pringle, Caleb Rachocki, & Caleb Ruby
+# Pennsylvania Western University, California
+#
+# pyvizgoomexport.py
+# This file contains the GOOM exporter.
+# Instead of playing GOOM live on screen, it renders the whole song to a video file,
+# at whatever resolution and framerate we ask for.
+# Nothing in the pipeline waits on a clock, so it runs as fast as the computer can go,
+# which is usually a lot faster than real time.
+
+# Explanation of these imports is in the `pyvizgoompage.py` file
+# GStreamer takes a moment to load, and the customizer page reads the export choices below,
+# so `Gst` itself is only imported once an export actually starts.
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import GLib
+
+# The choices we offer for the size of the exported video, as (width, height).
+EXPORT_RESOLUTIONS = [(640, 480), (1280, 720), (1920, 1080)]
+
+# The choices we offer for the framerate of the exported video.
+EXPORT_FRAMERATES = [24, 30, 60]
+
+# How often we check how far along the export is, in milliseconds.
+PROGRESS_INTERVAL = 250
+
+# The GStreamer pipeline for exporting.
+# First, read the audio file and decode it, whatever format it is in.
+# Next, we branch out the pipeline using the "tee" element.
+# The first branch visualizes the audio using GOOM. The "caps" right after GOOM force it to draw
+# at the size and framerate we want. Then, it converts the video and encodes it as H.264.
+# The second branch encodes the audio itself as Vorbis.
+# Both branches meet at the "muxer", which packs them together into a single .mkv file.
+# The file sink doesn't wait on the clock ("sync=false"), so the whole thing runs as fast as it can.
+# The file names are filled in afterwards, so we don't have to worry about spaces and quotes in them.
+EXPORT_PIPELINE = (
+    "filesrc name=src ! decodebin ! audioconvert ! audioresample ! tee name=t "
+    "t. ! queue ! audioconvert ! goom ! video/x-raw,width={width},height={height},framerate={framerate}/1 "
+    "! videoconvert ! x264enc speed-preset=veryfast ! queue ! mux. "
+    "t. ! queue ! audioconvert ! vorbisenc ! queue ! mux. "
+    "matroskamux name=mux ! filesink name=sink sync=false"
+)
+
+
+class GoomExporter:
+
+    # Constructor function
+    # `on_progress` is called with a number from 0 to 1 every so often.
+    # `on_done` is called when the file is finished, and `on_error` with a message if something breaks.
+    # All three are called on the GUI's main loop.
+    def __init__(self, audio_path, output_path, width=1280, height=720, framerate=30, on_progress=None, on_done=None, on_error=None):
+        self.audio_path = audio_path
+        self.output_path = output_path
+        self.width, self.height, self.framerate = width, height, framerate
+        self.on_progress = on_progress
+        self.on_done = on_done
+        self.on_error = on_error
+        self.pipeline = None
+        self.progress_id = None
+
+    # Build the pipeline and start exporting. This returns right away.
+    def start(self):
+        from gi.repository import Gst
+
+        # Initialize GStreamer. Doing it more than once is harmless.
+        Gst.init(None)
+
+        self.pipeline = Gst.parse_launch(EXPORT_PIPELINE.format(width=self.width, height=self.height, framerate=self.framerate))
+        self.pipeline.get_by_name("src").set_property("location", self.audio_path)
+        self.pipeline.get_by_name("sink").set_property("location", self.output_path)
+
+        # The GUI's main loop delivers the pipeline's messages to us. See `pyvizgoompage.py`.
+        bus = self.pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect("message::eos", self._on_eos)
+        bus.connect("message::error", self._on_error)
+
+        self.pipeline.set_state(Gst.State.PLAYING)
+        self.progress_id = GLib.timeout_add(PROGRESS_INTERVAL, self._report_progress)
+
+    # Stop exporting. Whatever was written so far is left as it is.
+    def cancel(self):
+        self._stop()
+
+    # Shut the pipeline down, and stop checking on its progress.
+    def _stop(self):
+        from gi.repository import Gst
+        if self.progress_id is not None:
+            GLib.source_remove(self.progress_id)
+            self.progress_id = None
+        if self.pipeline is not None:
+            self.pipeline.get_bus().remove_signal_watch()
+            self.pipeline.set_state(Gst.State.NULL)
+            self.pipeline = None
+
+    # Ask the pipeline how far into the song it is, and how long the song is.
+    def _report_progress(self):
+        from gi.repository import Gst
+        if self.pipeline is None:
+            return GLib.SOURCE_REMOVE
+
+        found_position, position = self.pipeline.query_position(Gst.Format.TIME)
+        found_duration, duration = self.pipeline.query_duration(Gst.Format.TIME)
+        if found_position and found_duration and duration > 0 and self.on_progress is not None:
+            self.on_progress(min(1.0, position / duration))
+
+        return GLib.SOURCE_CONTINUE
+
+    # The end of the song made it all the way through to the file. We're done.
+    def _on_eos(self, bus, message):
+        self._stop()
+        if self.on_progress is not None:
+            self.on_progress(1.0)
+        if self.on_done is not None:
+            self.on_done(self.output_path)
+
+    # Something went wrong inside the pipeline.
+    def _on_error(self, bus, message):
+        error, debug = message.parse_error()
+        self._stop()
+        if self.on_error is not None:
+            self.on_error(error.message)
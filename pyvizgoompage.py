@@ -6,9 +6,6 @@
 # This file contains the loading page for the GOOM visuakizer
 # This page has the logic to build a GStreamer pipeline to create the GOOM Visualization
 
-# `os` is used to access files in a system-independent way.
-import os
-
 # Explanation of the Gtk, Adw, and GLib imports is in the `pyvizapp.py` file
 # However, we are importing one extra library this time.
 # GStreamer is a powerful media library, based on GObject.
@@ -19,27 +16,177 @@ gi.require_version("Adw", "1")
 gi.require_version('Gst', '1.0')
 from gi.repository import GLib, Gtk, Adw, Gst
 
-# Hey it's the YouTube downloader again! See `pyvizapp.py` for more information.
-from yt_dlp import YoutubeDL
+# Hey it's the YouTube downloader again! See `pyvizdownloader.py` for more information.
+import pyvizdownloader
+
+# We hand the download of the audio to the background job scheduler
+import pyvizscheduler
+
+# Each visualization runs in its own session, with its own private copy of the audio.
+# See `pyvizsession.py` for more information.
+import pyvizsession
+
+# Rendering GOOM to a video file, instead of onto the screen, is done by the exporter.
+# See `pyvizgoomexport.py` for more information.
+import pyvizgoomexport
+
+# GOOM pipelines that are put together, but not in use right now. See `take_pipeline`.
+_idle_pipelines = []
 
-# We run the download of the audio asynchronously 
-import threading
+
+# A GOOM pipeline that can be used over and over, for one song after another.
+# Loading GStreamer's plugins and building the pipeline takes a moment, so we do it ahead of time,
+# and keep the pipeline around afterwards, instead of building a new one for every visualization.
+class GoomPipeline:
+
+    # Constructor function
+    def __init__(self):
+
+        # Initialize GStreamer. Doing it more than once is harmless.
+        Gst.init(None)
+
+        # The GStreamer media library is based on a "pipeline" approach.
+        # Media is manipulated by putting it through various "elements".
+        # Linking these elements together makes a "pipeline"
+        # The following string defines our pipeline.
+        # First, grab the audio we want to visualize. Which file that is gets filled in later, for each song.
+        # Parse it using the "wavparse" element
+        # Next, we branch out the pipeline using the "tee" element.
+        # The first branch converts and resamples the audio into an optimal format,
+        # then plays it using a platform-appropriate method.
+        # Now, "t." lets us work on the second branch, which takes the parsed wav from just before the tee,
+        # converts it to an appropriate format for visualization, visualizes it using GOOM,
+        # and then converts and outputs the video feed in a platform-appropriate way.
+        pipeline_str = "filesrc name=src ! wavparse ! tee name=t ! queue ! audioconvert ! audioresample ! autoaudiosink t. ! queue ! audioconvert ! goom ! videoconvert ! autovideosink"
+
+        # We parse our pipeline with this convenience function.
+        self.pipeline = Gst.parse_launch(pipeline_str)
+        self.source = self.pipeline.get_by_name("src")
+
+        # Whoever is using the pipeline right now wants to know when the song is ready to play,
+        # and when it is over.
+        self.on_ready = None
+        self.on_finished = None
+
+        # `released` is true while the pipeline is back on the shelf, so releasing it twice doesn't put it there twice.
+        # `broken` is true once something went wrong inside it. A broken pipeline is never used again.
+        self.released = False
+        self.broken = False
+
+        # We don't need a main loop of our own to listen to the pipeline's messages.
+        # The GUI's main loop is already running, and it delivers them to us just fine.
+        # The pipeline keeps the same bus forever, so we only need to hook it up once.
+        bus = self.pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect("message::async-done", self._prerolled)
+        bus.connect("message::eos", self._finished)
+        bus.connect("message::error", self._failed)
+
+        # "Ready" means every element is built and has everything it needs, but no file is open yet.
+        self.pipeline.set_state(Gst.State.READY)
+
+    # Open a song, and "pre-roll" it: decode enough of it that the pipeline can start playing instantly.
+    # This happens in the background. `on_ready` is called once it's done,
+    # and `on_finished` is called if something goes wrong before then.
+    def preroll(self, path, on_ready=None, on_finished=None):
+        self.on_ready = on_ready
+        self.on_finished = on_finished
+        self.source.set_property("location", path)
+        if self.pipeline.set_state(Gst.State.PAUSED) == Gst.StateChangeReturn.SUCCESS:
+            # It was ready right away, so there won't be a message saying so.
+            GLib.idle_add(self._prerolled, None, None)
+
+    # Start playing. `on_finished` is called when the song is over, or if something goes wrong.
+    def play(self, on_finished=None):
+        self.on_ready = None
+        self.on_finished = on_finished
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    # Stop playing, close the song, and put the pipeline back on the shelf for the next visualization.
+    # Releasing a pipeline that is already on the shelf, or that broke, does nothing.
+    def release(self):
+        if self.released or self.broken:
+            return
+        self.released = True
+        self.on_ready = None
+        self.on_finished = None
+        self.pipeline.set_state(Gst.State.READY)
+        _idle_pipelines.append(self)
+
+    # Helper functions for GStreamer
+
+    # The song has been pre-rolled, and is ready to play.
+    def _prerolled(self, bus, message):
+        on_ready = self.on_ready
+        self.on_ready = None
+        if on_ready is not None:
+            on_ready()
+        return GLib.SOURCE_REMOVE
+
+    # When the feed is over, we are done with the pipeline, and it can be used again.
+    def _finished(self, bus, message):
+        on_finished = self.on_finished
+        self.release()
+        if on_finished is not None:
+            on_finished()
+
+    # When something goes wrong, we can't trust the pipeline anymore.
+    # Shut it down for good, instead of putting it back on the shelf.
+    def _failed(self, bus, message):
+        if self.broken:
+            return
+        on_finished = self.on_finished
+        self.on_ready = None
+        self.on_finished = None
+        self.broken = True
+        self.pipeline.set_state(Gst.State.NULL)
+        self.pipeline.get_bus().remove_signal_watch()
+        if self in _idle_pipelines:
+            _idle_pipelines.remove(self)
+
+        if on_finished is not None:
+            on_finished()
+
+
+# Get a GOOM pipeline: one that is already put together if we have one, or a new one if we don't.
+# When you are done with it, call its `release` function.
+def take_pipeline():
+    if len(_idle_pipelines) > 0:
+        pipeline = _idle_pipelines.pop()
+        pipeline.released = False
+        return pipeline
+    return GoomPipeline()
 
 # Like all the other pages, the GOOM page inherits from AdwNavigationPage
 class PyVizGoomPage(Adw.NavigationPage):
     # Constructor function 
-    def __init__(self, url, navigation_view):
+    # If `export_path` is given, GOOM is rendered to that video file (at `export_size` and `export_framerate`)
+    # instead of being played on screen.
+    # `video` is what we know about the song, as a `pyvizdownloader.VideoInfo`.
+    # `trace_id` ties this visualization to the press of "Submit" that led to it. See `pyviztelemetry.py`.
+    def __init__(self, video, navigation_view, export_path=None, export_size=(1280, 720), export_framerate=30, trace_id=None):
         # Use the parent class's constructor logic.
         super().__init__()
 
+        self.export_path = export_path
+        self.export_size = export_size
+        self.export_framerate = export_framerate
+
+        # The exporter, once the export has started.
+        self.exporter = None
+
+        # The GOOM pipeline we are getting ready while the song downloads. See `GoomPipeline`.
+        self.goom = None
+
         # Set the title of this page
         self.set_title("Visualizer Output")
 
         # Explanation for how these widgets work can be found in `pyvizapp.py`
+        # We hold on to the header bar, so we can bring the back button back once an export is finished.
         toolbar_view = Adw.ToolbarView()
-        header_bar = Adw.HeaderBar()
-        header_bar.set_show_back_button(False)
-        toolbar_view.add_top_bar(header_bar)
+        self.header_bar = Adw.HeaderBar()
+        self.header_bar.set_show_back_button(False)
+        toolbar_view.add_top_bar(self.header_bar)
 
         # Create a vertical box to hold the main content of this page.
         # Space its children out by 16 px. Vertically center it.
@@ -47,26 +194,38 @@ class PyVizGoomPage(Adw.NavigationPage):
         mainbox.set_valign(Gtk.Align.CENTER)
         
         # A spinner  to show while the video is downloading.
-        spinner = Gtk.Spinner()
-        spinner.set_size_request(64,64)
-        spinner.set_vexpand(True)
-        spinner.start()
-        mainbox.append(spinner)
+        self.spinner = Gtk.Spinner()
+        self.spinner.set_size_request(64,64)
+        self.spinner.set_vexpand(True)
+        self.spinner.start()
+        mainbox.append(self.spinner)
 
         # 2 blocks of text to explain what is happening behind the screen...
 
         # ...a big "downloading message"
-        loading_text = Gtk.Label()
-        loading_text.set_label("\nPlease wait...\n\nYour song is being downloaded.")
-        loading_text.set_justify(Gtk.Justification.CENTER)
-        loading_text.add_css_class("title-1")
-        mainbox.append(loading_text)
-
-        # ...a message explaining that the visualizer is to pop out in its own window.
-        explain_text = Gtk.Label()
-        explain_text.set_label("Your visualizer will start in its own window, momentarily.")
-        explain_text.set_justify(Gtk.Justification.CENTER)
-        mainbox.append(explain_text)
+        self.loading_text = Gtk.Label()
+        self.loading_text.set_label("\nPlease wait...\n\nYour song is being downloaded.")
+        self.loading_text.set_justify(Gtk.Justification.CENTER)
+        self.loading_text.add_css_class("title-1")
+        mainbox.append(self.loading_text)
+
+        # ...a message explaining where the visualizer is going to end up.
+        self.explain_text = Gtk.Label()
+        if export_path is not None:
+            self.explain_text.set_label("Your visualizer will be saved to " + export_path + ".")
+        else:
+            self.explain_text.set_label("Your visualizer will start in its own window, momentarily.")
+        self.explain_text.set_justify(Gtk.Justification.CENTER)
+        self.explain_text.set_wrap(True)
+        mainbox.append(self.explain_text)
+
+        # A progress bar for the download, and then for the export. It stays hidden until the download gets going.
+        self.progress_bar = Gtk.ProgressBar()
+        self.progress_bar.set_show_text(True)
+        self.progress_bar.set_margin_start(64)
+        self.progress_bar.set_margin_end(64)
+        self.progress_bar.set_visible(False)
+        mainbox.append(self.progress_bar)
 
         # Set the mainbox as the content widget of the toolbar view
         toolbar_view.set_content(mainbox)
@@ -74,88 +233,155 @@ class PyVizGoomPage(Adw.NavigationPage):
         # Set the toolbar view as the child of the nav page
         self.set_child(toolbar_view)
 
-        # Start the thread to download the video.
-        download_thread = threading.Thread(target=self.download, args=(url, navigation_view))
-        download_thread.start()
+        # If the user leaves the page in the middle of an export, stop it.
+        self.connect("hidden", self._page_hidden)
+
+        # This visualization's session. It owns the downloaded audio,
+        # so other visualizations running at the same time can't overwrite it.
+        self.session = pyvizsession.PyVizSession(trace_id)
+
+        # Have the scheduler download the video in the background.
+        # The user is waiting on this page for it, so it gets top priority.
+        # Once it is done, the scheduler calls `_downloaded` on the GUI's main loop.
+        self.session.submit("download", self.download, video,
+            priority=pyvizscheduler.PRIORITY_USER,
+            on_done=lambda result: self._downloaded(navigation_view),
+            on_error=lambda error: self._download_failed())
 
-    def download(self, url, navigation_view):
+        # While the song downloads, put the GOOM pipeline together, so it is ready to go the moment the song is.
+        # We wait until this page is on screen first, so the user isn't left looking at the previous one.
+        if export_path is None:
+            GLib.idle_add(self._prepare_pipeline)
+
+    # This function downloads the audio. It is run in the background by the scheduler.
+    def download(self, job, video):
         
-        # Downloader options dictionary
-        ydl_opts = {
-            # Ask youtube to output a high-quality .wav file
-            'format': 'wav/bestaudio/best',
-
-            # Output the file to a local folder called "downloads\audio"
-            'paths': {'home' : os.path.join("downloads", "audio")},
-
-            # Name the file cur_audio.wav
-            'outtmpl' : "cur_audio",
-
-            # Sometimes YouTube fails to properly give us the file we asked for.
-            # Just to be safe, we attempt to convert the output to .wav
-            'postprocessors': [{  # Extract audio using ffmpeg
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'wav',
-            }]
-        }
-
-        # Download the audio in question
-        YoutubeDL(ydl_opts).download(url)
+        # Download the audio in question, using a long-lived session from the shared downloader service.
+        # Output the file to this visualization's private folder, and name the file audio.wav
+        # Progress updates are passed on to `_download_progress`, on the GUI's main loop.
+        with self.session.span("download"):
+            pyvizdownloader.downloader.download_audio(video.url, self.session.folder(), "audio",
+                on_progress=lambda fraction, downloaded, total: job.post(self._download_progress, fraction, downloaded, total), info=video)
         
+        return
+
+    # The download made some progress. We end up here, on the GUI's main loop, a few times a second at most.
+    # Until we know how big the file is, the progress bar just bounces back and forth.
+    def _download_progress(self, fraction, downloaded, total):
+        self.progress_bar.set_visible(True)
+        if fraction is None:
+            self.progress_bar.pulse()
+            self.progress_bar.set_text(format(downloaded / 1048576, ".1f") + " MB")
+        else:
+            self.progress_bar.set_fraction(fraction)
+            self.progress_bar.set_text(format(downloaded / 1048576, ".1f") + " MB of " + format(total / 1048576, ".1f") + " MB")
+
+    # Get a GOOM pipeline ready. This runs on the GUI's main loop, while the song downloads.
+    # (If the download already failed by now, there is no point.)
+    def _prepare_pipeline(self):
+        if not self.session.closed:
+            self.goom = take_pipeline()
+        return GLib.SOURCE_REMOVE
+
+    # If the download didn't work out, we won't be needing the pipeline after all.
+    def _download_failed(self):
+        if self.goom is not None:
+            self.goom.release()
+            self.goom = None
+        self.session.close()
+
+    # Once the download is done, we end up here, back on the GUI's main loop.
+    def _downloaded(self, navigation_view):
+        self.progress_bar.set_visible(False)
+
+        # Exports stay on this page, so the user can watch the progress.
+        if self.export_path is not None:
+            self.export()
+            return
+
+        # Normally, the pipeline was already put together while the song was downloading.
+        if self.goom is None:
+            self.goom = take_pipeline()
+
+        # Point the pipeline at the song, and pre-roll it, right now, while this page is still up.
+        # Once it is ready, `_prerolled` takes the page down and starts it.
+        self.loading_text.set_label("\nPlease wait...\n\nYour visualizer is starting.")
+        self.goom.preroll(self.session.path("audio.wav"),
+            on_ready=lambda: self._prerolled(navigation_view),
+            on_finished=self._goom_failed)
+
+        return
+
+    # The song is pre-rolled. We end up here, on the GUI's main loop.
+    def _prerolled(self, navigation_view):
+
         # Remove this page from the navigation view when the loading is complete.
         navigation_view.pop()
 
         #Visualize the audio!
         self.viz()
-        
-        return
-    
-    # Helper function for GStreamer
-    def on_eos(self, bus, message, loop):
-        loop.quit()
 
-    # Helper function for GStreamer
-    def on_error(self, bus, message, loop):
-        loop.quit()
+    # GOOM couldn't open the song. Let the user know, and let them go back.
+    def _goom_failed(self):
+        self.goom = None
+        self.spinner.stop()
+        self.loading_text.set_label("\nSorry!\n\nGOOM could not play this song.")
+        self.header_bar.set_show_back_button(True)
+        self.session.close()
 
-    # The visualizer function.
+    # The visualizer function. This runs on the GUI's main loop.
     def viz(self):
-        
-        # Initialize GStreamer
-        Gst.init(None)
 
-        # The GStreamer media library is based on a "pipeline" approach.
-        # Media is manipulated by putting it through various "elements".
-        # Linking these elements together makes a "pipeline"
-        # The following string defines our pipeline.
-        # First, grab the audio we want to visualize from .\downloads\audio\cur_audio.wav.
-        # Parse it using the "wavparse" element
-        # Next, we branch out the pipeline using the "tee" element.
-        # The first branch converts and resamples the audio into an optimal format,
-        # then plays it using a platform-appropriate method.
-        # Now, "t." lets us work on the second branch, which takes the parsed wav from just before the tee,
-        # converts it to an appropriate format for visualization, visualizes it using GOOM,
-        # and then converts and outputs the video feed in a platform-appropriate way.
-        pipeline_str = "filesrc location=" + os.path.join("downloads", "audio", "cur_audio.wav") + " ! wavparse ! tee name=t ! queue ! audioconvert ! audioresample ! autoaudiosink t. ! queue ! audioconvert ! goom ! videoconvert ! autovideosink"
-        
-        # We parse and launch our pipeline with this convenience function.
-        pipeline = Gst.parse_launch(pipeline_str)
+        # The pipeline is already pre-rolled, so all that's left is to start it.
+        # Once the song is over (or if anything goes wrong), the pipeline goes back on the shelf (or is thrown away),
+        # and the session is over, so we clean up its files.
+        self.goom.play(self.session.close)
+        self.goom = None
 
-        # This is basic GStreamer boilerplate to start the pipeline
-        loop = GLib.MainLoop()
-        bus = pipeline.get_bus()
-        bus.add_signal_watch()
-        bus.connect("message::eos", self.on_eos, loop)
-        bus.connect("message::error", self.on_error, loop)
-        pipeline.set_state(Gst.State.PLAYING)
+        return
+
+    # The export function. This runs on the GUI's main loop, and returns right away.
+    # GStreamer does the actual work on threads of its own.
+    def export(self):
+        self.loading_text.set_label("\nPlease wait...\n\nYour visualizer is being rendered.")
+        self.progress_bar.set_fraction(0)
+        self.progress_bar.set_text(None)
+        self.progress_bar.set_visible(True)
+
+        # Rendering a whole song can take a while, so let the user back out of it.
+        self.header_bar.set_show_back_button(True)
+
+        width, height = self.export_size
+        self.exporter = pyvizgoomexport.GoomExporter(self.session.path("audio.wav"), self.export_path,
+            width, height, self.export_framerate,
+            on_progress=self.progress_bar.set_fraction,
+            on_done=self._exported,
+            on_error=self._export_failed)
+        self.exporter.start()
 
-        # This allows the user to stop the playing from the terminal
-        try:
-            loop.run()
-        except KeyboardInterrupt:
-            pass
+    # The video file is finished. Let the user know, and let them go back.
+    def _exported(self, output_path):
+        self.exporter = None
+        self.spinner.stop()
+        self.loading_text.set_label("\nAll done!\n\nYour visualizer has been saved.")
+        self.explain_text.set_label(output_path)
+        self.session.close()
 
-        # If we get here, the feed is over. Set the state from "playing" to "NULL"
-        pipeline.set_state(Gst.State.NULL)
+    # Something went wrong while rendering.
+    def _export_failed(self, message):
+        self.exporter = None
+        self.spinner.stop()
+        self.loading_text.set_label("\nSomething went wrong.\n\nYour visualizer could not be saved.")
+        self.explain_text.set_label(message)
+        self.session.close()
 
-        return
\ No newline at end of file
+    # When the user leaves the page, stop any export that is still going, and end the session.
+    # (When playing on screen, the page leaves on its own while GOOM is still getting started,
+    # so there is nothing to do here.)
+    def _page_hidden(self, page):
+        if self.export_path is None:
+            return
+        if self.exporter is not None:
+            self.exporter.cancel()
+            self.exporter = None
+        self.session.close()
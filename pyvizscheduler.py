@@ -0,0 +1,276 @@
+# PyViz, a Python music visualizer.
+# Program by Austin Pringle, Caleb Rachocki, & Caleb Ruby
+# Pennsylvania Western University, California
+#
+# pyvizscheduler.py
+# This file contains the background job scheduler.
+# All of the slow work in PyViz (searching, fetching thumbnails, downloading and analyzing audio)
+# is handed to this scheduler instead of being given a brand new thread every time.
+# Each kind of work gets its own small pool of worker threads, so no matter how many times
+# the user mashes "Submit" or "Back", only a handful of threads are ever running.
+
+# `os` lets background workers ask the operating system to run them at a lower priority.
+import os
+
+# The workers are threads, and they wait on thread-safe priority queues.
+import threading
+import queue
+
+# `itertools.count` gives us an ever-increasing number.
+# We use it so that jobs with the same priority run in the order they were submitted.
+import itertools
+
+# Used to print errors from jobs that have no error callback.
+import traceback
+
+# Explanation of these imports is in the `pyvizapp.py` file
+# Here, we use GLib to hand results back to the Gtk main loop.
+from gi.repository import GLib
+
+# Job priorities. Lower numbers run first.
+# Anything the user is looking at right now should use `PRIORITY_USER`.
+# Work done ahead of time "just in case" should use `PRIORITY_PREFETCH`.
+PRIORITY_USER = 0
+PRIORITY_NORMAL = 5
+PRIORITY_PREFETCH = 10
+
+# How many worker threads each kind of job is allowed to have.
+POOL_SIZES = {
+    "search" : 2,
+    "thumbnail" : 4,
+    "download" : 2,
+    "analysis" : 1,
+    "prepare" : 1,
+
+    # Each visualizer window has a worker of its own, watching it for as long as it is open.
+    # They spend all that time waiting on a pipe, so there are plenty to go around.
+    "visualizer" : 16,
+}
+
+
+# How much "nicer" to the rest of the program each kind of worker thread is, in Unix "nice" levels.
+# "prepare" work (getting the next song of a playlist ready while the current one plays) must never
+# make the visualizer drop frames, so the operating system is told to give it only what's left over.
+POOL_NICENESS = {
+    "prepare" : 10,
+}
+
+
+# Raised inside a job when it has been cancelled.
+# Jobs don't need to catch this. The scheduler handles it.
+class JobCancelled(Exception):
+    pass
+
+
+# Remembers which job each worker thread is running right now.
+_current = threading.local()
+
+
+# Get the job that the calling thread is running, or `None` if it isn't running one.
+# This lets code deep inside a job (like a yt-dlp progress hook) check for cancellation
+# without the job having to be passed all the way down to it.
+def current_job():
+    return getattr(_current, "job", None)
+
+
+# A single piece of background work.
+class Job:
+
+    # Constructor function
+    # `function` is called on a worker thread as `function(job, *args)`.
+    # `on_done` is called on the Gtk main loop with whatever `function` returned.
+    # `on_error` is called on the Gtk main loop with the exception, if `function` raised one.
+    def __init__(self, kind, priority, function, args, on_done, on_error, preemptible):
+        self.kind = kind
+        self.priority = priority
+        self.function = function
+        self.args = args
+        self.on_done = on_done
+        self.on_error = on_error
+        self.preemptible = preemptible
+
+        # Set whenever the job should stop what it is doing, whether for good or just for now.
+        self.stop_event = threading.Event()
+
+        # `cancelled` means the job is gone for good.
+        # `preempted` means the job was pushed aside by more important work, and will run again later.
+        self.cancelled = False
+        self.preempted = False
+        self.running = False
+
+        # `finished` means the job is over for good, one way or another.
+        # Anything in `done_callbacks` is called (on the worker thread) when that happens.
+        self.finished = False
+        self.done_callbacks = []
+        self.lock = threading.Lock()
+
+    # Cancel the job. If it hasn't started, it never will.
+    # If it is running, it stops the next time it calls `check()`.
+    # Either way, its `on_done` and `on_error` callbacks are never called.
+    def cancel(self):
+        self.cancelled = True
+        self.stop_event.set()
+
+    # Push the job aside, so it gets put back into the queue and runs again later.
+    def preempt(self):
+        self.preempted = True
+        self.stop_event.set()
+
+    # Call `function(job)` once the job is over for good, whether it finished, failed or was cancelled.
+    # If the job is already over, it is called right away.
+    def add_done_callback(self, function):
+        with self.lock:
+            if not self.finished:
+                self.done_callbacks.append(function)
+                return
+        function(self)
+
+    # Mark the job as over for good, and let everyone who asked know about it.
+    def _finish(self):
+        with self.lock:
+            self.finished = True
+            callbacks = self.done_callbacks
+            self.done_callbacks = []
+        for function in callbacks:
+            function(self)
+
+    # Jobs call this every so often. If the job has been stopped, it raises `JobCancelled`.
+    def check(self):
+        if self.stop_event.is_set():
+            raise JobCancelled()
+
+    # Run a function on the Gtk main loop, unless this job gets cancelled first.
+    # Use this for results that trickle in while the job is still running.
+    def post(self, function, *args):
+        def _call():
+            if not self.cancelled:
+                function(*args)
+            return GLib.SOURCE_REMOVE
+        GLib.idle_add(_call)
+
+
+# A group of worker threads that all take the same kind of job.
+class WorkerPool:
+
+    # Constructor function
+    def __init__(self, kind, size, niceness=0):
+        self.kind = kind
+        self.size = size
+        self.niceness = niceness
+        self.jobs = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.running = []
+        self.threads = []
+        self.lock = threading.Lock()
+
+    # Queue a job, starting another worker thread if we are still allowed to.
+    def submit(self, job):
+        self.jobs.put((job.priority, next(self.counter), job))
+
+        with self.lock:
+            if len(self.threads) < self.size:
+                thread = threading.Thread(target=self._work, name="pyviz-" + self.kind + "-" + str(len(self.threads)), daemon=True)
+                self.threads.append(thread)
+                thread.start()
+
+            # If every worker is busy, and one of them is running something less important than
+            # this new job, push that one aside so this one can go first.
+            elif len(self.running) >= self.size:
+                victims = [running for running in self.running if running.preemptible and running.priority > job.priority]
+                if len(victims) > 0:
+                    max(victims, key=lambda running: running.priority).preempt()
+
+    # Cancel every job in the pool, queued or running.
+    def cancel_all(self):
+        with self.lock:
+            for job in self.running:
+                job.cancel()
+        while True:
+            try:
+                self.jobs.get_nowait()[2].cancel()
+            except queue.Empty:
+                break
+
+    # The loop that every worker thread runs.
+    def _work(self):
+
+        # On Linux, a thread can be given its own priority by its thread ID.
+        # Anywhere that doesn't work, the thread just runs at the normal priority.
+        if self.niceness > 0:
+            try:
+                os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.niceness)
+            except (AttributeError, OSError):
+                pass
+
+        while True:
+            job = self.jobs.get()[2]
+
+            # Skip jobs that were cancelled while they were waiting in line.
+            if job.cancelled:
+                job._finish()
+                continue
+
+            with self.lock:
+                self.running.append(job)
+            job.running = True
+            _current.job = job
+
+            interrupted = False
+            try:
+                result = job.function(job, *job.args)
+            except JobCancelled:
+                interrupted = True
+            except Exception as error:
+                # A job with nobody to report to still shouldn't take the worker thread down with it.
+                if job.on_error is not None:
+                    job.post(job.on_error, error)
+                else:
+                    traceback.print_exc()
+            else:
+                if job.on_done is not None:
+                    job.post(job.on_done, result)
+            finally:
+                _current.job = None
+                job.running = False
+                with self.lock:
+                    self.running.remove(job)
+
+            # A job that was pushed aside (rather than cancelled) goes back in line.
+            # If it finished before it noticed, there is nothing left to do.
+            if job.preempted and not job.cancelled:
+                job.preempted = False
+                job.stop_event.clear()
+                if interrupted:
+                    self.jobs.put((job.priority, next(self.counter), job))
+                    continue
+
+            job._finish()
+
+
+# The scheduler itself. It owns one worker pool per kind of job.
+class JobScheduler:
+
+    # Constructor function
+    def __init__(self, pool_sizes=POOL_SIZES):
+        self.pools = {kind : WorkerPool(kind, size, POOL_NICENESS.get(kind, 0)) for kind, size in pool_sizes.items()}
+
+    # Hand a job to the scheduler.
+    # `kind` picks the worker pool, which is one of the keys of `POOL_SIZES`.
+    # `function` is called on a worker thread as `function(job, *args)`.
+    # Prefetch jobs can be pushed aside by more important work unless `preemptible` says otherwise.
+    # Returns the `Job`, which can be used to cancel it.
+    def submit(self, kind, function, *args, priority=PRIORITY_NORMAL, on_done=None, on_error=None, preemptible=None):
+        if preemptible is None:
+            preemptible = priority >= PRIORITY_PREFETCH
+        job = Job(kind, priority, function, args, on_done, on_error, preemptible)
+        self.pools[kind].submit(job)
+        return job
+
+    # Cancel everything. Called when the application shuts down.
+    def shutdown(self):
+        for pool in self.pools.values():
+            pool.cancel_all()
+
+
+# The one scheduler that the whole program shares.
+scheduler = JobScheduler()
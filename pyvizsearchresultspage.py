@@ -6,31 +6,60 @@
 # This file contains the search results page.
 # This page has the logic to search YouTube and display results.
 
-# `os` is used to access files in a system-independent way.
-import os
-
 # Explanation of these imports is in the `pyvizapp.py` file
+# This time, we also need `Gio` and `GObject`. We use them to build a list of search results
+# that the list view widget can read from.
 import gi
 gi.require_version("Gtk", "4.0")
 gi.require_version("Adw", "1")
-from gi.repository import GLib, Gtk, Adw
+from gi.repository import Gio, GObject, Gtk, Adw
 
-# We do a long-running YouTube search operation on this page, so we run it asynchronously.
-import threading
+# We do a long-running YouTube search operation on this page, so we hand it to the background job scheduler.
+import pyvizscheduler
 
-# Hey it's the YouTube downloader again! See `pyvizapp.py` for more information.
-from yt_dlp import YoutubeDL
+# Each search runs in its own session. See `pyvizsession.py` for more information.
+import pyvizsession
 
-# This lets us nuke a directory and all of its contents.
-# Used to give us a fresh .tmp directory ever time.
-from shutil import rmtree
+# Hey it's the YouTube downloader again! See `pyvizdownloader.py` for more information.
+import pyvizdownloader
 
-from PIL import Image
+# Thumbnails are decoded in memory and shared between pages through this cache.
+import pyvizthumbnails
 
 # Once the user selects the search result they want, we need to open this page.
 # It's the page that lets the user customize the visualizer.
 import pyvizcustomizerpage
 
+# How many search results we ask YouTube for at a time.
+RESULTS_PER_PAGE = 10
+
+# We stop offering more results after this many. Nobody scrolls that far.
+# It also keeps the later pages cheap enough: YouTube can't jump straight to result number 400,
+# so getting a page means walking through the search's pages (about 20 results each) from the very start.
+# The titles and IDs of earlier results come along for the ride, but nothing else about them is fetched.
+# At this cap, the last page of results costs about 25 small requests.
+MAX_RESULTS = 500
+
+
+# One search result. The list view reads these out of the results list.
+# It only holds the video's ID and title. The thumbnail itself lives in the shared thumbnail cache.
+class SearchResult(GObject.Object):
+
+    # A signal we send out when this result's thumbnail has arrived in the cache.
+    __gsignals__ = {
+        "thumbnail-ready" : (GObject.SignalFlags.RUN_FIRST, None, ()),
+    }
+
+    # Constructor function
+    def __init__(self, video_info):
+        super().__init__()
+        self.video_info = video_info
+        self.video_id = video_info["id"]
+        self.title = video_info.get("title") or self.video_id
+
+        # The background job fetching this result's thumbnail, if there is one.
+        self.thumbnail_job = None
+
 
 # Inherit from AdNavigationPage.
 class PyVizSearchResultsPage(Adw.NavigationPage):
@@ -39,13 +68,12 @@ class PyVizSearchResultsPage(Adw.NavigationPage):
     # Constructor function.
     # In the constructor, we pass some of the UI elements from the last page.
     # This is so we can return them to their default state.
-    def __init__(self, search_query, feedback_text, submit_button, spinner, navigation_view):
-        
+    # `trace_id` ties this search to the press of "Submit" that started it. See `pyviztelemetry.py`.
+    def __init__(self, search_query, feedback_text, submit_button, spinner, navigation_view, trace_id=None):
+
         # Use the parent class's constructor logic.
         super().__init__()
 
-        self.interrupted = False
-
         # Set the title of this page
         self.set_title("Search Results")
 
@@ -54,215 +82,262 @@ class PyVizSearchResultsPage(Adw.NavigationPage):
         submit_button.set_sensitive(True)
         spinner.stop()
 
+        self.search_query = search_query
+        self.navigation_view = navigation_view
+
+        # `loading` is true while we are waiting on a page of results.
+        # `exhausted` is true once YouTube has run out of results to give us.
+        self.loading = False
+        self.exhausted = False
+
+        # Every background job this page starts belongs to this page's own session,
+        # so we can cancel them all if the user leaves, without touching anybody else's work.
+        self.session = pyvizsession.PyVizSession(trace_id)
+
         # Explanation for how these widgets work can be found in `pyvizapp.py`
         toolbar_view = Adw.ToolbarView()
         header_bar = Adw.HeaderBar()
         toolbar_view.add_top_bar(header_bar)
 
+        # This is the list of search results. It starts off empty, and grows as results come in.
+        self.results = Gio.ListStore(item_type=SearchResult)
+
+        # A list view doesn't make a row of widgets for every search result.
+        # It only makes enough rows to fill the screen, and recycles them as the user scrolls.
+        # The "factory" is what it uses to build a row (`setup`), and to fill a row in with a result (`bind`).
+        # When a row scrolls off screen, it is emptied out (`unbind`) to be reused.
+        factory = Gtk.SignalListItemFactory()
+        factory.connect("setup", self._setup_row)
+        factory.connect("bind", self._bind_row)
+        factory.connect("unbind", self._unbind_row)
+
+        # The list view needs to know how results get selected.
+        # We don't need selection at all, just clicking, so we use `NoSelection`.
+        # Clicking a row once "activates" it, which calls `_result_activated`.
+        list_view = Gtk.ListView(model=Gtk.NoSelection(model=self.results), factory=factory)
+        list_view.set_single_click_activate(True)
+        list_view.connect("activate", self._result_activated)
+
         # GtkScrolledWindow allows us to scroll the content when it becomes too big.
         # The second line specifies that we only want to scroll vertically,
         # and never horizontally.
+        # When the user scrolls all the way to the bottom, we go and get more results.
         scrolled_window = Gtk.ScrolledWindow()
         scrolled_window.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
-
-        # Create a vertical box to hold the main content of this page.
-        # Space its children out by 8 px.
-        mainbox = Gtk.Box(orientation = Gtk.Orientation.VERTICAL, spacing = 8)
-
-        # The resultsbox is one of the two child widgets of mainbox.
-        # It holds the search results.
-        resultsbox = Gtk.Box(orientation = Gtk.Orientation.VERTICAL, spacing = 0)
-
-        # Add the resultsbox to the mainbox
-        mainbox.append(resultsbox)
+        scrolled_window.set_vexpand(True)
+        scrolled_window.set_child(list_view)
+        scrolled_window.connect("edge-reached", self._edge_reached)
 
         # The search page gets shown before the search is done happening.
         # Therefore, the page would be empty by default.
-        # To show the user that we are working, we show a 32px x 32px spinner.
-        # It goes under the resultsbox, so you can still see that the program is working
-        # As the various search results start to load in.
-        search_spinner = Gtk.Spinner()
-        search_spinner.set_margin_top(16)
-        search_spinner.set_size_request(32,32)
-        mainbox.append(search_spinner)
-        search_spinner.start()
-
-        # Set the mainbox as the child of the scrolled window to make it scrollable.
-        scrolled_window.set_child(mainbox)
-
-        # Set the scrolled window as the main content of the toolbar view.
+        # To show the user that we are working, we show a 32px x 32px spinner at the bottom of the page.
+        # Beside it, there is a button to load more results, for when there isn't enough to scroll.
+        bottom_box = Gtk.Box(orientation = Gtk.Orientation.HORIZONTAL, spacing = 8)
+        bottom_box.set_halign(Gtk.Align.CENTER)
+        bottom_box.set_margin_top(8)
+        bottom_box.set_margin_bottom(8)
+
+        self.search_spinner = Gtk.Spinner()
+        self.search_spinner.set_size_request(32,32)
+        bottom_box.append(self.search_spinner)
+
+        # If a page of results fails to load, this says so, and the button is left on so the user can try again.
+        self.error_text = Gtk.Label()
+        bottom_box.append(self.error_text)
+
+        self.load_more_button = Gtk.Button()
+        self.load_more_button.set_label("Load more results")
+        self.load_more_button.add_css_class("flat")
+        self.load_more_button.connect("clicked", lambda button: self._load_more())
+        bottom_box.append(self.load_more_button)
+
+        # Set the scrolled window as the main content of the toolbar view,
+        # and put the spinner and button in a bar at the bottom.
         toolbar_view.set_content(scrolled_window)
+        toolbar_view.add_bottom_bar(bottom_box)
 
         # Set the completed toolbar_view as the child of this page.
         self.set_child(toolbar_view)
 
         self.connect("hidden", self._search_interrupt, navigation_view)
 
-        # Create a new thread in which we can search YouTube.
-        # The target of the thread is the searchYoutube method.
-        # We pass the search query, as well as a few relevant UI elements, as parameters.
-        searchThread = threading.Thread(target=self.searchYouTube, args=(search_query, resultsbox, search_spinner, navigation_view))
-        searchThread.start()
+        # Get the first page of results.
+        self._load_more()
 
+    # When the user leaves this page, get rid of it, and cancel everything it was still doing.
+    # This stops the search (and any thumbnails still downloading) right where they are.
     def _search_interrupt(self, nav_page, nav_view):
         nav_view.remove(nav_page)
-        self.interrupted = True
-        
-    # This function actually does the YouTube searching.
-    def searchYouTube(self, search_query, resultsbox, spinner, navigation_view):
-        # This is weird, but basically, nuke the .tmp directory,
-        # And then recreate it.
-        # Then, if we get any error, just create it instead.
-        # Technically, we don't need to create the .tmp directory here,
-        # because the YouTube downloader does it automatically.
-        # Better to be safe than sorry.
-        try:
-            rmtree(".tmp")
-            os.mkdir(".tmp")
-        except:
-            os.mkdir(".tmp")
-        
-        # Declare a `for` loop for the numbers 1-10.
-        # We are going to use this to get the first 10 YouTube search results.
+        self.session.close()
+
+    # When the user scrolls to the very bottom of the list, get more results.
+    def _edge_reached(self, scrolled_window, position):
+        if position == Gtk.PositionType.BOTTOM:
+            self._load_more()
+
+    # Ask the scheduler to fetch the next page of results in the background.
+    # If we are already fetching one, or there are none left, this does nothing.
+    def _load_more(self):
+        if self.loading or self.exhausted:
+            return
+
+        self.loading = True
+        self.error_text.set_label("")
+        self.search_spinner.start()
+        self.load_more_button.set_sensitive(False)
+
+        # The user is waiting on this, so it gets top priority.
+        # When the page comes back, the scheduler calls `_page_loaded` on the GUI's main loop.
+        start = self.results.get_n_items() + 1
+        self.session.submit("search", self.searchYouTube, self.search_query, start,
+            priority=pyvizscheduler.PRIORITY_USER,
+            on_done=self._page_loaded,
+            on_error=self._page_failed)
+
+    # This function actually does the YouTube searching. It is run in the background by the scheduler.
+    # It gets one page of results, starting at result number `start`.
+    def searchYouTube(self, job, search_query, start):
+
         # We don't download the actual audio now. That comes later.
         # Instead, we just want metadata about the video,
         # in order to show  the user what result we came back with for their query.
-        for i in range(1,11):
-            if not self.interrupted:
-                os.mkdir(os.path.join(".tmp", str(i)))
-                
-                # Instead of having one method with a Buuuuunch of params,
-                # yt_dlp's YTDownloader takes a dictionary of potential arguments.
-                # `ydl_opts` defines our download arguments
-                ydl_search_opts = {
-
-                    # The `default-search` option lets you specify how you want to search.
-                    # Here, we tell it to ytsearch<i>
-                    # This means, "grab all of the first "i" (ie "first 5") search results".
-                    # Using this functionality, we could technically avoid using a for-loop.
-                    # However, we want to display the search results as they come in,
-                    # and if we used the "grab the first i results" by itself, the user would have to
-                    # wait for all of the results to come back before we could continue program flow,
-                    # thereby making them look at a blank screen.
-                    # Therefore, we use this option in combination with the next option...
-                    'default_search' : 'ytsearch'+str(i),
-
-                    # The `playlist_items` option here lets us get the "i"th result specifically.
-                    # Together with the last option, this means that for each iteration of the loop,
-                    # we ask for the top <i> search results, but only actually grab the "i"th.
-                    'playlist_items' : str(i),
-
-                    # Save the downloads to a directory called .tmp\<i>\
-                    # This means each search result gets a unique folder.
-                    'paths': {
-                        'home' : os.path.join(".",".tmp", str(i))  
-                    },
-
-                    # Don't actually download the video itself at all.
-                    # Remember, right now, we just want metadata.
-                    'skip_download' : 'true',
-
-                    # Write the thumbnail to file
-                    'writethumbnail' : 'true',
-
-                    # If it's the thumbnail, we name the output file something like
-                    # "IMG-videotitle.fileextension"
-                    # If not, don't use the `IMG` part
-                    'outtmpl' : {
-                        'default' : '%(title)s %(id)s',
-                    }
-                }
-                
-                # Instantiate a `YoutubeDL` object, using `ydl_search_opts` as the parameter.
-                # Then, call the `download` method, passing `url` as a parameter.
-                YoutubeDL(ydl_search_opts).download(search_query)
-
-                # !!!!!!!!!!
-                # For the following UI elements, keep in mind that these are created for each result.
-                # Their variable names are not unique outside of this for-loop.
-
-                # First, we create a button, inside of which which the search result will be displayed.
-                # The result is inside a button so that the user can click on the result to go to the next step.
-                # The `flat` style class makes it look cleaner.
-                search_result_button = Gtk.Button()
-                search_result_button.add_css_class("flat")
-
-                # Create a box to handle the layout inside of the search result button.
-                search_result_button_box = Gtk.Box(orientation = Gtk.Orientation.HORIZONTAL, spacing = 0)
-
-                # Declare a variable which will hold the path to the downloaded thumbnail.
-                # Ignore how ugly this line of code is. It basically grabs the first file
-                # in the tmp\1\ directory, which should be the download.
-                thumbnail_path = os.path.join(".tmp",str(i), os.listdir(os.path.join(".tmp",str(i)))[0])
-
-                # Google invented a wacky file format called .webp,
-                # which is the format that they use to store YouTube thumbnails.
-                # Gtk doesn't play well with .webp sometimes, so let's make the images .png!
-                # We're going to convert the image to .png using PIL (the Pillow package)
-                # Here, we open the image we just found, as an image object,
-                # Then split the filename and extension in two, in order to remove the .webp extension.
-                # Then we save it as .png
-                Image.open(thumbnail_path).save(os.path.splitext(thumbnail_path)[0] + ".png")
-
-                # Delete the original unconverted thumbnail
-                os.remove(thumbnail_path)
-
-                # Update the thumbnail path to point to the new .png version
-                thumbnail_path = os.path.splitext(thumbnail_path)[0] + ".png"
-
-                # Create an image to hold the video thumbnail.
-                # Then, request a size of 240p, and set the image from the path.
-                # Then add the image to the result_button_box. 
-                search_result_thumbnail = Gtk.Image()
-                search_result_thumbnail. set_size_request(352,240)
-                search_result_thumbnail.set_from_file(thumbnail_path)
-                search_result_button_box.append(search_result_thumbnail)
-
-                # Create a label to hold the title of the search result.
-                # Allow the text to wrap if there is not enough space.
-                # Allow it to expand if it gets more space.
-                # Then, set the label based off of the filename of the url_file_path.
-                # Then add it to the search results box.
-                search_result_text = Gtk.Label()
-                search_result_text.set_wrap(True)
-                search_result_text.set_hexpand(True)
-
-                # In this super fun block of code we isolate the video title
-                # from the rest of the thumbnail path.
-                # First, we split the filename from the path
-                search_result_title_inprogress = os.path.split(thumbnail_path)[1]
-                # Then, we excise the file extension
-                search_result_title_inprogress = os.path.splitext(search_result_title_inprogress)[0]
-                # Then, we tokenize the string, and remove the last token.
-                # (The URL would be the last token)
-                search_result_title_inprogress = search_result_title_inprogress.split()[0:len(search_result_title_inprogress.split())-1]\
-                # Then we re-unite the tokens into a string containing just the video title.
-                search_result_title = ""
-                for word in search_result_title_inprogress:
-                    search_result_title = search_result_title + word + " "
-                # Now, we are done.
-                search_result_text.set_label(search_result_title)
-                search_result_button_box.append(search_result_text)
-
-                # Set the completed search_result_button_box as the child of the search_result_button
-                search_result_button.set_child(search_result_button_box)
-
-                # Connect the search_result_button's "clicked" signal to the  `_result_clicked` callback function.
-                # Also, pass the thumbnail path ant the navigation view
-                search_result_button.connect("clicked", self._result_clicked, thumbnail_path, navigation_view)
-
-                # Add this result to the results
-                resultsbox.append(search_result_button)
-            else: break
-        # This is outside of the for-loop.
-        # Getting here means we have received all 10 search results.
-        # The program is done working, hide the search spinner.
-        spinner.stop()
-
-        # Return, because, if we don't, the thread never stops.
-        return
+        end = start + RESULTS_PER_PAGE - 1
+
+        # Borrow a long-lived `YoutubeDL` session from the shared downloader service.
+        # It already knows not to download the video itself. Remember, right now, we just want metadata.
+        # On top of that, we give it a few search options that only apply to this one request.
+        #
+        # The `default-search` option lets you specify how you want to search.
+        # Here, we tell it to ytsearch<end>
+        # This means, "grab all of the first <end> (ie "first 20") search results".
+        #
+        # The `playlist_items` option here lets us get only the results from <start> to <end>.
+        # Together with the last option, this means we get exactly one page of results.
+        #
+        # The `extract_flat` option tells it to just read the titles and IDs off of the search results,
+        # instead of visiting every single video's page. That makes a whole page come back in one request.
+        #
+        # Then, call the `extract_info` method, passing the query as a parameter.
+        # A search comes back as a playlist, and its entries are our results.
+        with self.session.span("search", start=start) as span:
+            search_result = pyvizdownloader.downloader.extract_info(search_query[0],
+                default_search='ytsearch'+str(end),
+                playlist_items=str(start)+"-"+str(end),
+                extract_flat='in_playlist')
+            entries = list(search_result.get("entries") or [])
+            span.set("results", len(entries))
+
+        return entries
+
+    # When a page of results comes back, we end up here, back on the GUI's main loop.
+    def _page_loaded(self, entries):
+        self.loading = False
+        self.search_spinner.stop()
+        self.load_more_button.set_label("Load more results")
+
+        # Add all of the new results to the list in one go.
+        # The list view takes care of showing them.
+        self.results.splice(self.results.get_n_items(), 0, [SearchResult(entry) for entry in entries if entry.get("id")])
+
+        # A short page means YouTube has nothing more to give us.
+        if len(entries) < RESULTS_PER_PAGE or self.results.get_n_items() >= MAX_RESULTS:
+            self.exhausted = True
+
+        self.load_more_button.set_sensitive(not self.exhausted)
+
+    # If a page of results fails to load (say, the network dropped out for a moment), we end up here instead.
+    # That doesn't mean YouTube is out of results, so we tell the user, and let them try again.
+    def _page_failed(self, error):
+        self.loading = False
+        self.search_spinner.stop()
+
+        # If the page was cancelled, the user has already left. There's nobody to tell.
+        if isinstance(error, pyvizscheduler.JobCancelled):
+            return
+
+        self.error_text.set_label("Could not load more results.")
+        self.load_more_button.set_label("Try again")
+        self.load_more_button.set_sensitive(True)
+
+    # Build the widgets for one row of the list. The list view calls this only a handful of times,
+    # and then reuses the rows it already has.
+    def _setup_row(self, factory, list_item):
+
+        # Create a box to handle the layout inside of the row.
+        search_result_box = Gtk.Box(orientation = Gtk.Orientation.HORIZONTAL, spacing = 0)
+
+        # Create an image to hold the video thumbnail.
+        # Then, request a size of 240p, and add the image to the box.
+        search_result_thumbnail = Gtk.Image()
+        search_result_thumbnail. set_size_request(352,240)
+        search_result_box.append(search_result_thumbnail)
+
+        # Create a label to hold the title of the search result.
+        # Allow the text to wrap if there is not enough space.
+        # Allow it to expand if it gets more space.
+        # Then add it to the box.
+        search_result_text = Gtk.Label()
+        search_result_text.set_wrap(True)
+        search_result_text.set_hexpand(True)
+        search_result_box.append(search_result_text)
+
+        list_item.set_child(search_result_box)
+
+    # Fill in a row with a particular search result.
+    def _bind_row(self, factory, list_item):
+        result = list_item.get_item()
+        search_result_box = list_item.get_child()
+        search_result_thumbnail = search_result_box.get_first_child()
+        search_result_text = search_result_box.get_last_child()
+
+        search_result_text.set_label(result.title)
+
+        # When the thumbnail arrives, show it.
+        # We remember the signal connection, so we can undo it when the row is recycled.
+        handler = result.connect("thumbnail-ready", lambda result: self._show_thumbnail(result, search_result_thumbnail))
+        list_item.thumbnail_handler = (result, handler)
+
+        # If the thumbnail is already in the shared cache, use it right away.
+        # Otherwise, have the scheduler fetch it in the background.
+        # The user is looking at this row, so it gets top priority.
+        if not self._show_thumbnail(result, search_result_thumbnail):
+            search_result_thumbnail.clear()
+            if result.thumbnail_job is None or result.thumbnail_job.finished:
+                result.thumbnail_job = self.session.submit("thumbnail", self._fetch_thumbnail, result.video_info,
+                    priority=pyvizscheduler.PRIORITY_USER,
+                    on_done=lambda texture: result.emit("thumbnail-ready"))
+
+    # Empty out a row that has scrolled off screen, so it can be reused.
+    def _unbind_row(self, factory, list_item):
+        result, handler = list_item.thumbnail_handler
+        result.disconnect(handler)
+        list_item.thumbnail_handler = None
+
+        # Nobody is looking at this result anymore, so if its thumbnail hasn't started downloading yet,
+        # don't bother. If it scrolls back into view, we'll ask again.
+        if result.thumbnail_job is not None and not result.thumbnail_job.running:
+            result.thumbnail_job.cancel()
+            result.thumbnail_job = None
+
+    # Show a result's thumbnail in an image, if it is in the shared cache.
+    # Returns whether it was.
+    def _show_thumbnail(self, result, image):
+        thumbnail = pyvizthumbnails.thumbnail_cache.get(result.video_id)
+        if thumbnail is not None:
+            image.set_from_paintable(thumbnail)
+            return True
+        return False
+
+    # Fetch the thumbnail of a search result into the shared thumbnail cache.
+    # It is run in the background by the scheduler, and the thumbnail is decoded
+    # and shrunk to display size in memory, right there in the background.
+    def _fetch_thumbnail(self, job, video_info):
+        with pyvizdownloader.downloader.metadata_session() as ydl:
+            return pyvizthumbnails.thumbnail_cache.load(video_info, ydl)
 
     # Callback function for whenever a result is selected.
-    def _result_clicked(self, button, thumbnail_path, navigation_view):
+    def _result_activated(self, list_view, position):
+        result = self.results.get_item(position)
+
         # Push the customizer page to the navigation stack.
-        navigation_view.push(pyvizcustomizerpage.PyVizCustomizerPage(thumbnail_path, navigation_view))
+        self.navigation_view.push(pyvizcustomizerpage.PyVizCustomizerPage(pyvizdownloader.VideoInfo(result.video_info), self.navigation_view, self.session.trace_id))
@@ -0,0 +1,137 @@
+# PyViz, a Python music visualizer.
+# Program by Austin Pringle, Caleb Rachocki, & Caleb Ruby
+# Pennsylvania Western University, California
+#
+# pyvizsession.py
+# This file contains the session class.
+# A session is one self-contained piece of work, like a search or a visualization.
+# Each one gets its own private folder and keeps track of its own background jobs,
+# so any number of them can run side by side without stepping on each other's files.
+
+# `os` is used to access files in a system-independent way.
+import os
+
+# Used to give every session a unique ID.
+import uuid
+
+# Used to create each session's private folder in the system's temporary directory.
+import tempfile
+
+# This lets us nuke a directory and all of its contents.
+# Used to clean up a session's folder when the session is over.
+from shutil import rmtree
+
+# The lock protects the job list, since jobs are added from more than one thread.
+import threading
+
+# Sessions hand their background work to the shared scheduler.
+import pyvizscheduler
+
+# Sessions tag their timing spans with their own ID. See `pyviztelemetry.py`.
+import pyviztelemetry
+
+# Every session that hasn't been closed yet, so they can all be cleaned up when the application quits.
+_open_sessions = set()
+_open_sessions_lock = threading.Lock()
+
+
+# Close every session that is still open. Called when the application shuts down.
+def close_all_sessions():
+    with _open_sessions_lock:
+        sessions = list(_open_sessions)
+    for session in sessions:
+        session.close()
+
+
+class PyVizSession:
+
+    # Constructor function
+    # `trace_id` ties this session to the others started by the same press of "Submit". See `pyviztelemetry.py`.
+    def __init__(self, trace_id=None):
+
+        # A short, unique ID for this session.
+        self.id = uuid.uuid4().hex[:12]
+        self.trace_id = trace_id or self.id
+
+        # The session's private folder. It isn't created until somebody actually needs it.
+        self.directory = None
+
+        # Every job this session has started, so we can cancel them all when it is over.
+        self.jobs = []
+        self.closed = False
+        self.lock = threading.Lock()
+
+        with _open_sessions_lock:
+            _open_sessions.add(self)
+
+    # Get the path to this session's private folder, creating it if needed.
+    def folder(self):
+        with self.lock:
+            if self.directory is None:
+                self.directory = tempfile.mkdtemp(prefix="pyviz-" + self.id + "-")
+            return self.directory
+
+    # Get the path to a file inside this session's private folder.
+    def path(self, name):
+        return os.path.join(self.folder(), name)
+
+    # Time a stage of this session. See `Telemetry.span`.
+    def span(self, name, **attributes):
+        return pyviztelemetry.telemetry.span(name, session=self.id, trace=self.trace_id, **attributes)
+
+    # Write down a stage of this session that has already been timed. See `Telemetry.record`.
+    def record(self, name, seconds, **attributes):
+        pyviztelemetry.telemetry.record(name, seconds, session=self.id, trace=self.trace_id, **attributes)
+
+    # Hand a job to the shared scheduler, and remember it as belonging to this session.
+    # Takes the same arguments as `JobScheduler.submit`.
+    # If the session is already over, the job is cancelled right away.
+    def submit(self, kind, function, *args, **kwargs):
+        job = pyvizscheduler.scheduler.submit(kind, function, *args, **kwargs)
+        with self.lock:
+            if self.closed:
+                job.cancel()
+            else:
+                # Forget about jobs that are completely done, so the list doesn't grow forever.
+                self.jobs = [old_job for old_job in self.jobs if not old_job.finished]
+                self.jobs.append(job)
+        return job
+
+    # End the session. Cancels all of its jobs, and deletes its private folder.
+    # It is safe to call this more than once.
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            jobs = self.jobs
+            self.jobs = []
+            directory = self.directory
+
+        with _open_sessions_lock:
+            _open_sessions.discard(self)
+
+        for job in jobs:
+            job.cancel()
+
+        if directory is None:
+            return
+
+        # A job that was in the middle of writing into the folder might not notice it was cancelled
+        # for a moment. So, we only delete the folder once every one of them has actually stopped.
+        # (A job waiting on an analysis process stops that process before it stops itself. See `_wait` in `pyvizvisprocess.py`.)
+        running = [job for job in jobs if not job.finished]
+        remaining = [len(running)]
+        if remaining[0] == 0:
+            rmtree(directory, ignore_errors=True)
+            return
+
+        def _job_stopped(job):
+            with self.lock:
+                remaining[0] = remaining[0] - 1
+                last = remaining[0] == 0
+            if last:
+                rmtree(directory, ignore_errors=True)
+
+        for job in running:
+            job.add_done_callback(_job_stopped)
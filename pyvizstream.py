@@ -0,0 +1,323 @@
+# PyViz, a Python music visualizer.
+# Program by Austin Pringle, Caleb Rachocki, & Caleb Ruby
+# Pennsylvania Western University, California
+#
+# pyvizstream.py
+# This file contains the frame streamer.
+# It shares the built-in visualizer with other screens, through a tiny web server.
+#
+# - http://<address>:<port>/ is a web page that shows the visualizer.
+# - http://<address>:<port>/stream.mjpg is the visualizer itself, as a "motion JPEG" video stream.
+# - http://<address>:<port>/frame.jpg is the latest single frame.
+# - ws://<address>:<port>/position is a WebSocket that tells you how far into the song we are, once per frame.
+#
+# Every frame is turned into a JPEG only once, no matter how many screens are watching.
+# A screen that can't keep up just misses some frames. It never slows the visualizer down.
+# By default, only programs on this computer can connect.
+
+# The web server runs on `asyncio`, in a thread of its own.
+import asyncio
+
+# For the WebSocket handshake.
+import base64
+import hashlib
+
+# Positions are sent as JSON.
+import json
+
+# The web server and the JPEG encoder each get their own thread, so the visualizer never waits on either.
+import threading
+
+# For limiting how many frames per second get streamed.
+import time
+
+# `io` lets us write the JPEG into memory instead of a file.
+import io
+
+# Used to encode the frames as JPEGs.
+from PIL import Image
+
+# Where the server listens by default. "127.0.0.1" means "this computer only".
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+# The JPEG quality, from 1 (worst) to 95 (best).
+DEFAULT_QUALITY = 80
+
+# At most this many frames per second are streamed. Anything more is skipped before it is even copied.
+DEFAULT_MAX_FPS = 30
+
+# The boundary between frames in the motion JPEG stream.
+BOUNDARY = b"pyvizframe"
+
+# Every WebSocket handshake mixes in this exact string. It is part of the WebSocket standard.
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# The web page at "/". It shows the stream, and the song position underneath.
+INDEX_PAGE = b"""<!DOCTYPE html>
+<html>
+<head><title>PyViz</title></head>
+<body style="margin: 0; background: black; color: white; font-family: sans-serif;">
+<img src="/stream.mjpg" style="width: 100%; height: auto; display: block;">
+<p id="position"></p>
+<script>
+var socket = new WebSocket("ws://" + location.host + "/position");
+socket.onmessage = function (event) {
+    document.getElementById("position").textContent = JSON.parse(event.data).position.toFixed(2) + " s";
+};
+</script>
+</body>
+</html>
+"""
+
+
+# Wrap a piece of text as a WebSocket message.
+def _websocket_message(text):
+    payload = text.encode()
+    header = bytearray([0x81])
+    if len(payload) < 126:
+        header.append(len(payload))
+    elif len(payload) < 65536:
+        header.append(126)
+        header += len(payload).to_bytes(2, "big")
+    else:
+        header.append(127)
+        header += len(payload).to_bytes(8, "big")
+    return bytes(header) + payload
+
+
+# One connected screen (or WebSocket).
+# It only ever holds on to the newest thing to send. If something newer comes in before
+# the last one went out, the last one is dropped.
+class _Client:
+    def __init__(self):
+        self.latest = None
+        self.ready = asyncio.Event()
+        self.dropped = 0
+
+    # Called with each new frame (or position).
+    def offer(self, item):
+        if self.latest is not None:
+            self.dropped += 1
+        self.latest = item
+        self.ready.set()
+
+    # Wait for the next thing to send.
+    async def next(self):
+        await self.ready.wait()
+        self.ready.clear()
+        item = self.latest
+        self.latest = None
+        return item
+
+
+# The frame streamer itself.
+class FrameStreamer:
+
+    # Constructor function
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, quality=DEFAULT_QUALITY, max_fps=DEFAULT_MAX_FPS):
+        self.host, self.port = host, port
+        self.quality = quality
+        self.min_interval = 1.0 / max_fps
+
+        # The newest frame that hasn't been encoded yet, as (pixels, width, height, position).
+        # The visualizer puts frames in here, and the encoder takes them out.
+        # If the encoder is still busy with the last one, the visualizer simply replaces it.
+        self.pending_frame = None
+        self.condition = threading.Condition()
+        self.last_publish = 0.0
+
+        # The newest encoded frame, and how many frames have been encoded.
+        self.latest_jpeg = None
+        self.frames_encoded = 0
+
+        self.video_clients = set()
+        self.position_clients = set()
+
+        self.loop = None
+        self.server = None
+        self.running = False
+        self.threads = []
+
+    # Start the web server and the encoder.
+    # This waits until the server is listening, so if the port is taken, the `OSError` comes out of here.
+    def start(self):
+        started = threading.Event()
+        errors = []
+
+        def _serve():
+            self.loop = asyncio.new_event_loop()
+            try:
+                self.server = self.loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+            except OSError as error:
+                errors.append(error)
+                started.set()
+                self.loop.close()
+                return
+            started.set()
+            self.loop.run_forever()
+
+            # We were stopped. Hang up on every screen, and close everything down.
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.server.close()
+            self.loop.run_until_complete(self.server.wait_closed())
+            self.loop.close()
+
+        self.running = True
+        server_thread = threading.Thread(target=_serve, name="pyviz-stream-server", daemon=True)
+        server_thread.start()
+        started.wait()
+        if len(errors) > 0:
+            self.running = False
+            raise errors[0]
+
+        encoder_thread = threading.Thread(target=self._encode_frames, name="pyviz-stream-encoder", daemon=True)
+        encoder_thread.start()
+        self.threads = [server_thread, encoder_thread]
+
+    # Stop the web server and the encoder. It is safe to call this more than once.
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        with self.condition:
+            self.condition.notify()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    # Hand the streamer the frame that was just drawn. This is called by the visualizer, after every frame.
+    # `framebuffer` is a `visualizerengine.FrameBuffer`, and `position` is how far into the song we are, in seconds.
+    # It never waits on the encoder or on any screen: at worst, it copies the pixels and moves on.
+    def publish(self, framebuffer, position):
+        now = time.monotonic()
+        if not self.running or now - self.last_publish < self.min_interval:
+            return
+        self.last_publish = now
+
+        with self.condition:
+            self.pending_frame = (bytes(framebuffer.pixels), framebuffer.width, framebuffer.height, position)
+            self.condition.notify()
+
+    # The encoder thread. It turns each new frame into a JPEG, once, and hands it to the web server.
+    def _encode_frames(self):
+        while True:
+            with self.condition:
+                while self.running and self.pending_frame is None:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                pixels, width, height, position = self.pending_frame
+                self.pending_frame = None
+
+            # The frame buffer is blue-green-red-unused. Pillow can read that layout directly.
+            image = Image.frombuffer("RGB", (width, height), pixels, "raw", "BGRX", 0, 1)
+            jpeg = io.BytesIO()
+            image.save(jpeg, "JPEG", quality=self.quality)
+
+            self.loop.call_soon_threadsafe(self._broadcast, jpeg.getvalue(), position)
+
+    # Hand a new frame and position to every connected screen. This runs on the web server's thread.
+    def _broadcast(self, jpeg, position):
+        self.latest_jpeg = jpeg
+        self.frames_encoded += 1
+        for client in self.video_clients:
+            client.offer(jpeg)
+        message = _websocket_message(json.dumps({"position": position, "frame": self.frames_encoded}))
+        for client in self.position_clients:
+            client.offer(message)
+
+    # Handle one connection to the web server.
+    async def _handle(self, reader, writer):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            lines = request.decode("latin-1").split("\r\n")
+            method, path = lines[0].split(" ")[:2]
+            headers = {}
+            for line in lines[1:]:
+                if ":" in line:
+                    name, value = line.split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+
+            if method != "GET":
+                await self._respond(writer, b"405 Method Not Allowed", b"text/plain", b"")
+            elif path == "/":
+                await self._respond(writer, b"200 OK", b"text/html", INDEX_PAGE)
+            elif path == "/frame.jpg":
+                if self.latest_jpeg is None:
+                    await self._respond(writer, b"503 Service Unavailable", b"text/plain", b"No frames yet.\n")
+                else:
+                    await self._respond(writer, b"200 OK", b"image/jpeg", self.latest_jpeg)
+            elif path == "/stream.mjpg":
+                await self._stream_video(writer)
+            elif path == "/position" and headers.get("upgrade", "").lower() == "websocket":
+                await self._stream_position(reader, writer, headers["sec-websocket-key"])
+            else:
+                await self._respond(writer, b"404 Not Found", b"text/plain", b"Not found.\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, KeyError, ValueError):
+            # The screen went away, or sent us something we don't understand.
+            pass
+        except asyncio.CancelledError:
+            # The streamer is being stopped.
+            pass
+        finally:
+            writer.close()
+
+    # Send a simple, complete response.
+    async def _respond(self, writer, status, content_type, body):
+        writer.write(b"HTTP/1.1 " + status + b"\r\nContent-Type: " + content_type
+            + b"\r\nContent-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+        await writer.drain()
+
+    # Send frames to a screen as a motion JPEG stream, for as long as it stays connected.
+    # Waiting on `drain` only holds up this one screen. Frames that come in meanwhile replace each other.
+    async def _stream_video(self, writer):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: multipart/x-mixed-replace; boundary=" + BOUNDARY
+            + b"\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n")
+        client = _Client()
+        self.video_clients.add(client)
+        try:
+            while True:
+                jpeg = await client.next()
+                writer.write(b"--" + BOUNDARY + b"\r\nContent-Type: image/jpeg\r\nContent-Length: "
+                    + str(len(jpeg)).encode() + b"\r\n\r\n" + jpeg + b"\r\n")
+                await writer.drain()
+        finally:
+            self.video_clients.discard(client)
+
+    # Send the song position over a WebSocket, for as long as it stays connected.
+    async def _stream_position(self, reader, writer, key):
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest())
+        writer.write(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: "
+            + accept + b"\r\n\r\n")
+        await writer.drain()
+
+        client = _Client()
+        self.position_clients.add(client)
+
+        # We don't expect the other side to say anything, except goodbye.
+        async def _listen():
+            while True:
+                data = await reader.read(1024)
+                if len(data) == 0 or data[0] & 0x0F == 0x8:
+                    return
+
+        listener = asyncio.ensure_future(_listen())
+        try:
+            while True:
+                sender = asyncio.ensure_future(client.next())
+                done, pending = await asyncio.wait([sender, listener], return_when=asyncio.FIRST_COMPLETED)
+                if listener in done:
+                    sender.cancel()
+                    writer.write(b"\x88\x00")
+                    await writer.drain()
+                    return
+                writer.write(sender.result())
+                await writer.drain()
+        finally:
+            listener.cancel()
+            self.position_clients.discard(client)
@@ -0,0 +1,240 @@
+# PyViz, a Python music visualizer.
+# Program by Austin Pringle, Caleb Rachocki, & Caleb Ruby
+# Pennsylvania Western University, California
+#
+# pyviztelemetry.py
+# This file contains the telemetry recorder.
+# It times every stage between the user pressing "Submit" and the first visualizer frame showing up:
+# the metadata probe, the search, the download, the analysis, and so on.
+#
+# Each timed stage is a "span". Spans are tagged with the session they belong to (see `pyvizsession.py`)
+# and with a "trace": one trip from "Submit" to a visualization, which can cross several sessions.
+# They are written to two files in the telemetry folder:
+#
+# - `spans.jsonl` gets one line of JSON per span, as it finishes.
+# - `metrics.prom` is a snapshot of how long each stage takes overall, in Prometheus's text format.
+#
+# The telemetry folder is `~/.cache/pyviz/telemetry` unless the `PYVIZ_TELEMETRY_DIR` environment variable says otherwise.
+# Setting the `PYVIZ_NO_TELEMETRY` environment variable turns it off entirely.
+# It only does a little bookkeeping per stage, and there are only a handful of stages per visualization,
+# so it is cheap enough to leave on.
+
+# Spans are written as JSON.
+import json
+
+# `os` is used to access files in a system-independent way.
+import os
+
+# Spans are finished on many threads, so the files and totals are guarded with a lock.
+import threading
+
+# Each snapshot is written to a temporary file first. See `write_snapshot`.
+import tempfile
+
+# For measuring time.
+import time
+
+# Used to give every trace a unique ID.
+import uuid
+
+# An OrderedDict remembers the order things were added in.
+# We use it to forget the oldest traces first.
+from collections import OrderedDict
+
+# The file names inside the telemetry folder.
+SPANS_FILE = "spans.jsonl"
+METRICS_FILE = "metrics.prom"
+
+# The snapshot is rewritten at most this often, in seconds. It is also written when the application quits.
+SNAPSHOT_INTERVAL = 10.0
+
+# How many traces we remember the start of. A trace has no clear end (the user can go back and pick
+# another search result, from the same search), so instead of forgetting each one when it's over,
+# we forget the oldest ones once there are this many. Nobody is still clicking through a search from this many searches ago.
+MAX_TRACES = 256
+
+# The histogram buckets for stage times, in seconds.
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0]
+
+
+# Where telemetry goes, unless told otherwise.
+def default_directory():
+    if os.environ.get("PYVIZ_TELEMETRY_DIR"):
+        return os.environ["PYVIZ_TELEMETRY_DIR"]
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache, "pyviz", "telemetry")
+
+
+# The running totals for one stage, for the snapshot.
+class _StageTotals:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def add(self, seconds, ok):
+        self.count += 1
+        self.total += seconds
+        if not ok:
+            self.errors += 1
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[index] += 1
+
+
+# One stage being timed. See `Telemetry.span`.
+class Span:
+    def __init__(self, telemetry, name, session, trace, attributes):
+        self.telemetry = telemetry
+        self.name = name
+        self.session = session
+        self.trace = trace
+        self.attributes = attributes
+
+    # Add a detail to the span, like how many results a search found.
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.timestamp = time.time()
+        return self
+
+    def __exit__(self, error_type, error, error_traceback):
+        seconds = time.perf_counter() - self.start
+        if error_type is not None:
+            self.attributes["error"] = error_type.__name__
+        self.telemetry.record(self.name, seconds, self.session, self.trace, error_type is None, self.timestamp, **self.attributes)
+        return False
+
+
+# The telemetry recorder itself.
+class Telemetry:
+
+    # Constructor function
+    def __init__(self, directory=None, enabled=True):
+        self.directory = directory or default_directory()
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.spans_file = None
+        self.stages = {}
+        self.last_snapshot = 0.0
+
+        # When each trace started, so we can tell how long the whole trip took. Oldest first. See `MAX_TRACES`.
+        self.trace_starts = OrderedDict()
+
+    # Start a new trace. Call this when the user sets things in motion, like pressing "Submit".
+    def new_trace(self):
+        trace = uuid.uuid4().hex[:12]
+        with self.lock:
+            self.trace_starts[trace] = time.perf_counter()
+            while len(self.trace_starts) > MAX_TRACES:
+                self.trace_starts.popitem(last=False)
+        return trace
+
+    # How many seconds since a trace started, or `None` if we don't know about it (or have forgotten it).
+    def since_trace_start(self, trace):
+        with self.lock:
+            start = self.trace_starts.get(trace)
+        if start is None:
+            return None
+        return time.perf_counter() - start
+
+    # Time a stage, like so:
+    #   with telemetry.span("download", session=session.id, trace=session.trace_id):
+    #       ...
+    # If the stage raises an error, the span is marked as failed, and the error carries on as usual.
+    def span(self, name, session=None, trace=None, **attributes):
+        return Span(self, name, session, trace, attributes)
+
+    # Write down a stage that has already been timed.
+    # Use this for stages that start in one place and end in another, like the time to the first frame.
+    def record(self, name, seconds, session=None, trace=None, ok=True, timestamp=None, **attributes):
+        if not self.enabled:
+            return
+
+        line = {
+            "time": timestamp if timestamp is not None else time.time() - seconds,
+            "stage": name,
+            "seconds": round(seconds, 6),
+            "ok": ok,
+            "session": session,
+            "trace": trace,
+        }
+        if len(attributes) > 0:
+            line["attributes"] = attributes
+
+        with self.lock:
+            self.stages.setdefault(name, _StageTotals()).add(seconds, ok)
+            try:
+                if self.spans_file is None:
+                    os.makedirs(self.directory, exist_ok=True)
+                    self.spans_file = open(os.path.join(self.directory, SPANS_FILE), "a", buffering=1)
+                self.spans_file.write(json.dumps(line, default=str) + "\n")
+            except OSError:
+                # Telemetry must never break the application. If we can't write, we stop trying.
+                self.enabled = False
+                return
+
+            write_snapshot = time.monotonic() - self.last_snapshot >= SNAPSHOT_INTERVAL
+
+        if write_snapshot:
+            self.write_snapshot()
+
+    # The totals for every stage, in Prometheus's text format.
+    def prometheus_text(self):
+        lines = [
+            "# HELP pyviz_stage_seconds How long each stage of a visualization took.",
+            "# TYPE pyviz_stage_seconds histogram",
+        ]
+        with self.lock:
+            stages = sorted(self.stages.items())
+            for name, totals in stages:
+                for bound, count in zip(BUCKETS, totals.buckets):
+                    lines.append("pyviz_stage_seconds_bucket{stage=\"" + name + "\",le=\"" + repr(bound) + "\"} " + str(count))
+                lines.append("pyviz_stage_seconds_bucket{stage=\"" + name + "\",le=\"+Inf\"} " + str(totals.count))
+                lines.append("pyviz_stage_seconds_sum{stage=\"" + name + "\"} " + repr(totals.total))
+                lines.append("pyviz_stage_seconds_count{stage=\"" + name + "\"} " + str(totals.count))
+
+            lines.append("# HELP pyviz_stage_errors_total How many times each stage failed.")
+            lines.append("# TYPE pyviz_stage_errors_total counter")
+            for name, totals in stages:
+                lines.append("pyviz_stage_errors_total{stage=\"" + name + "\"} " + str(totals.errors))
+        return "\n".join(lines) + "\n"
+
+    # Write the snapshot file.
+    # It is written to a separate file first, and then swapped in, so whoever reads it never sees half of one.
+    # That file gets a name of its own every time, so two snapshots written at once (from two threads,
+    # or two copies of PyViz) can't write over each other's half-written file.
+    def write_snapshot(self):
+        if not self.enabled:
+            return
+        self.last_snapshot = time.monotonic()
+        path = os.path.join(self.directory, METRICS_FILE)
+        temporary_path = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            descriptor, temporary_path = tempfile.mkstemp(prefix="." + METRICS_FILE + "-", dir=self.directory)
+            with os.fdopen(descriptor, "w") as snapshot_file:
+                snapshot_file.write(self.prometheus_text())
+            os.replace(temporary_path, path)
+        except OSError:
+            if temporary_path is not None:
+                try:
+                    os.remove(temporary_path)
+                except OSError:
+                    pass
+
+    # Write the final snapshot and close the files. Called when the application shuts down.
+    def close(self):
+        if len(self.stages) > 0:
+            self.write_snapshot()
+        with self.lock:
+            if self.spans_file is not None:
+                self.spans_file.close()
+                self.spans_file = None
+
+
+# The one recorder that the whole application shares.
+telemetry = Telemetry(enabled=not os.environ.get("PYVIZ_NO_TELEMETRY"))
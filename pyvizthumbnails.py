@@ -0,0 +1,133 @@
+# PyViz, a Python music visualizer.
+# Program by Austin Pringle, Caleb Rachocki, & Caleb Ruby
+# Pennsylvania Western University, California
+#
+# pyvizthumbnails.py
+# This file contains the thumbnail pipeline and the shared thumbnail cache.
+# Thumbnails are fetched, decoded and shrunk entirely in memory, and then kept around
+# as ready-to-draw textures for both the search results page and the customizer page.
+
+# `io` lets us treat a chunk of bytes in memory as if it were a file.
+import io
+
+# The cache can be filled from several threads at once, so we guard it with a lock.
+import threading
+
+# An OrderedDict remembers the order things were added in.
+# We use that to throw out the oldest thumbnails once the cache is full.
+from collections import OrderedDict
+
+# Explanation of these imports is in the `pyvizapp.py` file
+# `Gdk` is the part of Gtk that deals with drawing. We use it to make textures.
+import gi
+gi.require_version("Gtk", "4.0")
+gi.require_version("Gdk", "4.0")
+from gi.repository import GLib, Gdk
+
+# Used to decode whatever image format YouTube hands us (usually .webp or .jpg)
+from PIL import Image
+
+# Every thumbnail in the UI is shown in a 352px x 240px box.
+# There is no point in keeping any more pixels than that around.
+THUMBNAIL_WIDTH = 352
+THUMBNAIL_HEIGHT = 240
+
+# The cache holds on to this many thumbnails before it starts forgetting the oldest ones.
+# At 352x240 RGB, each one is roughly 250KB.
+THUMBNAIL_CACHE_SIZE = 64
+
+
+# Pick the URL of the thumbnail we want out of a yt-dlp info dictionary.
+def get_thumbnail_url(info):
+
+    # Most of the time yt-dlp gives us the "best" thumbnail directly.
+    if info.get("thumbnail"):
+        return info["thumbnail"]
+
+    # Otherwise, it gives us a list of thumbnails, sorted from worst to best.
+    # We take the best one.
+    thumbnails = info.get("thumbnails") or []
+    if len(thumbnails) > 0:
+        return thumbnails[-1].get("url")
+
+    # Quick search results sometimes don't list any thumbnails at all.
+    # Every YouTube video has one at a predictable address, though.
+    if info.get("id"):
+        return "https://i.ytimg.com/vi/" + info["id"] + "/hqdefault.jpg"
+
+    return None
+
+
+# Turn the raw bytes of an image file into a Gdk texture of display size.
+# This does not touch the disk, and it is safe to call from a worker thread.
+def decode_thumbnail(data):
+
+    # Open the image straight from memory.
+    image = Image.open(io.BytesIO(data))
+
+    # For JPEGs, this asks the decoder to skip detail we are going to throw away anyway.
+    # It is a no-op for other formats.
+    image.draft("RGB", (THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT))
+
+    # Shrink the image (keeping its aspect ratio) to fit the display box.
+    # We only ever do this once per thumbnail.
+    image = image.convert("RGB")
+    image.thumbnail((THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT), Image.Resampling.BILINEAR)
+
+    # Wrap the raw pixels in a texture that Gtk can draw directly.
+    # The stride is the number of bytes in each row: 3 bytes (R, G, B) per pixel.
+    width, height = image.size
+    return Gdk.MemoryTexture.new(width, height, Gdk.MemoryFormat.R8G8B8, GLib.Bytes.new(image.tobytes()), width * 3)
+
+
+# This is the shared, in-process thumbnail cache.
+# It maps a video ID to the texture of its thumbnail.
+class ThumbnailCache:
+
+    # Constructor function
+    def __init__(self, max_entries=THUMBNAIL_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.textures = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Look up a thumbnail. Returns `None` if we don't have it.
+    def get(self, video_id):
+        with self.lock:
+            texture = self.textures.get(video_id)
+
+            # Mark this thumbnail as recently used, so it is the last to be thrown out.
+            if texture is not None:
+                self.textures.move_to_end(video_id)
+
+            return texture
+
+    # Put a thumbnail in the cache, throwing out the oldest ones if we are full.
+    def put(self, video_id, texture):
+        with self.lock:
+            self.textures[video_id] = texture
+            self.textures.move_to_end(video_id)
+            while len(self.textures) > self.max_entries:
+                self.textures.popitem(last=False)
+
+    # Get the thumbnail for a video, fetching and decoding it if we don't have it yet.
+    # `info` is the yt-dlp info dictionary of the video.
+    # `ydl` is the `YoutubeDL` object that produced it. We borrow its network connection.
+    def load(self, info, ydl):
+        texture = self.get(info["id"])
+        if texture is not None:
+            return texture
+
+        url = get_thumbnail_url(info)
+        if url is None:
+            return None
+
+        # Download the thumbnail straight into memory and decode it.
+        with ydl.urlopen(url) as response:
+            texture = decode_thumbnail(response.read())
+
+        self.put(info["id"], texture)
+        return texture
+
+
+# The one cache that every page shares.
+thumbnail_cache = ThumbnailCache()
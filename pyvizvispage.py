@@ -6,43 +6,91 @@
 # This file contains the loading page for our custom visualizer.
 # This page has the logic to download the song and create our custom visualization
 
-# `os` is used to access files in a system-independent way.
-import os
-
 # Explanation of these imports is in the `pyvizapp.py` file
 import gi
 gi.require_version("Gtk", "4.0")
 gi.require_version("Adw", "1")
 from gi.repository import GLib, Gtk, Adw
 
-# Hey it's the YouTube downloader again! See `pyvizapp.py` for more information.
-from yt_dlp import YoutubeDL
+# Hey it's the YouTube downloader again! See `pyvizdownloader.py` for more information.
+import pyvizdownloader
+
+# We hand the download of the audio to the background job scheduler
+import pyvizscheduler
+
+# Each visualization runs in its own session, with its own private copy of the audio.
+# See `pyvizsession.py` for more information.
+import pyvizsession
+
+# We time how long it takes for the first frame to show up. See `pyviztelemetry.py`.
+import pyviztelemetry
 
-# We run the download of the audio asynchronously 
-import threading
+# For measuring time.
+import time
 
-import visualizerengine
+# The visualizer engine itself lives in `visualizerengine.py`.
+# It loads numpy and pygame, which take a moment, so we only import it once it is needed.
+# The analysis, and the visualizer's own window, run in processes of their own. See `pyvizvisprocess.py`.
+
+# When playing a playlist, we wait this many seconds after a song starts before getting the next one ready,
+# so the work of getting it ready doesn't land on top of the visualizer starting up.
+PREPARE_DELAY = 5
 
 # Like all the other pages, the vis page inherits from AdwNavigationPage
 class PyVizVisPage(Adw.NavigationPage):
     # Constructor function 
-    def __init__(self, url, navigation_view, fg_color, bg_color):
+    # If `embedded` is true, the visualizer is shown right on this page, instead of in its own window.
+    # `backend` is how the song is analyzed, one of `visualizerengine.ANALYSIS_BACKENDS`.
+    # If `stream` is true, the visualizer is also shared with other screens. See `pyvizstream.py`.
+    # `trace_id` ties this visualization to the press of "Submit" that led to it. See `pyviztelemetry.py`.
+    # `video` is what we know about the song, as a `pyvizdownloader.VideoInfo`.
+    # `queue` is the rest of a playlist, as more `VideoInfo`s, to play after this song.
+    # `bar_style` is how the bars look, one of `visualizerengine.BAR_STYLES`, or `None` for the default one.
+    def __init__(self, video, navigation_view, fg_color, bg_color, embedded=True, backend="librosa", stream=False, trace_id=None, queue=(), bar_style=None):
         # Use the parent class's constructor logic.
         super().__init__()
 
-
-
         self.fg_color = fg_color
         self.bg_color = bg_color
+        self.embedded = embedded
+        self.backend = backend
+        self.stream = stream
+        self.bar_style = bar_style
+
+        # The frame streamer, while the visualizer is being streamed.
+        self.streamer = None
+
+        # The songs still to come, and what is playing them.
+        # Only the "librosa" analyzer can move from one song to the next. The live analyzer plays just the first one.
+        self.queue = list(queue) if backend == "librosa" else []
+        self.playback = None
+        self.tracks_prepared = 0
+
+        # In window mode, the process that runs the visualizer's window, and how it was doing when it last said.
+        self.visualizer_process = None
+        self.frame_stats = None
+        self.navigation_view = navigation_view
+
+        # When the user clicked "Visualize!", for timing how long the first frame takes.
+        self.created = time.perf_counter()
+
+        # The widget that shows the visualizer on this page, once it is ready,
+        # and the seek bar underneath it, which shows the song's waveform. See `pyvizwaveform.py`.
+        self.vis_widget = None
+        self.seek_bar = None
+        self.seek_bar_timer = None
+        self.envelope = None
 
         # Set the title of this page
         self.set_title("Visualizer Output")
 
         # Explanation for how these widgets work can be found in `pyvizapp.py`
-        toolbar_view = Adw.ToolbarView()
-        header_bar = Adw.HeaderBar()
-        header_bar.set_show_back_button(False)
-        toolbar_view.add_top_bar(header_bar)
+        # We hold on to the toolbar view and header bar, because the embedded visualizer replaces
+        # the page's content once it is ready.
+        self.toolbar_view = Adw.ToolbarView()
+        self.header_bar = Adw.HeaderBar()
+        self.header_bar.set_show_back_button(False)
+        self.toolbar_view.add_top_bar(self.header_bar)
 
         # Create a vertical box to hold the main content of this page.
         # Space its children out by 16 px. Vertically center it.
@@ -59,59 +107,360 @@ class PyVizVisPage(Adw.NavigationPage):
         # 2 blocks of text to explain what is happening behind the screen...
 
         # ...a big "downloading message"
-        loading_text = Gtk.Label()
-        loading_text.set_label("\nPlease wait...\n\nYour song is being downloaded.")
-        loading_text.set_justify(Gtk.Justification.CENTER)
-        loading_text.add_css_class("title-1")
-        mainbox.append(loading_text)
+        self.loading_text = Gtk.Label()
+        self.loading_text.set_label("\nPlease wait...\n\nYour song is being downloaded.")
+        self.loading_text.set_justify(Gtk.Justification.CENTER)
+        self.loading_text.add_css_class("title-1")
+        mainbox.append(self.loading_text)
+
+        # A progress bar for the download. It shows up once the download gets going.
+        self.progress_bar = Gtk.ProgressBar()
+        self.progress_bar.set_show_text(True)
+        self.progress_bar.set_margin_start(64)
+        self.progress_bar.set_margin_end(64)
+        self.progress_bar.set_visible(False)
+        mainbox.append(self.progress_bar)
 
-        # ...a message explaining that the visualizer is to pop out in its own window.
+        # ...a message explaining where the visualizer is going to show up.
         explain_text = Gtk.Label()
-        explain_text.set_label("Your visualizer will start in its own window, momentarily.")
+        if embedded:
+            explain_text.set_label("Your visualizer will start right here, momentarily.")
+        else:
+            explain_text.set_label("Your visualizer will start in its own window, momentarily.")
         explain_text.set_justify(Gtk.Justification.CENTER)
         mainbox.append(explain_text)
 
         # Set the mainbox as the content widget of the toolbar view
-        toolbar_view.set_content(mainbox)
+        self.toolbar_view.set_content(mainbox)
 
         # Set the toolbar view as the child of the nav page
-        self.set_child(toolbar_view)
+        self.set_child(self.toolbar_view)
 
-        # Start the thread to download the video.
-        download_thread = threading.Thread(target=self.download, args=(url, navigation_view))
-        download_thread.start()
+        # When the user leaves the page, stop the embedded visualizer.
+        self.connect("hidden", self._page_hidden)
 
-    def download(self, url, navigation_view):
+        # This visualization's session. It owns the downloaded audio,
+        # so other visualizations running at the same time can't overwrite it.
+        self.session = pyvizsession.PyVizSession(trace_id)
+
+        # Have the scheduler download the video in the background.
+        # The user is waiting on this page for it, so it gets top priority.
+        # Once it is done, the scheduler calls `_downloaded` on the GUI's main loop.
+        self.session.submit("download", self.download, video,
+            priority=pyvizscheduler.PRIORITY_USER,
+            on_done=lambda result: self._downloaded(navigation_view),
+            on_error=lambda error: self.session.close())
+
+    # This function downloads the audio. It is run in the background by the scheduler.
+    def download(self, job, video):
         
-        # Downloader options dictionary
-        ydl_opts = {
-            # Ask youtube to output a high-quality .wav file
-            'format': 'wav/bestaudio/best',
-
-            # Output the file to a local folder called "downloads\audio"
-            'paths': {'home' : os.path.join("downloads", "audio")},
-
-            # Name the file cur_audio.wav
-            'outtmpl' : "cur_audio",
-
-            # Sometimes YouTube fails to properly give us the file we asked for.
-            # Just to be safe, we attempt to convert the output to .wav
-            'postprocessors': [{  # Extract audio using ffmpeg
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'wav',
-            }]
-        }
-
-        # Download the audio in question
-        YoutubeDL(ydl_opts).download(url)
+        # Download the audio in question, using a long-lived session from the shared downloader service.
+        # Output the file to this visualization's private folder, and name the file audio.wav
+        # Progress updates are passed on to `_download_progress`, on the GUI's main loop.
+        with self.session.span("download"):
+            pyvizdownloader.downloader.download_audio(video.url, self.session.folder(), "audio",
+                on_progress=lambda fraction, downloaded, total: job.post(self._download_progress, fraction, downloaded, total), info=video)
         
-        # Remove this page from the navigation view when the loading is complete.
-        navigation_view.pop()
+        return
+
+    # The download made some progress. We end up here, on the GUI's main loop, a few times a second at most.
+    # Until we know how big the file is, the progress bar just bounces back and forth.
+    def _download_progress(self, fraction, downloaded, total):
+        self.progress_bar.set_visible(True)
+        if fraction is None:
+            self.progress_bar.pulse()
+            self.progress_bar.set_text(format(downloaded / 1048576, ".1f") + " MB")
+        else:
+            self.progress_bar.set_fraction(fraction)
+            self.progress_bar.set_text(format(downloaded / 1048576, ".1f") + " MB of " + format(total / 1048576, ".1f") + " MB")
+
+    # Once the download is done, we end up here, back on the GUI's main loop.
+    def _downloaded(self, navigation_view):
+
+        # The embedded visualizer stays on this page. We just need the song analyzed first.
+        # That is slow, so the scheduler does it in the background, on its analysis worker.
+        self.progress_bar.set_visible(False)
+
+        if self.embedded:
+            self.loading_text.set_label("\nPlease wait...\n\nYour song is being analyzed.")
+            self.session.submit("analysis", self.analyze,
+                priority=pyvizscheduler.PRIORITY_USER,
+                on_done=self._show_embedded,
+                on_error=self._visualizer_failed)
+            return
 
-        #Visualize the audio!
-        self.viz()
+        # Visualize the audio!
+        # The visualizer runs its own window, in its own process, until it is closed. See `pyvizvisprocess.py`.
+        # The analysis worker starts it and analyzes the song. Then a "visualizer" worker of its own keeps an eye on it,
+        # so the analysis worker is free for the next song while the window is open. We stay on this page until its first frame,
+        # so the user can see how it's going (or what went wrong).
+        # Once the window is closed (or if anything goes wrong), the session is over.
+        self.loading_text.set_label("\nPlease wait...\n\nYour song is being analyzed.")
+        self.session.submit("analysis", self.prepare_window,
+            priority=pyvizscheduler.PRIORITY_USER,
+            on_done=self._window_ready,
+            on_error=self._visualizer_failed)
         
         return
 
-    def viz(self):
-        visualizerengine.run_audio_visualizer(os.path.join("downloads","audio","cur_audio.wav"), self.fg_color, self.bg_color) 
\ No newline at end of file
+    # Start the visualizer process, and analyze the song for it. It is run in the background by the scheduler.
+    # The visualizer process starts loading while the song is analyzed, in an analysis process.
+    # (The live analyzer has nothing to analyze up front. The visualizer process sets it up itself.)
+    def prepare_window(self, job):
+        import pyvizvisprocess
+        self.visualizer_process = pyvizvisprocess.VisualizerProcess(self.session.path("audio.wav"),
+            self.fg_color.to_string(), self.bg_color.to_string(), self.backend, self.stream, playlist=len(self.queue) > 0, bar_style=self.bar_style)
+
+        # If the analysis fails or is cancelled, the visualizer process is left waiting for a song. Send it home.
+        directory = None
+        try:
+            if self.backend == "librosa":
+                with self.session.span("analysis", backend=self.backend):
+                    directory = pyvizvisprocess.analyze(self.session.path("audio.wav"), self.session.path("analysis"), job.check)
+        except Exception:
+            self.visualizer_process.stop()
+            raise
+
+        # From here to the first frame is mostly pygame opening its window.
+        self.analyzed = time.perf_counter()
+        return directory
+
+    # The song is analyzed, and we're back on the GUI's main loop. Hand the window over to its own worker.
+    # If the session ends before that worker gets going, the visualizer process is sent home all the same.
+    def _window_ready(self, directory):
+        self.playback = self.visualizer_process
+        job = self.session.submit("visualizer", self.viz, directory,
+            priority=pyvizscheduler.PRIORITY_USER,
+            on_done=lambda result: self.session.close(),
+            on_error=self._visualizer_failed)
+        job.add_done_callback(lambda job: self.visualizer_process.stop())
+
+    # Run the visualizer in its own window, until it is closed. It is run in the background by the scheduler.
+    # In a playlist, the rest of the songs get handed to the visualizer process.
+    def viz(self, job, directory):
+        self.visualizer_process.play(directory)
+        self.visualizer_process.run(job.check, lambda *message: job.post(self._visualizer_message, *message))
+
+    # The visualizer process said something, and we're back on the GUI's main loop. See `VisualizerProcess`.
+    def _visualizer_message(self, name, *details):
+        if name == "first_frame":
+            self._first_frame()
+            # Remove this page from the navigation view, now that the visualizer is up.
+            self.navigation_view.pop()
+        elif name == "track":
+            self._next_track_started(details[0])
+        elif name == "stats":
+            self.frame_stats = details[0]
+        elif name == "error":
+            self._visualizer_failed(RuntimeError(details[0]))
+        elif name == "done":
+            self.session.record("visualizer_run", details[0]["seconds"], frames=details[0]["frames"],
+                last_fps=self.frame_stats["fps"] if self.frame_stats is not None else None)
+
+    # The visualizer couldn't start, or stopped with an error. If the user is still on this page, tell them.
+    # A song too long to analyze within the memory budget gets its own message (see `AnalysisMemoryError`).
+    def _visualizer_failed(self, error):
+        if not isinstance(error, pyvizscheduler.JobCancelled):
+            if isinstance(error, MemoryError):
+                self.loading_text.set_label("\nSorry!\n\nThis song is too long to analyze on this computer.")
+            else:
+                self.loading_text.set_label("\nSorry!\n\nThe visualizer ran into a problem.")
+            self.header_bar.set_show_back_button(True)
+        self.session.close()
+
+    # Get whatever plays the song. For a playlist, that's a `PlaylistPlayback`, which the rest of the songs get handed to.
+    def create_playback(self, analyzer):
+        import visualizerengine
+        if len(self.queue) > 0:
+            return visualizerengine.PlaylistPlayback(analyzer, self.session.path("audio.wav"), self._track_changed)
+        return visualizerengine.create_playback(analyzer, self.session.path("audio.wav"))
+
+    # Start sharing the visualizer with other screens, if the user asked for it.
+    # If the streamer can't start (say, something else is using its port), the visualizer just runs without it.
+    def start_streamer(self):
+        if not self.stream:
+            return
+        import pyvizstream
+        streamer = pyvizstream.FrameStreamer()
+        try:
+            streamer.start()
+        except OSError:
+            return
+        self.streamer = streamer
+
+    def stop_streamer(self):
+        if self.streamer is not None:
+            self.streamer.stop()
+            self.streamer = None
+
+    # Analyze the song for the embedded visualizer. It is run in the background by the scheduler.
+    # (The live analyzer only gets its pipeline ready here. The real analysis happens as the song plays.)
+    # The seek bar needs the song's envelope pyramid. The "librosa" analyzer makes one along the way,
+    # and for the live analyzer, we make one with a quick pass over the file.
+    # The "librosa" analysis itself runs in an analysis process (see `pyvizvisprocess.py`), so the GUI stays smooth,
+    # and we map its results from the session's folder.
+    def analyze(self, job):
+        import visualizerengine
+        import pyvizenvelope
+        import pyvizvisprocess
+        with self.session.span("analysis", backend=self.backend):
+            if self.backend == "librosa":
+                directory = pyvizvisprocess.analyze(self.session.path("audio.wav"), self.session.path("analysis"), job.check)
+                analyzer = visualizerengine.load_analysis(directory)
+            else:
+                analyzer = visualizerengine.create_analyzer(self.session.path("audio.wav"), self.backend)
+        self.envelope = getattr(analyzer, "envelope", None)
+        if self.envelope is None:
+            with self.session.span("envelope"):
+                self.envelope = pyvizenvelope.build_envelope(self.session.path("audio.wav"), job.check)
+        self.analyzed = time.perf_counter()
+        return analyzer
+
+    # Once the song is analyzed, we end up here, back on the GUI's main loop.
+    # Swap the loading message out for the visualizer itself, and start it.
+    def _show_embedded(self, analyzer):
+        import visualizerengine
+        import pyvizviswidget
+        import pyvizwaveform
+
+        # The same visual as the window gets (see `run_audio_visualizer`). The widget sizes it to fit.
+        visualizer = visualizerengine.create_visual(None, analyzer, self.fg_color, self.bg_color, style=self.bar_style)
+        self.playback = self.create_playback(analyzer)
+        self.start_streamer()
+        self.vis_widget = pyvizviswidget.PyVizVisWidget(visualizer, self.playback, self.streamer, self._quality_changed, self._first_frame)
+
+        # The seek bar goes under the visualizer. It catches up with the song ten times a second.
+        content = Gtk.Box(orientation = Gtk.Orientation.VERTICAL)
+        content.append(self.vis_widget)
+        self.seek_bar = pyvizwaveform.PyVizWaveform(48, self._seek)
+        self.seek_bar.set_envelope(self.envelope)
+        content.append(self.seek_bar)
+        self.seek_bar_timer = GLib.timeout_add(100, self._update_seek_bar)
+        self.toolbar_view.set_content(content)
+
+        # The header bar shows the quality level the visualizer is running at.
+        self.window_title = Adw.WindowTitle.new(self.get_title(), self.vis_widget.governor.describe())
+        self.header_bar.set_title_widget(self.window_title)
+
+        # Now that there is something to look at, let the user go back whenever they like.
+        self.header_bar.set_show_back_button(True)
+
+        self.vis_widget.start()
+
+    # The first frame has been drawn. Write down how long everything took to get here:
+    # from the end of the analysis (starting up the visualizer itself), from the click on "Visualize!",
+    # and from the press of "Submit".
+    def _first_frame(self):
+        now = time.perf_counter()
+        mode = "embedded" if self.embedded else "window"
+        self.session.record("visualizer_start", now - self.analyzed, mode=mode)
+        self.session.record("first_frame", now - self.created, mode=mode)
+        since_submit = pyviztelemetry.telemetry.since_trace_start(self.session.trace_id)
+        if since_submit is not None:
+            self.session.record("submit_to_first_frame", since_submit, mode=mode)
+
+        # The first song is playing. Start getting the next one ready.
+        if len(self.queue) > 0:
+            GLib.timeout_add_seconds(PREPARE_DELAY, self._prepare_next)
+
+    # The playlist moved on to its next song. This is called from whatever thread is drawing the visualizer,
+    # so we hop over to the GUI's main loop before touching anything.
+    def _track_changed(self, title):
+        GLib.idle_add(self._next_track_started, title)
+
+    # The next song started, and we're back on the GUI's main loop.
+    # Show its title, and in a little while, start getting the one after it ready.
+    # (In window mode, the visualizer process tells us about it instead, in `_visualizer_message`.)
+    def _next_track_started(self, title):
+        if self.embedded and title is not None:
+            self.window_title.set_title(title)
+        if self.seek_bar is not None:
+            self.seek_bar.set_envelope(self.playback.analyzer.envelope)
+        GLib.timeout_add_seconds(PREPARE_DELAY, self._prepare_next)
+        return GLib.SOURCE_REMOVE
+
+    # Get the next song of the playlist ready, while the current one plays.
+    # Only one song is ever got ready ahead of time. The next one waits until this one starts playing.
+    # All of this is background work at the lowest priority: the download goes through the usual download
+    # workers, and the analysis runs on the "prepare" worker, which the operating system runs at a lower priority
+    # than everything else. See `pyvizscheduler.py`.
+    def _prepare_next(self):
+        if self.session.closed:
+            return GLib.SOURCE_REMOVE
+
+        # That was the last song.
+        if len(self.queue) == 0:
+            self.playback.finish()
+            return GLib.SOURCE_REMOVE
+
+        video = self.queue.pop(0)
+        self.tracks_prepared += 1
+        name = "track-" + str(self.tracks_prepared)
+        self.session.submit("download", self.prepare_download, video, name,
+            priority=pyvizscheduler.PRIORITY_PREFETCH,
+            on_done=lambda result: self._prepare_downloaded(name, video.title),
+            on_error=self._prepare_failed)
+        return GLib.SOURCE_REMOVE
+
+    # Download the next song. It is run in the background by the scheduler.
+    def prepare_download(self, job, video, name):
+        with self.session.span("prepare_download", track=self.tracks_prepared):
+            pyvizdownloader.downloader.download_audio(video.url, self.session.folder(), name, info=video)
+
+    # The next song is downloaded, and we're back on the GUI's main loop. Analyze it.
+    def _prepare_downloaded(self, name, title):
+        path = self.session.path(name + ".wav")
+        self.session.submit("prepare", self.prepare_track, path, name,
+            priority=pyvizscheduler.PRIORITY_PREFETCH,
+            on_done=lambda analysis: self.playback.add(analysis, path, title),
+            on_error=self._prepare_failed)
+
+    # Analyze the next song, and read it through once so the mixer finds it in memory.
+    # It is run in the background by the scheduler. The analysis itself runs in the low priority "prepare"
+    # analysis process (see `pyvizvisprocess.py`), and is saved in the session's folder.
+    # In window mode, the visualizer process loads the analysis itself, so all it needs is that folder,
+    # and nothing of the visualizer is loaded into this process. (The analysis just read the whole song, too.)
+    def prepare_track(self, job, path, name):
+        import pyvizvisprocess
+        with self.session.span("prepare_analysis", track=self.tracks_prepared):
+            directory = pyvizvisprocess.analyze(path, self.session.path(name + "-analysis"), job.check, kind="prepare")
+        if not self.embedded:
+            return directory
+        import visualizerengine
+        analyzer = visualizerengine.load_analysis(directory)
+        job.check()
+        visualizerengine.prebuffer(path, job.check)
+        return analyzer
+
+    # The next song couldn't be got ready. Skip it, and try the one after.
+    # (If the session is over, its jobs were cancelled on purpose, and `_prepare_next` does nothing.)
+    def _prepare_failed(self, error):
+        self._prepare_next()
+
+    # Keep the seek bar's position marker up with the song.
+    def _update_seek_bar(self):
+        self.seek_bar.set_position(self.vis_widget.position)
+        return GLib.SOURCE_CONTINUE
+
+    # The user clicked somewhere on the seek bar. Jump there, as long as the song is still going.
+    def _seek(self, position):
+        if self.vis_widget.tick_id is not None:
+            self.playback.seek(position)
+
+    # The visualizer changed its quality level, to keep up with the screen.
+    def _quality_changed(self, description):
+        self.window_title.set_subtitle(description)
+
+    # When the user leaves the page, stop the embedded visualizer, and end the session.
+    # (In window mode, the page leaves on its own once the visualizer is up, and the window carries on by itself,
+    # so there is nothing to do here.)
+    def _page_hidden(self, page):
+        if not self.embedded:
+            return
+        if self.vis_widget is not None:
+            self.vis_widget.stop()
+        if self.seek_bar_timer is not None:
+            GLib.source_remove(self.seek_bar_timer)
+            self.seek_bar_timer = None
+        self.stop_streamer()
+        self.session.close() 
\ No newline at end of file
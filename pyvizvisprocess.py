@@ -0,0 +1,356 @@
+# PyViz, a Python music visualizer.
+# Program by Austin Pringle, Caleb Rachocki, & Caleb Ruby
+# Pennsylvania Western University, California
+#
+# pyvizvisprocess.py
+# This file runs the built-in visualizer, and its analysis, in processes of their own.
+#
+# Python only runs one thread of Python code at a time (the "GIL"). When the analysis or the visualizer's
+# frame loop ran on a thread inside the app, they took turns with GTK, and on our 2-core kiosks
+# the app's window would stutter while a song was analyzed, and the visualizer would drop frames
+# whenever the app had something to do. Separate processes don't take turns: each gets a core of its own.
+#
+# There are two kinds of process:
+#
+# - Analysis processes, which analyze songs. They stay around, so librosa only has to be loaded and warmed up once
+#   (see `warm_up`). Each one saves its analysis to the session's folder (see `AudioAnalyzer.save`),
+#   and whoever asked for it maps it straight from there (see `load_analysis`), so the big spectrogram
+#   never has to be copied from one process to another.
+#   There is one for songs the user is waiting on ("analysis"), and one for getting the next song of a playlist
+#   ready ("prepare"). The second one runs at a lower priority, just like the scheduler's "prepare" worker.
+#
+# - The visualizer process (`VisualizerProcess`), which opens the visualizer's window and runs it until it is closed.
+#   It talks to the page that started it over two small pipes: the page sends it commands
+#   (play, stop, add a song, that was the last song), and it sends back how it is doing
+#   (ready, first frame, frame stats, the song changed, errors, done).
+
+# `os` is used to lower the priority of the "prepare" analysis process.
+import os
+
+# For keeping track of the analysis processes from more than one thread at a time.
+import threading
+
+# For timing frames.
+import time
+
+# The analysis processes are run by a `ProcessPoolExecutor`, which hands work to them and results back.
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+
+# "spawn" starts every process fresh, instead of copying the app into it.
+# A copy of a running GTK app (with all of its threads) is not something we want to run code in.
+import multiprocessing
+
+# For the priorities of the analysis processes, and for stopping early when a job is cancelled.
+import pyvizscheduler
+
+# The way new processes are started. See above.
+CONTEXT = multiprocessing.get_context("spawn")
+
+# How often, in seconds, we check whether the job waiting on a process has been cancelled.
+POLL_INTERVAL = 0.1
+
+# How often, in seconds, the visualizer process sends back its frame stats.
+STATS_INTERVAL = 1.0
+
+# How long, in seconds, the visualizer process gets to close its window after being told to stop,
+# before it is stopped the hard way.
+STOP_TIMEOUT = 5.0
+
+# Normally, other screens see exactly what the window shows. Setting the `PYVIZ_STREAM_VISUAL` environment variable
+# to one of `visualizerengine.VISUALS` gives them that look instead, drawn at this size,
+# from the same analysis as the window (see `FeatureBus`).
+STREAM_VISUAL = os.environ.get("PYVIZ_STREAM_VISUAL") or None
+STREAM_SIZE = (1280, 720)
+
+# The analysis processes, by kind ("analysis" or "prepare"). Each is started the first time it is needed.
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+# Get the analysis process of a kind, starting it if needed.
+def _pool(kind):
+    with _pools_lock:
+        if kind not in _pools:
+            _pools[kind] = concurrent.futures.ProcessPoolExecutor(1, mp_context=CONTEXT,
+                initializer=_start_analysis_process, initargs=(pyvizscheduler.POOL_NICENESS.get(kind, 0),))
+        return _pools[kind]
+
+
+# Wait for an analysis process to finish something, calling `check` every now and then,
+# so the job waiting on it can be cancelled.
+# If it is cancelled after the process has started on it, and `stop` is true, the process is stopped (see `_stop`).
+def _wait(kind, future, check, stop=True):
+    try:
+        while True:
+            try:
+                return future.result(timeout=POLL_INTERVAL)
+            except concurrent.futures.TimeoutError:
+                pass
+            if check is not None:
+                try:
+                    check()
+                except pyvizscheduler.JobCancelled:
+                    # If it hasn't started yet, it never will.
+                    if not future.cancel() and not future.done() and stop:
+                        _stop(kind)
+                    raise
+    except BrokenProcessPool:
+        # The process died (most likely, it ran out of memory). Forget it, so the next song gets a fresh one.
+        with _pools_lock:
+            _pools.pop(kind, None)
+        raise
+
+
+# Stop an analysis process in the middle of whatever it is doing, and wait for it to be gone.
+# A song can't be stopped partway through its analysis, and left to finish on its own, it would hold up
+# the next song the user is waiting on, and then write into a session folder that might already be cleaned up.
+# Like when a process dies, it is forgotten, so the next song gets a fresh one.
+def _stop(kind):
+    with _pools_lock:
+        pool = _pools.pop(kind, None)
+    if pool is None:
+        return
+
+    # `ProcessPoolExecutor` has no way to stop its processes before Python 3.14's `terminate_workers`,
+    # so we stop them ourselves.
+    processes = list((pool._processes or {}).values())
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+# Load and warm up the analyzer in the "analysis" process, so the first real song doesn't pay for it.
+# See `warm_up` in `visualizerengine.py`.
+# The warm-up is pushed aside whenever a real song comes along, and it writes nothing, so it's never stopped partway:
+# the song just waits for it in the same process, and gets that process warmed up.
+def warm_up(check=None):
+    _wait("analysis", _pool("analysis").submit(_warm_up_analysis_process), check, stop=False)
+
+
+# Analyze a song in an analysis process, and save the analysis to `directory`.
+# `kind` is which analysis process does it, "analysis" or "prepare". `tier` is one of the `ANALYSIS_TIERS`.
+# Returns `directory`, for `load_analysis` in `visualizerengine.py`, or for handing to the visualizer process.
+def analyze(path, directory, check=None, kind="analysis", tier=None):
+    _wait(kind, _pool(kind).submit(_analyze_in_process, path, directory, tier), check)
+    return directory
+
+
+# Stop all of the analysis processes. Anything they haven't started on yet is dropped.
+def shutdown():
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+# These run inside the analysis processes.
+
+def _start_analysis_process(niceness):
+    if niceness > 0:
+        try:
+            os.nice(niceness)
+        except (AttributeError, OSError):
+            pass
+
+def _warm_up_analysis_process():
+    import visualizerengine
+    visualizerengine.warm_up()
+
+def _analyze_in_process(path, directory, tier):
+    import visualizerengine
+    visualizerengine.AudioAnalyzer(path, tier).save(directory)
+
+
+# The built-in visualizer's window, running in a process of its own.
+# `path` is the song's .wav file, `bar_color` and `bg_color` are "rgb(r,g,b)" strings,
+# `backend` is one of `visualizerengine.ANALYSIS_BACKENDS`, and if `stream` is true, the visualizer is also
+# shared with other screens (see `pyvizstream.py`). If `playlist` is true, more songs are going to be added to it.
+# `bar_style` is one of `visualizerengine.BAR_STYLES`, or `None` for the default one.
+#
+# The process starts loading right away, while the song is still being analyzed. Once the analysis is done,
+# `play` starts the window. `run` then waits on it, passing along everything it sends back, until the window is closed.
+class VisualizerProcess:
+    def __init__(self, path, bar_color, bg_color, backend="librosa", stream=False, playlist=False, bar_style=None):
+        self.settings = {
+            "path": path,
+            "bar_color": bar_color,
+            "bg_color": bg_color,
+            "backend": backend,
+            "stream": stream,
+            "playlist": playlist,
+            "bar_style": bar_style,
+        }
+
+        # Commands go one way, and status comes back the other. Each pipe has a receiving end and a sending end.
+        commands_in, self.commands = CONTEXT.Pipe(duplex=False)
+        self.status, status_out = CONTEXT.Pipe(duplex=False)
+
+        # Commands can come from the GUI's main loop and from the background worker at the same time.
+        self.lock = threading.Lock()
+
+        self.process = CONTEXT.Process(target=_visualizer_main, args=(self.settings, commands_in, status_out), daemon=True)
+        self.process.start()
+
+        # The process has its own copies of these ends now. Closing ours means we notice when it goes away.
+        commands_in.close()
+        status_out.close()
+
+    def _send(self, *command):
+        with self.lock:
+            try:
+                self.commands.send(command)
+            except OSError:
+                # It's already gone.
+                pass
+
+    # Start the window. `directory` is where the analysis was saved (see `analyze`),
+    # or `None` for the live analyzer, which the visualizer process sets up itself.
+    def play(self, directory):
+        self._send("play", directory)
+
+    # Add a song to the playlist, like `PlaylistPlayback.add`. `directory` is where its analysis was saved (see `analyze`).
+    def add(self, directory, filename, title=None):
+        self._send("add", directory, filename, title)
+
+    # There won't be any more songs, like `PlaylistPlayback.finish`.
+    def finish(self):
+        self._send("finish")
+
+    # Close the window, and wait for the process to end. If it doesn't end in time, end it the hard way.
+    def stop(self):
+        self._send("stop")
+        self.process.join(STOP_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+    # Wait for the window to be closed. Everything the process sends back is passed to `on_message`,
+    # as a name followed by its details. `check` is called every now and then, and if it raises
+    # (say, because the job was cancelled), the window is closed.
+    def run(self, check, on_message):
+        finished = False
+        try:
+            while not finished:
+                if self.status.poll(POLL_INTERVAL):
+                    try:
+                        message = self.status.recv()
+                    except EOFError:
+                        break
+                    on_message(*message)
+                    finished = message[0] in ("done", "error")
+                elif not self.process.is_alive():
+                    break
+                check()
+        finally:
+            self.stop()
+
+        if not finished:
+            raise RuntimeError("the visualizer stopped unexpectedly (exit code " + str(self.process.exitcode) + ")")
+
+
+# This is the visualizer process itself.
+def _visualizer_main(settings, commands, status):
+    def _report(*message):
+        try:
+            status.send(message)
+        except OSError:
+            # The app is gone. There's nobody left to tell.
+            pass
+
+    streamer = None
+    try:
+        import visualizerengine
+        import pygame
+
+        # Everything is loaded. Wait for the song to be ready.
+        _report("ready")
+        try:
+            command = commands.recv()
+        except EOFError:
+            return
+        if command[0] != "play":
+            return
+
+        path = settings["path"]
+        if command[1] is not None:
+            analyzer = visualizerengine.load_analysis(command[1])
+        else:
+            analyzer = visualizerengine.create_analyzer(path, settings["backend"])
+
+        if settings["stream"]:
+            import pyvizstream
+            streamer = pyvizstream.FrameStreamer()
+            try:
+                streamer.start()
+            except OSError:
+                # Just like the embedded visualizer, the window runs without it.
+                streamer = None
+
+        playback = None
+        if settings["playlist"]:
+            playback = visualizerengine.PlaylistPlayback(analyzer, path, lambda title: _report("track", title))
+
+        # Commands that come in while the window is open. They are looked at between frames.
+        def _command(command):
+            if command[0] == "stop":
+                pygame.event.post(pygame.event.Event(pygame.QUIT))
+            elif command[0] == "add" and playback is not None:
+                playback.add(visualizerengine.load_analysis(command[1]), command[2], command[3])
+            elif command[0] == "finish" and playback is not None:
+                playback.finish()
+
+        # Frame stats: how many frames, and how long their work took, since the last report.
+        governor = visualizerengine.FrameGovernor()
+        frame_times = []
+        totals = {"frames": 0, "started": None, "last_report": None}
+
+        def _on_frame(frame_time):
+            now = time.perf_counter()
+            if totals["started"] is None:
+                totals["started"] = totals["last_report"] = now
+            frame_times.append(frame_time)
+            totals["frames"] += 1
+            if now - totals["last_report"] >= STATS_INTERVAL:
+                _report("stats", {
+                    "fps": len(frame_times) / (now - totals["last_report"]),
+                    "frame_ms": sum(frame_times) / len(frame_times) * 1000,
+                    "slowest_ms": max(frame_times) * 1000,
+                    "quality": governor.describe(),
+                })
+                frame_times.clear()
+                totals["last_report"] = now
+
+            while commands.poll():
+                try:
+                    _command(commands.recv())
+                except EOFError:
+                    # The app is gone. Close the window.
+                    _command(("stop",))
+                    break
+
+        # Other screens can get a look of their own. See `STREAM_VISUAL`.
+        window_streamer, outputs = streamer, []
+        if streamer is not None and STREAM_VISUAL is not None:
+            visual = visualizerengine.create_visual(STREAM_VISUAL, analyzer, settings["bar_color"], settings["bg_color"], *STREAM_SIZE,
+                style=settings["bar_style"])
+            outputs.append(visualizerengine.FrameOutput(visual, *STREAM_SIZE, streamer, max_fps=pyvizstream.DEFAULT_MAX_FPS))
+            window_streamer = None
+
+        try:
+            visualizerengine.run_audio_visualizer(path, settings["bar_color"], settings["bg_color"], settings["backend"], window_streamer,
+                analyzer=analyzer, outputs=outputs, on_first_frame=lambda: _report("first_frame"), playback=playback, bar_style=settings["bar_style"],
+                governor=governor, on_frame=_on_frame)
+        finally:
+            if streamer is not None:
+                streamer.stop()
+
+        seconds = time.perf_counter() - totals["started"] if totals["started"] is not None else 0.0
+        _report("done", {"frames": totals["frames"], "seconds": seconds})
+    except Exception as error:
+        import traceback
+        traceback.print_exc()
+        _report("error", str(error))
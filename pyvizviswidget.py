@@ -0,0 +1,154 @@
+# PyViz, a Python music visualizer.
+# Program by Austin Pringle, Caleb Rachocki, & Caleb Ruby
+# Pennsylvania Western University, California
+#
+# pyvizviswidget.py
+# This file contains the widget that shows our custom visualizer right inside the PyViz window.
+# Instead of opening a pygame window with its own event loop, the visualizer draws each frame
+# into a block of memory, and this widget shows that same block of memory on screen.
+# Gtk tells us when the screen is about to refresh, so we draw exactly one frame per refresh.
+
+# Explanation of these imports is in the `pyvizapp.py` file
+# We also need `cairo`, the drawing library that Gtk uses under the hood.
+# `require_foreign` makes sure Gtk hands us proper `cairo` objects when it asks us to draw.
+import gi
+gi.require_version("Gtk", "4.0")
+gi.require_foreign("cairo")
+from gi.repository import GLib, Gtk
+import cairo
+
+# For timing frames.
+import time
+
+# The visualizer engine itself. See `visualizerengine.py`.
+import visualizerengine
+
+
+# The widget. It is a "drawing area", which is a blank widget that lets us draw whatever we like.
+class PyVizVisWidget(Gtk.DrawingArea):
+
+    # Constructor function
+    # `visualizer` is one of `visualizerengine.VISUALS` (normally a `BarVisualizer`), and `playback` plays the song it visualizes
+    # (see `visualizerengine.create_playback`).
+    # `streamer`, if given, is a `pyvizstream.FrameStreamer` that shares every frame with other screens.
+    # `on_quality_changed`, if given, is called with a short description whenever the quality level changes.
+    # `on_first_frame`, if given, is called once the first frame has been drawn.
+    # `outputs` are any other outputs to feed alongside the widget's own visualizer (see `visualizerengine.FeatureBus`).
+    def __init__(self, visualizer, playback, streamer=None, on_quality_changed=None, on_first_frame=None, outputs=()):
+        super().__init__()
+        self.set_hexpand(True)
+        self.set_vexpand(True)
+
+        self.visualizer = visualizer
+        self.playback = playback
+        self.streamer = streamer
+        self.on_quality_changed = on_quality_changed
+        self.on_first_frame = on_first_frame
+
+        # The widget's visualizer, and any other outputs, all get their features from one bus,
+        # just like in the visualizer's own window (see `visualizerengine.run_audio_visualizer`).
+        # A playlist switches the bus over to each new song.
+        self.bus = visualizerengine.FeatureBus(visualizer.analyzer, [visualizer] + list(outputs))
+        if isinstance(playback, visualizerengine.PlaylistPlayback):
+            playback.follow(self.bus)
+
+        # The governor lowers the quality if frames start taking too long. See `visualizerengine.FrameGovernor`.
+        self.governor = visualizerengine.FrameGovernor()
+
+        # The size of the widget itself. At lower quality levels, the frame buffer is smaller than this.
+        self.widget_width, self.widget_height = 1, 1
+
+        # The memory the visualizer draws into, and a Cairo surface that reads from that very same memory.
+        # Both are replaced whenever the widget changes size.
+        self.framebuffer = visualizerengine.FrameBuffer(1, 1)
+        self.cairo_surface = None
+
+        # The tick callback that draws every frame, and the time of the last frame, in microseconds.
+        self.tick_id = None
+        self.last_frame_time = None
+
+        # How far into the song the last frame was, in seconds. The seek bar follows this.
+        self.position = 0.0
+
+        self.set_draw_func(self._draw)
+        self.connect("resize", self._resized)
+
+    # Start the music, and start drawing a frame on every screen refresh.
+    def start(self):
+        self.playback.play()
+        self.tick_id = self.add_tick_callback(self._tick)
+
+    # Stop the music, and stop drawing. It is safe to call this more than once.
+    def stop(self):
+        if self.tick_id is not None:
+            self.remove_tick_callback(self.tick_id)
+            self.tick_id = None
+            self.playback.stop()
+
+    # When the widget changes size, make a new block of memory to match,
+    # and wrap it in a Cairo surface so Gtk can read it without copying it.
+    def _resized(self, area, width, height):
+        self.widget_width, self.widget_height = width, height
+        self._fit()
+
+    # Size the block of memory to the widget, at the current quality level.
+    def _fit(self):
+        scale = self.governor.quality["render_scale"]
+        self.framebuffer.resize(int(self.widget_width * scale), int(self.widget_height * scale))
+        self.cairo_surface = cairo.ImageSurface.create_for_data(memoryview(self.framebuffer.pixels), cairo.FORMAT_RGB24,
+            self.framebuffer.width, self.framebuffer.height, self.framebuffer.stride)
+        self.visualizer.resize(self.framebuffer.width, self.framebuffer.height)
+
+    # Gtk calls this right before every screen refresh.
+    def _tick(self, widget, frame_clock):
+
+        # Once the song is over, stop drawing. The last frame stays on screen.
+        if not self.playback.is_playing():
+            self.tick_id = None
+            return GLib.SOURCE_REMOVE
+
+        # The frame clock tells us when this frame will be shown, in microseconds.
+        frame_time = frame_clock.get_frame_time()
+        if self.last_frame_time is None:
+            self.last_frame_time = frame_time
+        deltaTime = (frame_time - self.last_frame_time) / 1000000.0
+        self.last_frame_time = frame_time
+
+        # Work out this frame's features once, move the bars (and any other outputs) along, and draw the bars into our block of memory.
+        # We time just that work, not the wait for the screen, and let the governor know how long it took.
+        frame_start = time.perf_counter()
+        position = self.playback.get_position()
+        self.position = position
+        self.bus.step(deltaTime, position)
+        self.visualizer.render(self.framebuffer.surface)
+
+        # Share the frame with anyone watching from elsewhere. This never holds us up.
+        if self.streamer is not None:
+            self.streamer.publish(self.framebuffer, position)
+
+        if self.governor.record(time.perf_counter() - frame_start):
+            self.visualizer.set_quality(self.governor.quality)
+            self._fit()
+            if self.on_quality_changed is not None:
+                self.on_quality_changed(self.governor.describe())
+
+        # Let Cairo know the memory changed behind its back, and ask Gtk to show it.
+        if self.cairo_surface is not None:
+            self.cairo_surface.mark_dirty()
+        self.queue_draw()
+
+        return GLib.SOURCE_CONTINUE
+
+    # Gtk calls this when it wants the widget drawn. We just paint our block of memory onto it,
+    # stretched to fit if it is smaller than the widget.
+    def _draw(self, area, context, width, height):
+        if self.cairo_surface is not None:
+            context.scale(width / self.framebuffer.width, height / self.framebuffer.height)
+            context.set_source_surface(self.cairo_surface, 0, 0)
+            context.paint()
+
+            # The first real frame is on its way to the screen.
+            if self.on_first_frame is not None and self.last_frame_time is not None:
+                on_first_frame = self.on_first_frame
+                self.on_first_frame = None
+                on_first_frame()
@@ -0,0 +1,133 @@
+# PyViz, a Python music visualizer.
+# Program by Austin Pringle, Caleb Rachocki, & Caleb Ruby
+# Pennsylvania Western University, California
+#
+# pyvizwaveform.py
+# This file contains the waveform widget.
+# It draws a song's waveform from its envelope pyramid (see `pyvizenvelope.py`): the peaks lightly,
+# and the loudness (RMS) on top of them, more strongly.
+# It can also act as a seek bar: it shows how far into the song we are,
+# and clicking or dragging on it jumps to that spot.
+
+# Explanation of these imports is in the `pyvizapp.py` and `pyvizviswidget.py` files
+import gi
+gi.require_version("Gtk", "4.0")
+gi.require_foreign("cairo")
+from gi.repository import Gtk
+
+
+class PyVizWaveform(Gtk.DrawingArea):
+
+    # Constructor function
+    # `height` is how tall the waveform is, in pixels.
+    # `on_seek`, if given, makes this a seek bar: it is called with a song position, in seconds,
+    # whenever the user clicks on the waveform, or lets go after dragging across it.
+    def __init__(self, height=64, on_seek=None):
+        super().__init__()
+        self.set_hexpand(True)
+        self.set_content_height(height)
+
+        self.envelope = None
+        self.on_seek = on_seek
+
+        # How far into the song we are, in seconds, or `None` to not show it.
+        self.position = None
+
+        # While the user drags across the seek bar, where the pointer is, in pixels.
+        self.drag_x = None
+
+        # The waveform, summarized to the widget's width, as (width, lows, highs, RMS).
+        # It only changes when the width or the song does, so we keep it around between redraws.
+        self.columns = None
+
+        self.set_draw_func(self._draw)
+
+        if on_seek is not None:
+            drag = Gtk.GestureDrag()
+            drag.connect("drag-begin", self._drag_begin)
+            drag.connect("drag-update", self._drag_update)
+            drag.connect("drag-end", self._drag_end)
+            self.add_controller(drag)
+
+    # Show a song's waveform. `envelope` is a `pyvizenvelope.Envelope`.
+    def set_envelope(self, envelope):
+        self.envelope = envelope
+        self.columns = None
+        self.queue_draw()
+
+    # Move the position marker.
+    def set_position(self, position):
+        if position != self.position:
+            self.position = position
+            self.queue_draw()
+
+    # The song position under a point on the widget, in seconds.
+    def _position_at(self, x):
+        width = max(1, self.get_width())
+        return min(max(x / width, 0.0), 1.0) * self.envelope.duration
+
+    def _drag_begin(self, gesture, x, y):
+        self.drag_start = x
+        self.drag_x = x
+        self.queue_draw()
+
+    def _drag_update(self, gesture, offset_x, offset_y):
+        self.drag_x = self.drag_start + offset_x
+        self.queue_draw()
+
+    # Only seek once the user lets go. Seeking restarts the music, so seeking all the way through a drag would stutter.
+    def _drag_end(self, gesture, offset_x, offset_y):
+        x = self.drag_start + offset_x
+        self.drag_x = None
+        if self.envelope is not None:
+            self.position = self._position_at(x)
+            self.on_seek(self.position)
+        self.queue_draw()
+
+    def _draw(self, area, context, width, height):
+        if self.envelope is None or width <= 0:
+            return
+
+        if self.columns is None or self.columns[0] != width:
+            lows, highs, rms = self.envelope.query(0, self.envelope.duration, width)
+            self.columns = (width, lows, highs, rms)
+        lows, highs, rms = self.columns[1:]
+
+        color = self.get_color()
+        middle = height / 2
+
+        # Trace the outline of the waveform, along the top from left to right, and back along the bottom.
+        def _outline(tops, bottoms):
+            context.move_to(0, middle - tops[0] * middle)
+            for x in range(1, width):
+                context.line_to(x, middle - tops[x] * middle)
+            for x in range(width - 1, -1, -1):
+                context.line_to(x, middle - bottoms[x] * middle)
+            context.close_path()
+
+        # Draw the whole waveform faintly, then the part that has already played over it, more strongly.
+        position = self._position_at(self.drag_x) if self.drag_x is not None else self.position
+        played = 0 if position is None or self.envelope.duration <= 0 else width * position / self.envelope.duration
+        for alpha, clip in ((0.35, None), (0.9, played)):
+            if clip is not None:
+                if clip <= 0:
+                    break
+                context.save()
+                context.rectangle(0, 0, clip, height)
+                context.clip()
+
+            context.set_source_rgba(color.red, color.green, color.blue, alpha * 0.5)
+            _outline(highs, lows)
+            context.fill()
+            context.set_source_rgba(color.red, color.green, color.blue, alpha)
+            _outline(rms, -rms)
+            context.fill()
+
+            if clip is not None:
+                context.restore()
+
+        # The position marker.
+        if position is not None:
+            context.set_source_rgba(color.red, color.green, color.blue, 1.0)
+            context.rectangle(played - 1, 0, 2, height)
+            context.fill()
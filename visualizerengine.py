@@ -7,8 +7,9 @@
 # The ♥ of the program!
 
 # `librosa` is a musical analysis library.
-# We use it for everything on the frequency analysis side of this visualizer
-import librosa
+# We use it for everything on the frequency analysis side of this visualizer.
+# It takes a few seconds to load, so it is only loaded once a song is actually analyzed (see `AudioAnalyzer`).
+# The visualizer's own process (see `pyvizvisprocess.py`) is handed a finished analysis, and never needs it at all.
 
 # We use `numpy` for a handful of math-related calculations for the visualizer.
 import numpy as np
@@ -19,19 +20,690 @@ import pygame
 # For path.join what else
 import os
 
+# A finished analysis is saved as a few small files, so another process can pick it up. See `AudioAnalyzer.save`.
+import json
+
+# `math` gives us `exp`, for smoothing the bars the same way at any frame rate.
+import math
+
+# `io` and `wave` let us build a tiny .wav file in memory, for warming up the analyzer.
+import io
+import wave
+
+# Rendering to a video file hands the frames to `ffmpeg`, which runs as a separate program.
+import subprocess
+
+# For timing frames.
+import time
+
+# For measuring how much memory each step of the analysis actually used.
+import tracemalloc
+
+# The live analyzer keeps the spectrum readings that are still "in the future" in a queue.
+from collections import deque
+
+# The analyzer also gives the song an envelope pyramid, for drawing its waveform. See `pyvizenvelope.py`.
+import pyvizenvelope
+
+# GStreamer runs the live analyzer. See `pyvizgoompage.py` for more about GStreamer.
+# We only say which version we want here. `Gst` itself is loaded when a live analyzer is made.
+import gi
+gi.require_version('Gst', '1.0')
+
+# Whether the analyzer has already run once in this program.
+# Everything it needs is loaded and set up by then, so there is no point in warming it up again.
+_warmed_up = False
+
+# The sample rate of the warm-up signal. It is different from the one librosa loads at,
+# so the warm-up also sets up the resampler.
+WARM_UP_SAMPLE_RATE = 44100
+
+# The ways the visualizer can analyze a song.
+# "librosa" analyzes the whole song before it starts playing (`AudioAnalyzer`).
+# "gstreamer" analyzes the song live, as it plays (`SpectrumAnalyzer`).
+ANALYSIS_BACKENDS = ["librosa", "gstreamer"]
+
+# How carefully the "librosa" analyzer looks at the song. Each tier picks, all together:
+# - the sample rate the song is loaded at. Our highest bar is at 7900Hz, so anything over 16000Hz can't be seen,
+# - how carefully the song is resampled to that rate ("soxr_hq" is librosa's usual, "soxr_qq" is the quickest),
+# - and the FFT size and hop length, in samples. A bigger FFT tells frequencies apart more finely.
+#   Even "fast" splits them finer than the 100Hz between our bars.
+# "high" is how the analyzer has always worked. `benchmarks/analysis_tiers.py` measures what the others save,
+# and how different the bars look.
+ANALYSIS_TIERS = {
+    "fast": {"sample_rate": 16000, "res_type": "soxr_qq", "n_fft": 2048, "hop_length": 512},
+    "balanced": {"sample_rate": 22050, "res_type": "soxr_mq", "n_fft": 4096, "hop_length": 512},
+    "high": {"sample_rate": 22050, "res_type": "soxr_hq", "n_fft": 8192, "hop_length": 512},
+}
+
+# The tier used when nobody asks for one. The `PYVIZ_ANALYSIS_TIER` environment variable changes it.
+DEFAULT_ANALYSIS_TIER = os.environ.get("PYVIZ_ANALYSIS_TIER") or "high"
+
+# How much memory, in megabytes, the analysis of one song may use, or `None` for no limit.
+# The `PYVIZ_ANALYSIS_MEMORY_MB` environment variable sets it.
+DEFAULT_ANALYSIS_MEMORY_MB = float(os.environ["PYVIZ_ANALYSIS_MEMORY_MB"]) if os.environ.get("PYVIZ_ANALYSIS_MEMORY_MB") else None
+
+# The ways the analysis can work out the spectrogram, from the most memory to the least.
+# The analyzer estimates how much memory each would need (see `estimate_analysis_memory`),
+# and uses the first one that fits the memory budget.
+# - "full" is how the analyzer has always worked: the whole spectrogram at once. Along the way, librosa makes
+#   several full-size copies of it (complex numbers, magnitudes, powers, decibels), so it needs about 20 bytes per value.
+# - "chunked" works it out a piece at a time, straight into one spectrogram, and turns it into decibels in place.
+#   It comes out the same, in a quarter of the memory.
+# - "float16" keeps the spectrogram in 16-bit numbers. Decibels from -80 to 0 lose well under a tenth of a decibel.
+# - "hop_scale" takes readings that many times further apart, for a spectrogram that is coarser in time.
+#   That's the only one that changes how the bars look (they follow the music a bit more loosely), so it's the last resort.
+ANALYSIS_STRATEGIES = [
+    {"name": "full", "chunked": False, "float16": False, "hop_scale": 1},
+    {"name": "chunked", "chunked": True, "float16": False, "hop_scale": 1},
+    {"name": "chunked-float16", "chunked": True, "float16": True, "hop_scale": 1},
+    {"name": "chunked-float16-hop2", "chunked": True, "float16": True, "hop_scale": 2},
+    {"name": "chunked-float16-hop4", "chunked": True, "float16": True, "hop_scale": 4},
+]
+
+# How many spectrogram readings the chunked strategies work out at once.
+ANALYSIS_CHUNK_FRAMES = 128
+
+# Bytes in a megabyte.
+MEGABYTE = 1024 * 1024
+
+
+# The analysis was refused, because even its cheapest strategy would need more memory than the budget allows.
+class AnalysisMemoryError(MemoryError):
+    pass
+
+# Default settings for the live analyzer.
+# The song is split into this many frequency bands, evenly spaced from 0Hz up to half the sample rate.
+# At 44100Hz, 256 bands are about 86Hz wide each, a bit finer than the 100Hz between our bars.
+SPECTRUM_SAMPLE_RATE = 44100
+SPECTRUM_BANDS = 256
+
+# How often the live analyzer takes a reading, in seconds.
+SPECTRUM_INTERVAL = 0.02
+
+# Anything quieter than this many decibels is reported as exactly this. It matches the bottom of `AudioBar`.
+SPECTRUM_THRESHOLD = -80
+
+# How tall a bar can get, in pixels, when drawn at full size.
+BAR_MAX_HEIGHT = 400
+
+# How long it takes a bar to get most of the way (about 63%) to its new height, in seconds.
+BAR_SMOOTHING = 0.1
+
+# How the bars look. Every style but "flat" is drawn from pre-rendered pieces. See `BarSprites`.
+# "gradient" shades each bar from dark at the bottom to bright at the top.
+# "peaks" leaves a little cap at the top of each bar, which falls slowly after the bar drops.
+# "glow" is how far, in pixels at full size, a soft glow spreads around each bar. 0 is no glow.
+BAR_STYLES = {
+    "flat": {"gradient": False, "peaks": False, "glow": 0},
+    "gradient": {"gradient": True, "peaks": True, "glow": 0},
+    "neon": {"gradient": True, "peaks": True, "glow": 8},
+}
+
+# The style used when nobody picks one. Setting the `PYVIZ_BAR_STYLE` environment variable changes it.
+DEFAULT_BAR_STYLE = os.environ.get("PYVIZ_BAR_STYLE", "flat")
+
+# How fast a peak cap falls, as a fraction of the bar's full height per second.
+PEAK_FALL_SPEED = 0.6
+
+# The frequencies the visualizer looks at, in Hz: one per bar, 100Hz apart.
+BAR_FREQUENCIES = np.arange(100, 8000, 100)
+
+# Beat detection (see `FeatureBus`). A beat is when the bass (every frequency up to `BEAT_FREQUENCY`)
+# gets `BEAT_THRESHOLD` decibels louder than it has been, on average, over the last `BEAT_WINDOW` seconds.
+# Beats are at least `BEAT_MIN_GAP` seconds apart.
+BEAT_FREQUENCY = 250
+BEAT_THRESHOLD = 6
+BEAT_WINDOW = 1.0
+BEAT_MIN_GAP = 0.25
+
+# How much of the song, in seconds, the loudness is measured over, from the envelope pyramid (see `pyvizenvelope.py`).
+LOUDNESS_WINDOW = 0.05
+
+# How strong the glow is, right next to the bar, from 0 (invisible) to 255 (as solid as the bar).
+GLOW_ALPHA = 110
+
+# The pulse visual's halo: how far past the circle it reaches (as a part of the circle's size), in how many rings.
+PULSE_HALO_SIZE = 0.3
+PULSE_HALO_RINGS = 6
+
+# The quality levels the frame governor can pick from, best first.
+# "bar_step" keeps only every n-th bar, so there are fewer (wider) bars to analyze and draw.
+# "render_scale" draws the frame smaller than the window, and stretches it to fit.
+QUALITY_LEVELS = [
+    {"name": "full", "bar_step": 1, "render_scale": 1.0},
+    {"name": "high", "bar_step": 2, "render_scale": 1.0},
+    {"name": "medium", "bar_step": 2, "render_scale": 0.75},
+    {"name": "low", "bar_step": 4, "render_scale": 0.5},
+]
+
+# The GStreamer pipeline for the live analyzer.
+# Read the song, decode it, and bring it to a known sample rate.
+# The "spectrum" element measures how loud each frequency band is, and posts a message with its readings
+# every interval. The audio passes through it untouched, and gets played.
+# The file name is filled in afterwards, so we don't have to worry about spaces and quotes in it.
+SPECTRUM_PIPELINE = (
+    "filesrc name=src ! decodebin ! audioconvert ! audioresample ! audio/x-raw,rate={rate} "
+    "! spectrum bands={bands} interval={interval} threshold={threshold} post-messages=true message-magnitude=true "
+    "! audioconvert ! autoaudiosink"
+)
+
+# How long a song is, in seconds, along with its sample rate and number of channels, without loading it.
+# .wav files (which is what we download) are read by `wave`. Anything else is asked of librosa,
+# and assumed to be stereo.
+def probe_audio(filename):
+    try:
+        with wave.open(filename, "rb") as reader:
+            info = (reader.getnframes() / reader.getframerate(), reader.getframerate(), reader.getnchannels())
+        # A file that is already open (like the warm-up's) has to go back to the start for librosa.
+        if hasattr(filename, "seek"):
+            filename.seek(0)
+        return info
+    except (wave.Error, EOFError):
+        if hasattr(filename, "seek"):
+            filename.seek(0)
+        import librosa
+        return (librosa.get_duration(path=filename), librosa.get_samplerate(filename), 2)
+
+
+# Estimate how much memory each step of analyzing a song would need, in bytes, before doing it.
+# The steps are loading the song ("load"), working out the spectrogram ("stft"), and turning it into decibels ("decibels").
+# This counts the song's samples and the spectrogram (and librosa's copies of them), which is nearly all of it.
+# It doesn't count the memory the program itself takes up, with librosa and everything else loaded.
+def estimate_analysis_memory(duration, source_rate, channels, tier, strategy):
+    settings = ANALYSIS_TIERS[tier]
+    n_fft, hop_length = settings["n_fft"], settings["hop_length"] * strategy["hop_scale"]
+
+    source_samples = duration * source_rate
+    samples = duration * settings["sample_rate"]
+    bins = n_fft // 2 + 1
+    frames = 1 + int(samples // hop_length)
+    values = bins * frames
+    signal = samples * 4
+
+    # librosa reads every channel, mixes them down to one, and then resamples that.
+    load = max(source_samples * channels * 4 + source_samples * 4, source_samples * 4 + signal)
+
+    if not strategy["chunked"]:
+        # The song, a padded copy of it, complex numbers (8 bytes each), librosa's working copies, and the magnitudes (4).
+        # These were measured on librosa 0.11.
+        stft = 2 * signal + values * 16
+        # Magnitudes, powers, and a few temporary copies on the way to decibels.
+        decibels = signal + values * 20
+    else:
+        stored = 2 if strategy["float16"] else 4
+        chunk = bins * min(ANALYSIS_CHUNK_FRAMES, frames)
+        stft = 2 * signal + values * stored + chunk * 16
+        decibels = signal + values * stored + chunk * 8
+
+    return {"load": int(load), "stft": int(stft), "decibels": int(decibels)}
+
+
+# Pick the first of the `ANALYSIS_STRATEGIES` whose estimate fits in `budget_mb` megabytes (`None` is no limit).
+# Returns the strategy and its estimate. If none of them fit, the analysis is refused with an `AnalysisMemoryError`.
+def choose_analysis_strategy(duration, source_rate, channels, tier, budget_mb):
+    for strategy in ANALYSIS_STRATEGIES:
+        estimate = estimate_analysis_memory(duration, source_rate, channels, tier, strategy)
+        if budget_mb is None or max(estimate.values()) <= budget_mb * MEGABYTE:
+            return strategy, estimate
+    raise AnalysisMemoryError("analyzing this song (" + format(duration / 60, ".1f") + " minutes) would need about "
+        + format(max(estimate.values()) / MEGABYTE, ".1f") + " MB even at its cheapest, but the analysis memory budget is "
+        + format(budget_mb, ".1f") + " MB")
+
+
+# Work out a spectrogram in decibels a piece at a time, straight into one array of `dtype`.
+# It comes out the same as `librosa.amplitude_to_db(np.abs(librosa.stft(...)), ref=np.max)`, without the full-size copies.
+def _chunked_spectrogram(librosa, time_series, n_fft, hop_length, dtype):
+    # Pad the song like `librosa.stft` does, so every reading is centered on its moment of the song.
+    padded = np.pad(time_series, n_fft // 2, mode="constant")
+    frames = 1 + (len(padded) - n_fft) // hop_length
+    spectrogram = np.empty((n_fft // 2 + 1, frames), dtype)
+    for start in range(0, frames, ANALYSIS_CHUNK_FRAMES):
+        end = min(frames, start + ANALYSIS_CHUNK_FRAMES)
+        piece = padded[start * hop_length:(end - 1) * hop_length + n_fft]
+        spectrogram[:, start:end] = np.abs(librosa.stft(piece, n_fft=n_fft, hop_length=hop_length, center=False))
+    del padded
+
+    # Decibels, relative to the loudest value, and no quieter than 80 below it. (These are librosa's defaults.)
+    amin = 1e-5
+    offset = 20 * np.log10(max(amin, float(spectrogram.max())))
+    for start in range(0, frames, ANALYSIS_CHUNK_FRAMES):
+        block = spectrogram[:, start:start + ANALYSIS_CHUNK_FRAMES].astype(np.float32)
+        np.maximum(block, amin, out=block)
+        np.log10(block, out=block)
+        block *= 20
+        block -= offset
+        spectrogram[:, start:start + ANALYSIS_CHUNK_FRAMES] = block
+    np.maximum(spectrogram, float(spectrogram.max()) - 80, out=spectrogram)
+    return spectrogram
+
+
+# `tier` is one of the `ANALYSIS_TIERS`, or `None` for the default one.
+# `memory_budget_mb` is how much memory the analysis may use, in megabytes. See `ANALYSIS_STRATEGIES`.
+# `None` is the default budget (`DEFAULT_ANALYSIS_MEMORY_MB`).
+# Afterwards, `memory` tells which strategy was used, and how much memory each step was estimated to need
+# and actually used, in megabytes. The actual amounts are measured with `tracemalloc`,
+# unless something else was already measuring, in which case they are `None`.
 class AudioAnalyzer:
-    def __init__(self, filename):
-        time_series, sample_rate = librosa.load(filename)
-        stft = np.abs(librosa.stft(time_series, hop_length=512, n_fft=2048*4))
-        self.spectrogram = librosa.amplitude_to_db(stft, ref=np.max)
+    def __init__(self, filename, tier=None, memory_budget_mb=None):
+        self.tier = tier or DEFAULT_ANALYSIS_TIER
+        if self.tier not in ANALYSIS_TIERS:
+            raise ValueError("unknown analysis tier \"" + self.tier + "\"")
+        settings = ANALYSIS_TIERS[self.tier]
+        budget_mb = memory_budget_mb if memory_budget_mb is not None else DEFAULT_ANALYSIS_MEMORY_MB
+
+        strategy, estimate = choose_analysis_strategy(*probe_audio(filename), self.tier, budget_mb)
+        n_fft, hop_length = settings["n_fft"], settings["hop_length"] * strategy["hop_scale"]
+
+        measuring = not tracemalloc.is_tracing()
+        measured = {}
+        if measuring:
+            tracemalloc.start()
 
-        frequencies = librosa.core.fft_frequencies(n_fft=2048*4)
-        times = librosa.core.frames_to_time(np.arange(self.spectrogram.shape[1]), sr=sample_rate, hop_length=512, n_fft=2048*4)
+        # How much memory was used at most since the last step, in bytes.
+        def _step_peak():
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.reset_peak()
+            return peak
+
+        try:
+            import librosa
+            time_series, sample_rate = librosa.load(filename, sr=settings["sample_rate"], res_type=settings["res_type"])
+            if measuring:
+                measured["load"] = _step_peak()
+
+            if strategy["chunked"]:
+                self.spectrogram = _chunked_spectrogram(librosa, time_series, n_fft, hop_length,
+                    np.float16 if strategy["float16"] else np.float32)
+                if measuring:
+                    # The chunked strategy does both steps together.
+                    measured["stft"] = measured["decibels"] = _step_peak()
+            else:
+                stft = np.abs(librosa.stft(time_series, hop_length=hop_length, n_fft=n_fft))
+                if measuring:
+                    measured["stft"] = _step_peak()
+                self.spectrogram = librosa.amplitude_to_db(stft, ref=np.max)
+                del stft
+                if measuring:
+                    measured["decibels"] = _step_peak()
+        finally:
+            if measuring:
+                tracemalloc.stop()
+
+        self.memory = {
+            "strategy": strategy["name"],
+            "budget_mb": budget_mb,
+            "estimated_mb": {step: size / MEGABYTE for step, size in estimate.items()},
+            "measured_mb": {step: size / MEGABYTE for step, size in measured.items()} if measuring else None,
+        }
+
+        frequencies = librosa.core.fft_frequencies(sr=sample_rate, n_fft=n_fft)
+        times = librosa.core.frames_to_time(np.arange(self.spectrogram.shape[1]), sr=sample_rate, hop_length=hop_length, n_fft=n_fft)
         self.time_index_ratio = len(times) / times[len(times) - 1]
+
+        # How long the song is, in seconds.
+        self.duration = times[len(times) - 1]
+
+        # The song is already loaded, so its waveform comes nearly for free.
+        self.envelope = pyvizenvelope.envelope_from_samples(time_series, sample_rate)
+        del time_series
         self.frequencies_index_ratio = len(frequencies) / frequencies[len(frequencies)-1]
 
+        # Now that the analyzer has run once, everything it needs is loaded and ready.
+        global _warmed_up
+        _warmed_up = True
+
+        # The folder this analysis was saved to or loaded from, if any. See `save`.
+        self.directory = None
+
+    # How loud many frequencies are at once, as an array. It's the same as `get_decibel` for each of them, in one go.
+    def get_decibels(self, target_time, freqs):
+        time_index = min(int(target_time*self.time_index_ratio), self.spectrogram.shape[1] - 1)
+        return np.asarray(self.spectrogram[(freqs*self.frequencies_index_ratio).astype(np.intp), time_index], np.float32)
+
     def get_decibel(self, target_time, freq):
-        return self.spectrogram[int(freq*self.frequencies_index_ratio)][int(target_time*self.time_index_ratio)]
+        # Past the end of the song, keep showing the very last moment of it.
+        # Both indexes go in at once, so a spectrogram that is mapped from a file (see `load_analysis`) is just as quick.
+        # It always comes back as a plain number, even from a 16-bit spectrogram (see `ANALYSIS_STRATEGIES`).
+        time_index = min(int(target_time*self.time_index_ratio), self.spectrogram.shape[1] - 1)
+        return float(self.spectrogram[int(freq*self.frequencies_index_ratio), time_index])
+
+    # Save the analysis to `directory`, so another process can load it with `load_analysis`.
+    # The spectrogram is written as a plain .npy file, which the other process maps straight from the disk
+    # instead of having it copied over a pipe.
+    # `directory` itself is created if needed, but the folder it goes in must already be there: if it isn't,
+    # the session it belongs to is over (see `PyVizSession.close`), and saving would only bring its folder back.
+    def save(self, directory):
+        if not os.path.isdir(directory):
+            os.mkdir(directory)
+        np.save(os.path.join(directory, "spectrogram.npy"), np.ascontiguousarray(self.spectrogram))
+        self.envelope.save(os.path.join(directory, "envelope.npz"))
+        with open(os.path.join(directory, "analysis.json"), "w") as info_file:
+            json.dump({
+                "tier": self.tier,
+                "duration": float(self.duration),
+                "time_index_ratio": float(self.time_index_ratio),
+                "frequencies_index_ratio": float(self.frequencies_index_ratio),
+                "memory": self.memory,
+            }, info_file)
+        self.directory = directory
+
+
+# Load an analysis that `AudioAnalyzer.save` saved to `directory`.
+# The spectrogram is mapped from the file rather than read in, so only the parts that are looked at get loaded.
+def load_analysis(directory):
+    with open(os.path.join(directory, "analysis.json")) as info_file:
+        info = json.load(info_file)
+
+    analyzer = AudioAnalyzer.__new__(AudioAnalyzer)
+    analyzer.tier = info["tier"]
+    analyzer.duration = info["duration"]
+    analyzer.time_index_ratio = info["time_index_ratio"]
+    analyzer.frequencies_index_ratio = info["frequencies_index_ratio"]
+    analyzer.memory = info.get("memory")
+    analyzer.spectrogram = np.load(os.path.join(directory, "spectrogram.npy"), mmap_mode="r")
+    analyzer.envelope = pyvizenvelope.load_envelope(os.path.join(directory, "envelope.npz"))
+    analyzer.directory = directory
+    return analyzer
+
+
+# The very first analysis in a program is a lot slower than the rest.
+# Libraries are still being loaded, and the decoder, resampler and FFT are all being set up for the first time.
+# This runs a tiny analysis on one second of made-up audio, so that all of that is already done
+# by the time the user asks for a real one.
+# `check` is called between the steps, so whoever started the warm-up can stop it early.
+def warm_up(check=None):
+    if _warmed_up:
+        return
+
+    # One second of a 440Hz tone with a bit of noise on top, as 16-bit samples.
+    times = np.arange(WARM_UP_SAMPLE_RATE) / WARM_UP_SAMPLE_RATE
+    signal = 0.5 * np.sin(2 * np.pi * 440 * times) + 0.05 * np.random.default_rng(0).standard_normal(WARM_UP_SAMPLE_RATE)
+    samples = (np.clip(signal, -1, 1) * 32767).astype(np.int16)
+
+    # Write it out as a .wav file, but in memory instead of on the disk.
+    wav_file = io.BytesIO()
+    with wave.open(wav_file, "wb") as writer:
+        writer.setnchannels(1)
+        writer.setsampwidth(2)
+        writer.setframerate(WARM_UP_SAMPLE_RATE)
+        writer.writeframes(samples.tobytes())
+    wav_file.seek(0)
+
+    if check is not None:
+        check()
+
+    # Run it through the exact same analysis a real song goes through.
+    AudioAnalyzer(wav_file)
+
+# Plays the song for the "librosa" analyzer, using pygame.
+# The live analyzer plays the song itself, and has these same five functions.
+class MixerPlayback:
+    def __init__(self, filename):
+        self.filename = filename
+
+        # The mixer counts from wherever it was last started, so after a seek, we add where that was.
+        self.offset = 0.0
+
+    def play(self):
+        pygame.mixer.init()
+        pygame.mixer.music.load(self.filename)
+        pygame.mixer.music.play(0)
+        self.offset = 0.0
+
+    def stop(self):
+        pygame.mixer.music.stop()
+
+    # Jump to a spot in the song, in seconds.
+    def seek(self, position):
+        pygame.mixer.music.play(0, start=position)
+        self.offset = position
+
+    # How far into the song we are, in seconds.
+    def get_position(self):
+        return self.offset + pygame.mixer.music.get_pos() / 1000.0
+
+    def is_playing(self):
+        return pygame.mixer.music.get_busy()
+
+
+# Pull the list of band loudnesses out of a "spectrum" message.
+# PyGObject can't hand us the list directly, so we read it out of the message's text form,
+# which looks like "spectrum, ..., magnitude=(float){ -80, -61.5, ... };"
+def _parse_magnitudes(structure):
+    text = structure.to_string()
+    start = text.index("magnitude=(float){") + len("magnitude=(float){")
+    end = text.index("}", start)
+    return [float(value) for value in text[start:end].split(",")]
+
+
+# The live analyzer.
+# Instead of analyzing the whole song up front, it plays the song through a GStreamer pipeline
+# that measures the spectrum as it goes. Playback and analysis share the pipeline's clock,
+# so the bars can never drift away from the music.
+# It can be used anywhere an `AudioAnalyzer` can, and it is also its own playback (see `MixerPlayback`).
+class SpectrumAnalyzer:
+    def __init__(self, filename, bands=SPECTRUM_BANDS, interval=SPECTRUM_INTERVAL, threshold=SPECTRUM_THRESHOLD):
+        from gi.repository import Gst
+        Gst.init(None)
+        self.Gst = Gst
+
+        self.pipeline = Gst.parse_launch(SPECTRUM_PIPELINE.format(rate=SPECTRUM_SAMPLE_RATE, bands=bands,
+            interval=int(interval * Gst.SECOND), threshold=threshold))
+        self.pipeline.get_by_name("src").set_property("location", filename)
+
+        # We don't listen to the pipeline's messages as they come in. Instead, we pick them up
+        # whenever the visualizer asks for the next frame. That way, this works with any main loop, or none at all.
+        self.bus = self.pipeline.get_bus()
+
+        # How wide each band is, in Hz.
+        self.band_width = (SPECTRUM_SAMPLE_RATE / 2) / bands
+
+        # The readings for the moment we are hearing right now.
+        # Until the first one comes in, everything is silent.
+        self.magnitudes = [threshold] * bands
+
+        # Readings come in a little before their moment is actually heard.
+        # They wait here, as (time in seconds, readings), until it is their turn.
+        self.pending = deque()
+
+        # The song position the current readings were picked for, and whether the song is over.
+        self.time = None
+        self.finished = False
+
+        # Get everything loaded and ready to go, so playback starts the moment `play` is called.
+        self.pipeline.set_state(Gst.State.PAUSED)
+
+    def play(self):
+        self.pipeline.set_state(self.Gst.State.PLAYING)
+
+    def stop(self):
+        self.pipeline.set_state(self.Gst.State.NULL)
+        self.finished = True
+
+    # Jump to a spot in the song, in seconds.
+    # Readings that were already on their way are for the old spot, so they are thrown out.
+    def seek(self, position):
+        Gst = self.Gst
+        self.pipeline.seek_simple(Gst.Format.TIME, Gst.SeekFlags.FLUSH | Gst.SeekFlags.KEY_UNIT, int(position * Gst.SECOND))
+        self._poll()
+        self.pending.clear()
+        self.time = None
+
+    # How far into the song we are, in seconds, according to the pipeline's clock.
+    def get_position(self):
+        found, position = self.pipeline.query_position(self.Gst.Format.TIME)
+        if not found:
+            return 0.0
+        return position / self.Gst.SECOND
+
+    def is_playing(self):
+        self._poll()
+        return not self.finished
+
+    def get_decibel(self, target_time, freq):
+        # The visualizer asks for every bar at the same time, so we only catch up once per frame.
+        if target_time != self.time:
+            self.time = target_time
+            self._poll()
+            while len(self.pending) > 0 and self.pending[0][0] <= target_time:
+                self.magnitudes = self.pending.popleft()[1]
+
+        band = min(int(freq / self.band_width), len(self.magnitudes) - 1)
+        return self.magnitudes[band]
+
+    # Pick up all the messages the pipeline has posted since last time.
+    def _poll(self):
+        Gst = self.Gst
+        while True:
+            message = self.bus.pop_filtered(Gst.MessageType.ELEMENT | Gst.MessageType.EOS | Gst.MessageType.ERROR)
+            if message is None:
+                return
+
+            if message.type != Gst.MessageType.ELEMENT:
+                self.finished = True
+                continue
+
+            structure = message.get_structure()
+            if structure is None or structure.get_name() != "spectrum":
+                continue
+
+            self.pending.append((structure.get_value("stream-time") / Gst.SECOND, _parse_magnitudes(structure)))
+
+
+# Make the analyzer for a song, using one of the `ANALYSIS_BACKENDS`.
+# `tier` is one of the `ANALYSIS_TIERS`. Only the "librosa" analyzer has tiers.
+def create_analyzer(filename, backend="librosa", tier=None):
+    if backend == "gstreamer":
+        return SpectrumAnalyzer(filename)
+    return AudioAnalyzer(filename, tier)
+
+
+# Get whatever plays the song for an analyzer.
+def create_playback(analyzer, filename):
+    if isinstance(analyzer, SpectrumAnalyzer):
+        return analyzer
+    return MixerPlayback(filename)
+
+
+# Read a song file from start to end once, without keeping any of it.
+# That leaves the whole file in the operating system's memory, so when the mixer starts reading it
+# right as the last song ends, it never has to wait on the disk.
+# `check` is called between pieces, so whoever started it can stop it early.
+def prebuffer(filename, check=None, chunk_size=1024 * 1024):
+    with open(filename, "rb") as song_file:
+        while len(song_file.read(chunk_size)) > 0:
+            if check is not None:
+                check()
+
+
+# Plays a whole list of songs back to back, for the "librosa" analyzer, using pygame.
+# It has the same five functions as `MixerPlayback`, so the visualizer can't tell the difference.
+#
+# It starts with one song. The next ones are handed over with `add` whenever they are ready,
+# which may well be while the current one is still playing. As soon as there is a next song,
+# it is queued up in the mixer, and the mixer starts it the moment the current one ends, with no gap.
+# When that happens, the visualizer (see `follow`) is switched over to the next song's analyzer.
+# The window, the bars and the mixer all carry on as they were.
+#
+# `on_track_change`, if given, is called with the new song's title whenever the next song starts.
+# It is called from whatever thread is drawing the visualizer.
+class PlaylistPlayback:
+    def __init__(self, analyzer, filename, on_track_change=None):
+        self.analyzer = analyzer
+        self.filename = filename
+        self.on_track_change = on_track_change
+        self.visualizer = None
+
+        # The songs that are ready to go, as (analyzer, filename, title).
+        # Songs are added from the GUI's main loop and taken out while drawing. A deque is safe for that.
+        self.upcoming = deque()
+
+        # The song the mixer has been told to play next, if any.
+        self.queued = None
+
+        # Whether more songs might still be added. See `finish`.
+        self.expecting_more = True
+
+        # The mixer's last reported position. The mixer starts counting again from zero when it moves on
+        # to the queued song, so a position that jumps backwards means the next song has started.
+        self.last_position = 0.0
+
+        # Where in the current song the mixer was last started, after a seek.
+        self.offset = 0.0
+
+    # Switch this visualizer (or `FeatureBus`) over to each new song's analyzer as it starts.
+    def follow(self, visualizer):
+        self.visualizer = visualizer
+
+    # Hand over the next song, once it is downloaded and analyzed.
+    def add(self, analyzer, filename, title=None):
+        self.upcoming.append((analyzer, filename, title))
+
+    # No more songs are coming. Once the ones we have run out, the playlist is over.
+    def finish(self):
+        self.expecting_more = False
+
+    def play(self):
+        pygame.mixer.init()
+        pygame.mixer.music.load(self.filename)
+        pygame.mixer.music.play(0)
+
+    def stop(self):
+        self.expecting_more = False
+        self.upcoming.clear()
+        pygame.mixer.music.stop()
+
+    # Jump to a spot in the current song, in seconds.
+    # Restarting the music forgets the queued song, so it goes back in line, and is queued again on the next frame.
+    def seek(self, position):
+        if self.queued is not None:
+            self.upcoming.appendleft(self.queued)
+            self.queued = None
+        pygame.mixer.music.load(self.filename)
+        pygame.mixer.music.play(0, start=position)
+        self.offset = position
+        self.last_position = 0.0
+
+    # How far into the current song we are, in seconds.
+    # This is called once per frame, so it is also where we keep the next song lined up.
+    def get_position(self):
+        position = pygame.mixer.music.get_pos() / 1000.0
+
+        # The mixer moved on to the queued song.
+        if self.queued is not None and position < self.last_position - 0.25:
+            self._start(self.queued)
+            self.queued = None
+            self.offset = 0.0
+
+        # The next song wasn't ready in time, and the mixer ran out of music. Start it as soon as it is.
+        elif self.queued is None and len(self.upcoming) > 0 and not pygame.mixer.music.get_busy():
+            track = self.upcoming.popleft()
+            pygame.mixer.music.load(track[1])
+            pygame.mixer.music.play(0)
+            self._start(track)
+            self.offset = 0.0
+            position = 0.0
+
+        # Line up the next song in the mixer, so it follows this one without a gap.
+        if self.queued is None and len(self.upcoming) > 0 and pygame.mixer.music.get_busy():
+            self.queued = self.upcoming.popleft()
+            pygame.mixer.music.queue(self.queued[1])
+
+        self.last_position = position
+        return self.offset + position
+
+    def is_playing(self):
+        return pygame.mixer.music.get_busy() or self.expecting_more or len(self.upcoming) > 0
+
+    # A new song has started.
+    def _start(self, track):
+        self.analyzer, self.filename, title = track
+        if self.visualizer is not None:
+            self.visualizer.analyzer = self.analyzer
+        if self.on_track_change is not None:
+            self.on_track_change(title)
+
 
 class AudioBar:
     def __init__(self, x, y, freq, color, min_height=10, max_height=100, min_decibel=-80, max_decibel=0):
@@ -40,6 +712,9 @@ class AudioBar:
         self.min_height, self.max_height = min_height, max_height
         self.height = min_height
         self.min_decibel, self.max_decibel = min_decibel, max_decibel
+
+        # The height of the peak cap. It jumps up with the bar, but falls slowly. Only some styles show it.
+        self.peak = min_height
         self.__decibel_height_ratio = (self.max_height - self.min_height) / (self.max_decibel - self.min_decibel)
 
     def update(self, dt, decibel, screen_height):
@@ -52,15 +727,23 @@ class AudioBar:
         # Update the y position to the bottom of the screen
         self.y = screen_height - self.max_height
 
-        # Calculate the speed of height change
-        speed = (desired_height - self.height) / 0.1
-
-        # Update the height
-        self.height += speed * dt
+        # Move the height towards the desired height.
+        # The longer it has been since the last update, the further it gets. Done this way, the bars move
+        # the same no matter the frame rate, and never overshoot, even when a frame takes a long time.
+        self.height += (desired_height - self.height) * (1 - math.exp(-dt / BAR_SMOOTHING))
 
          # Clamp the height to ensure it stays within the defined range
         self.height = self.clamp(self.min_height, self.max_height, self.height)
 
+        self.peak = max(self.height, self.peak - PEAK_FALL_SPEED * self.max_height * dt)
+
+    # Change how tall the bar can get, keeping its current height in proportion.
+    def set_max_height(self, max_height):
+        self.height = self.min_height + (self.height - self.min_height) * (max_height - self.min_height) / (self.max_height - self.min_height)
+        self.peak = self.min_height + (self.peak - self.min_height) * (max_height - self.min_height) / (self.max_height - self.min_height)
+        self.max_height = max_height
+        self.__decibel_height_ratio = (self.max_height - self.min_height) / (self.max_decibel - self.min_decibel)
+
     def render(self, screen, barWidth):
         pygame.draw.rect(screen, self.color, (self.x, self.y + self.max_height - self.height, barWidth, self.height))
 
@@ -73,104 +756,613 @@ class AudioBar:
 
         return value
 
-def run_audio_visualizer(filename, bar_color, bg_color):
+# For some godforsaken reason, the color chooser widget returns a proprietary RGB object
+# It will let you output to a string, but not a tuple... why?
+# Anyways, this is my converter between their object and a tuple. It's ugly.
+# It also takes the "rgb(r,g,b)" string itself, or a tuple that is already converted.
+def convert_color(color):
+    if isinstance(color, tuple):
+        return color
+
+    if not isinstance(color, str):
+        color = color.to_string()
 
-    # For some godforsaken reason, the color chooser widget returns a proprietary RGB object
-    # It will let you output to a string, but not a tuple... why?
-    # Anyways, this is my converter between their object and a tuple. It's ugly.
     cur_colorcode = ""
     color_code_list = []
     allow = False
-    counter = 0
-    converted_bg_color = 0
-    converted_bar_color = 0
-    for rgba in (bar_color, bg_color):
-        for char in rgba.to_string():
-            
-            if char == "(":
-                allow = True
-                continue
+    for char in color:
 
-            if allow == True:
+        if char == "(":
+            allow = True
+            continue
 
-                if char == ",":
+        if allow == True:
+
+            if char == ",":
+                color_code_list.append(int(cur_colorcode))
+                cur_colorcode = ""
+                continue
+
+            if char == ")":
+                try:
                     color_code_list.append(int(cur_colorcode))
-                    cur_colorcode = ""
-                    continue
-                        
-                if char == ")":
-                    try:
-                        color_code_list.append(int(cur_colorcode))
 
-                    except ValueError:
-                        pass
+                except ValueError:
+                    pass
+
+                break
+
+            else: cur_colorcode = cur_colorcode + char
+
+    return tuple(color_code_list)
+
+
+# A block of pixel memory that the visualizer draws into, over and over.
+# `pixels` is the memory itself: 4 bytes per pixel, in blue-green-red-alpha order, row after row.
+# `surface` is a pygame surface that draws directly into that same memory, without a copy of its own.
+# Anybody else who understands that layout (like Cairo, which Gtk uses) can read the pixels straight out of it.
+class FrameBuffer:
+    def __init__(self, width, height):
+        self.resize(width, height)
+
+    # Make a new block of memory of a different size.
+    def resize(self, width, height):
+        self.width, self.height = max(1, width), max(1, height)
+        self.stride = self.width * 4
+        self.pixels = bytearray(self.stride * self.height)
+        self.surface = pygame.image.frombuffer(self.pixels, (self.width, self.height), "BGRA")
+
+
+# A color, pulled part of the way towards another one. `amount` goes from 0 (just `color`) to 1 (just `target`).
+def _mix(color, target, amount):
+    return tuple(int(round(color[i] + (target[i] - color[i]) * amount)) for i in range(3))
+
+
+# The pre-rendered pieces the styled bars are drawn from.
+# Drawing a gradient or a glow one pixel at a time, for every bar, every frame, would be far too slow in Python.
+# Instead, each piece is drawn once, and every frame is put together by copying ("blitting") parts of them:
+#
+# - The bar itself is one tall strip, a full bar high. A bar that is only partway up shows just the bottom part of it.
+# - The glow is another strip, a bit wider than the bar, with a soft top piece that goes on top of it.
+# - The peak cap is one small piece.
+#
+# Every bar of a frame goes to pygame in one big `blits` call.
+# The pieces only depend on the style, the bar color, and the bars' size, so they are only drawn again
+# when one of those changes (the window is resized, the quality level changes, or the color does).
+class BarSprites:
+    def __init__(self):
+        self.key = None
+
+    # Draw the pieces again, if anything they depend on has changed since last time.
+    # `surface` is what they will be blitted onto. The pieces are made to match it, so blitting them is a plain copy.
+    def update(self, surface, style, color, width, max_height):
+        key = (surface.get_bitsize(), surface.get_masks(), tuple(sorted(style.items())), color, width, max_height)
+        if key == self.key:
+            return
+        self.key = key
+
+        width, max_height = max(1, width), max(1, int(max_height))
+        scale = max_height / BAR_MAX_HEIGHT
+        color = tuple(int(value) for value in color[:3])
+
+        # The bar: dark at the bottom, the bar color in the middle, and a little brighter at the top.
+        self.strip = pygame.Surface((width, max_height), 0, surface)
+        for row in range(max_height):
+            depth = row / max_height
+            if not style["gradient"]:
+                shade = color
+            elif depth > 0.5:
+                shade = _mix(color, (0, 0, 0), 0.55 * (depth - 0.5) * 2)
+            else:
+                shade = _mix(color, (255, 255, 255), 0.25 * (0.5 - depth) * 2)
+            self.strip.fill(shade, (0, row, width, 1))
+
+        # The peak cap is a thin, bright line.
+        self.cap_height = max(2, int(round(4 * scale)))
+        self.cap = pygame.Surface((width, self.cap_height), 0, surface)
+        self.cap.fill(_mix(color, (255, 255, 255), 0.5))
+
+        # The glow fades out the further it gets from the bar.
+        self.glow = int(round(style["glow"] * scale))
+        self.glow_strip = self.glow_top = None
+        if self.glow > 0:
+            glow_width = width + 2 * self.glow
+
+            def _alpha(x, distance_above):
+                distance_beside = max(0, self.glow - x, x - (self.glow + width - 1))
+                distance = math.hypot(distance_beside, distance_above)
+                return int(GLOW_ALPHA * max(0.0, 1 - distance / (self.glow + 1)) ** 2)
+
+            self.glow_strip = pygame.Surface((glow_width, max_height), pygame.SRCALPHA)
+            for x in range(glow_width):
+                self.glow_strip.fill(color + (_alpha(x, 0),), (x, 0, 1, max_height))
+
+            self.glow_top = pygame.Surface((glow_width, self.glow), pygame.SRCALPHA)
+            for row in range(self.glow):
+                for x in range(glow_width):
+                    self.glow_top.set_at((x, row), color + (_alpha(x, self.glow - row),))
+
+    # Draw `bars` onto `surface`. The glows go down first, so the bars sit on top of their neighbors' glow.
+    def render(self, surface, bars, style):
+        glows, bodies, caps = [], [], []
+        for bar in bars:
+            height = int(bar.height)
+            top = bar.y + bar.max_height - height
+            bodies.append((self.strip, (bar.x, top), (0, self.strip.get_height() - height, self.strip.get_width(), height)))
+            if self.glow > 0:
+                glows.append((self.glow_strip, (bar.x - self.glow, top), (0, self.glow_strip.get_height() - height, self.glow_strip.get_width(), height)))
+                glows.append((self.glow_top, (bar.x - self.glow, top - self.glow)))
+            if style["peaks"]:
+                caps.append((self.cap, (bar.x, bar.y + bar.max_height - int(bar.peak) - self.cap_height)))
+        surface.blits(glows + bodies + caps, doreturn=False)
+
+
+# The bar visualizer itself, without any window attached.
+# It knows how to move the bars along with the music (`update`), and how to draw them onto a surface (`render`).
+# Whoever owns it decides where the surface comes from, and when to draw.
+# `style` is one of the `BAR_STYLES`, or `None` for the default one.
+class BarVisualizer:
+    def __init__(self, analyzer, bar_color, bg_color, width=800, height=600, style=None):
+        self.analyzer = analyzer
+        self.bar_color = convert_color(bar_color)
+        self.bg_color = convert_color(bg_color)
+
+        self.style_name = style or DEFAULT_BAR_STYLE
+        if self.style_name not in BAR_STYLES:
+            raise ValueError("unknown bar style \"" + self.style_name + "\"")
+        self.style = BAR_STYLES[self.style_name]
+        self.sprites = BarSprites()
+
+        # Initialize array of bars
+        # Each bar remembers which of the `BAR_FREQUENCIES` it is, to find its level in the `FrameFeatures`.
+        self.bars = []
+        self.frequencies = BAR_FREQUENCIES
+        self.barNum = len(self.frequencies)
+
+        for i, freq in enumerate(self.frequencies):
+            self.bars.append(AudioBar(0, 300, freq, self.bar_color, max_height=BAR_MAX_HEIGHT))
+            self.bars[i].index = i
+
+        # The bars that are actually shown. At lower quality levels, this is only some of them.
+        self.active_bars = self.bars
+
+        self.resize(width, height)
+
+    # Switch to one of the `QUALITY_LEVELS`.
+    # Whoever owns the visualizer is in charge of the "render_scale" part: it should `resize` the visualizer
+    # to the scaled-down size. The bars are made shorter here to match.
+    def set_quality(self, quality):
+        self.active_bars = self.bars[::quality["bar_step"]]
+        for bar in self.bars:
+            bar.set_max_height(BAR_MAX_HEIGHT * quality["render_scale"])
+        self.resize(self.width, self.height)
+
+    # Spread the bars out across a new width, and move them down to a new height.
+    def resize(self, width, height):
+        self.width, self.height = width, height
+        self.barNum = len(self.active_bars)
+        self.barWidth = width // self.barNum
+        for i, bar in enumerate(self.active_bars):
+            bar.x = (i * width) // self.barNum
+
+    # Move the bars along. `dt` is the time since the last update, and `position` is
+    # how far into the song we are, both in seconds.
+    # This asks the visualizer's own analyzer. When the levels have already been worked out
+    # (by a `FeatureBus`), `apply` takes them instead.
+    def update(self, dt, position):
+        self.apply(FrameFeatures(dt, position, get_levels(self.analyzer, position, self.frequencies)))
 
-                    counter = counter+1
+    # Move the bars along, to one frame's `FrameFeatures`.
+    # The levels come as a numpy array, but pygame wants the bars' heights as plain numbers.
+    def apply(self, features):
+        levels = features.levels.tolist()
+        for bar in self.active_bars:
+            bar.update(features.dt, levels[bar.index], self.height)
 
-                    if counter == 1:
-                        converted_bar_color = tuple(color_code_list)
+    # Draw the current state of the bars.
+    # The "flat" style draws plain rectangles. The rest are put together from pre-rendered pieces (see `BarSprites`).
+    def render(self, surface):
+        surface.fill(self.bg_color)
+        if self.style_name == "flat":
+            for bar in self.active_bars:
+                bar.render(surface, self.barWidth)
+            return
+        self.sprites.update(surface, self.style, self.bar_color, self.barWidth, self.active_bars[0].max_height)
+        self.sprites.render(surface, self.active_bars, self.style)
 
-                    if counter == 2:
-                        converted_bg_color = tuple(color_code_list)
 
-                    cur_colorcode = ""
-                    color_code_list = []
-                    allow = False
-                    break
+# A different look: one circle in the middle, that swells with how loud the song is, and a flash of color on every beat.
+# It only uses the `FrameFeatures`, so it has no `update` of its own. Hook it up to a `FeatureBus`.
+# It takes the same arguments as `BarVisualizer`, so the two can be swapped (see `VISUALS`), but it has only the one style.
+# At the top quality level, the circle has a soft halo around it. Below that, the halo is left out.
+class PulseVisualizer:
+    def __init__(self, analyzer, bar_color, bg_color, width=800, height=600, style=None):
+        self.analyzer = analyzer
+        self.bar_color = convert_color(bar_color)
+        self.bg_color = convert_color(bg_color)
+        self.size = 0.0
+        self.flash = 0.0
+        self.quality = QUALITY_LEVELS[0]
+        self.resize(width, height)
 
+    # Switch to one of the `QUALITY_LEVELS`.
+    # Like with `BarVisualizer`, whoever owns the visualizer is in charge of the "render_scale" part.
+    # Here, every level past the first also drops the halo.
+    def set_quality(self, quality):
+        self.quality = quality
 
-                else: cur_colorcode = cur_colorcode + char
+    def resize(self, width, height):
+        self.width, self.height = width, height
 
+    def apply(self, features):
+        # Ease towards the loudness like the bars do, and let the flash fade away.
+        self.size += (features.loudness - self.size) * (1 - math.exp(-features.dt / BAR_SMOOTHING))
+        self.flash = 1.0 if features.beat else self.flash * math.exp(-features.dt / (BAR_SMOOTHING * 2))
+
+    def render(self, surface):
+        color = tuple(int(value) for value in self.bar_color[:3])
+        background = _mix(tuple(int(value) for value in self.bg_color[:3]), color, 0.3 * self.flash)
+        surface.fill(background)
+        center = (self.width // 2, self.height // 2)
+        radius = max(1, int(min(self.width, self.height) * 0.45 * (0.2 + 0.8 * self.size)))
+        if self.quality["name"] == QUALITY_LEVELS[0]["name"]:
+            for ring in range(PULSE_HALO_RINGS, 0, -1):
+                pygame.draw.circle(surface, _mix(background, color, 1 - ring / (PULSE_HALO_RINGS + 1)),
+                    center, int(radius * (1 + PULSE_HALO_SIZE * ring / PULSE_HALO_RINGS)))
+        pygame.draw.circle(surface, color, center, radius)
+
+
+# The kinds of visual there are, by name. This is how other visuals plug in (see `register_visual`).
+# A visual is a class that is made like `BarVisualizer`, with `(analyzer, bar_color, bg_color, width, height, style)`,
+# and has these four functions:
+# - `set_quality(quality)`, to switch to one of the `QUALITY_LEVELS`,
+# - `resize(width, height)`,
+# - `apply(features)`, to move along to one frame's `FrameFeatures`,
+# - and `render(surface)`, to draw itself onto a pygame surface.
+VISUALS = {
+    "bars": BarVisualizer,
+    "pulse": PulseVisualizer,
+}
+
+# The visual used when nobody picks one.
+DEFAULT_VISUAL = "bars"
+
+
+# Add a new kind of visual, or replace one. See `VISUALS`.
+def register_visual(name, visual_class):
+    VISUALS[name] = visual_class
+
+
+# Make a visual of the kind called `name`, or the default one for `None`.
+def create_visual(name, analyzer, bar_color, bg_color, width=800, height=600, style=None):
+    name = name or DEFAULT_VISUAL
+    if name not in VISUALS:
+        raise ValueError("unknown visual \"" + name + "\"")
+    return VISUALS[name](analyzer, bar_color, bg_color, width, height, style)
+
+
+# How loud each of `frequencies` is at `position` seconds into the song, in decibels, from any analyzer.
+def get_levels(analyzer, position, frequencies):
+    if hasattr(analyzer, "get_decibels"):
+        return analyzer.get_decibels(position, frequencies)
+    return np.array([analyzer.get_decibel(position, freq) for freq in frequencies], np.float32)
+
+
+# Everything the visuals need to know about one frame.
+# `dt` is the time since the last frame, and `position` how far into the song we are, both in seconds.
+# `levels` is how loud each of the `BAR_FREQUENCIES` is, in decibels, from -80 to 0.
+# `beat` is whether a beat landed on this frame.
+# `loudness` is how loud the song is overall right now, from 0 (silent) to 1 (as loud as it gets).
+class FrameFeatures:
+    def __init__(self, dt, position, levels, beat=False, loudness=0.0):
+        self.dt = dt
+        self.position = position
+        self.levels = levels
+        self.beat = beat
+        self.loudness = loudness
+
+
+# The feature bus works out each frame's `FrameFeatures` once, and hands them to every output hooked up to it.
+# An output is anything with an `apply(features)` function: a visual drawn in a window (see `VISUALS`),
+# or an off-screen one that is streamed or recorded (see `FrameOutput` and `VideoOutput`).
+# However many outputs there are, the song is only analyzed once, and only looked up once per frame.
+# It has an `analyzer` just like a visualizer does, so a `PlaylistPlayback` can follow it from song to song.
+class FeatureBus:
+    def __init__(self, analyzer, outputs=()):
+        self.analyzer = analyzer
+        self.outputs = list(outputs)
+
+        # Which of the `BAR_FREQUENCIES` are the bass.
+        self.bass = BAR_FREQUENCIES <= BEAT_FREQUENCY
+
+        # The bass over the last `BEAT_WINDOW` seconds, as (position, decibels), and when the last beat was.
+        self.history = deque()
+        self.last_beat = None
+        self.last_position = None
+
+    def add(self, output):
+        self.outputs.append(output)
+
+    def remove(self, output):
+        self.outputs.remove(output)
+
+    # Work out the features of one frame, and hand them to every output. Returns the features.
+    def step(self, dt, position):
+        levels = get_levels(self.analyzer, position, BAR_FREQUENCIES)
+
+        # If the song jumped backwards (a seek, or the next song of a playlist), what came before doesn't count.
+        if self.last_position is not None and position < self.last_position:
+            self.history.clear()
+            self.last_beat = None
+        self.last_position = position
+
+        bass = float(np.mean(levels[self.bass]))
+        beat = False
+        if len(self.history) > 0:
+            average = sum(level for (time_of, level) in self.history) / len(self.history)
+            if bass > average + BEAT_THRESHOLD and (self.last_beat is None or position - self.last_beat >= BEAT_MIN_GAP):
+                beat = True
+                self.last_beat = position
+        self.history.append((position, bass))
+        while position - self.history[0][0] > BEAT_WINDOW:
+            self.history.popleft()
+
+        # The loudness comes from the envelope pyramid if there is one, and from the levels if there isn't.
+        envelope = getattr(self.analyzer, "envelope", None)
+        if envelope is not None:
+            loudness = min(1.0, float(envelope.query(max(0.0, position - LOUDNESS_WINDOW), position + 1e-3, 1)[2][0]) * 2)
+        else:
+            loudness = float(np.clip((np.mean(levels) + 80) / 80, 0, 1))
+
+        features = FrameFeatures(dt, position, levels, beat, loudness)
+        for output in self.outputs:
+            output.apply(features)
+        return features
+
+
+# An output that draws a visual off-screen, into its own frame buffer, and hands every frame to a `sink`,
+# like a `pyvizstream.FrameStreamer` (anything with a `publish(framebuffer, position)` function).
+# This is how another screen can get a different look than the window, at the cost of drawing it, and nothing more.
+# If `max_fps` is given, it only draws that many frames a second (the visual still moves along every frame),
+# which is all a streamer sends anyway.
+class FrameOutput:
+    def __init__(self, visual, width, height, sink, max_fps=None):
+        self.visual = visual
+        self.framebuffer = FrameBuffer(width, height)
+        self.visual.resize(self.framebuffer.width, self.framebuffer.height)
+        self.sink = sink
+        self.min_interval = 1.0 / max_fps if max_fps else 0.0
+        self.last_render = None
+
+    def apply(self, features):
+        self.visual.apply(features)
+        now = time.monotonic()
+        if self.last_render is not None and now - self.last_render < self.min_interval:
+            return
+        self.last_render = now
+        self.visual.render(self.framebuffer.surface)
+        self.sink.publish(self.framebuffer, features.position)
+
+
+# An output that draws a visual off-screen and records it into a video file, with the song mixed back in.
+# `filename` is the song. Call `close` once all of the frames are in.
+class VideoOutput:
+    def __init__(self, visual, filename, output_path, width=1280, height=720, framerate=30):
+        self.visual = visual
+        self.framebuffer = FrameBuffer(width, height)
+        self.visual.resize(self.framebuffer.width, self.framebuffer.height)
+
+        # `ffmpeg` reads raw frames, in the same layout as our frame buffer, from its standard input,
+        # and the song from the file. It stops when the shorter of the two runs out.
+        self.encoder = subprocess.Popen([
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "bgra", "-s", str(self.framebuffer.width) + "x" + str(self.framebuffer.height), "-r", str(framerate), "-i", "-",
+            "-i", filename,
+            "-c:v", "libx264", "-pix_fmt", "yuv420p", "-c:a", "aac", "-shortest",
+            output_path], stdin=subprocess.PIPE)
+
+    def apply(self, features):
+        self.visual.apply(features)
+        self.visual.render(self.framebuffer.surface)
+        self.encoder.stdin.write(self.framebuffer.pixels)
+
+    # Finish the video file.
+    def close(self):
+        self.encoder.stdin.close()
+        exit_code = self.encoder.wait()
+        if exit_code != 0:
+            raise RuntimeError("ffmpeg exited with code " + str(exit_code))
+
+
+# The frame governor keeps the frame rate steady by trading away detail.
+# After every frame, tell it how long that frame took to work out and draw (`record`).
+# If frames keep taking longer than the budget, it steps down to a cheaper one of the `QUALITY_LEVELS`.
+# Once there is plenty of time to spare again, it steps back up.
+# To keep it from flip-flopping between two levels, it only steps up when frames take well under the budget,
+# and it waits a while after every change before changing again.
+class FrameGovernor:
+    def __init__(self, target_fps=60, window=30, slow_ratio=1.0, fast_ratio=0.5, upgrade_delay=180):
+        self.budget = 1.0 / target_fps
+
+        # Recent frame times, in seconds. Decisions are made on their average, so one slow frame doesn't count.
+        self.frame_times = deque(maxlen=window)
+
+        # Step down when the average is over `slow_ratio` of the budget, and up when it is under `fast_ratio` of it.
+        self.slow_ratio, self.fast_ratio = slow_ratio, fast_ratio
+
+        # How many frames to wait after a change before stepping up again.
+        self.upgrade_delay = upgrade_delay
+
+        self.level = 0
+        self.frames_since_change = 0
+
+    # The current quality level, one of `QUALITY_LEVELS`.
+    @property
+    def quality(self):
+        return QUALITY_LEVELS[self.level]
+
+    # A short description of the current level, for showing to the user.
+    def describe(self):
+        return "Quality: " + self.quality["name"]
+
+    # Write down how long a frame took. Returns true if the quality level changed.
+    def record(self, frame_time):
+        self.frame_times.append(frame_time)
+        self.frames_since_change += 1
+
+        # Wait until we have a full window of frames at the current level.
+        if len(self.frame_times) < self.frame_times.maxlen:
+            return False
+
+        average = sum(self.frame_times) / len(self.frame_times)
+        if average > self.budget * self.slow_ratio and self.level < len(QUALITY_LEVELS) - 1:
+            self.level += 1
+        elif average < self.budget * self.fast_ratio and self.level > 0 and self.frames_since_change >= self.upgrade_delay:
+            self.level -= 1
+        else:
+            return False
+
+        self.frame_times.clear()
+        self.frames_since_change = 0
+        return True
+
+
+# Render the visualizer for a whole song into a video file, without opening any windows or playing anything.
+# `analyzer` is an `AudioAnalyzer` for the song in `filename`.
+# Frames are drawn one after another, as fast as the computer can go, and piped straight into `ffmpeg`,
+# which encodes them and mixes the song back in.
+# `bar_style` is one of the `BAR_STYLES`, or `None` for the default one, and `visual` is one of the `VISUALS`.
+# `extra_outputs` are more `VideoOutput`s to record at the same time, from the same analysis, at the same frame rate.
+def render_audio_visualizer(analyzer, filename, output_path, bar_color, bg_color, width=1280, height=720, framerate=30, bar_style=None,
+        visual=None, extra_outputs=()):
+    outputs = [VideoOutput(create_visual(visual, analyzer, bar_color, bg_color, width, height, bar_style), filename, output_path, width, height, framerate)]
+    outputs.extend(extra_outputs)
+    bus = FeatureBus(analyzer, outputs)
+
+    # Every frame is exactly one frame's worth of time after the last one.
+    deltaTime = 1.0 / framerate
+    frame_count = int(analyzer.duration * framerate) + 1
+    try:
+        for frame in range(frame_count):
+            bus.step(deltaTime, frame * deltaTime)
+    finally:
+        # Finish every video, even if one of them went wrong. The first problem is the one that gets raised.
+        errors = []
+        for output in outputs:
+            try:
+                output.close()
+            except (RuntimeError, OSError) as error:
+                errors.append(error)
+
+    if len(errors) > 0:
+        raise errors[0]
+
+
+# `streamer`, if given, is a `pyvizstream.FrameStreamer` that shares every frame with other screens.
+# `analyzer`, if given, is the song's analyzer, made ahead of time. Otherwise, one is made here.
+# `on_first_frame`, if given, is called once the first frame is on screen.
+# `playback`, if given, plays the song instead of the usual one for the analyzer.
+# A `PlaylistPlayback` keeps the window going from one song to the next.
+# `bar_style` is one of the `BAR_STYLES`, or `None` for the default one, and `visual` is one of the `VISUALS`.
+# `outputs` are more outputs (like a `FrameOutput`) fed from the same `FeatureBus` as the window.
+#
+# The rest are for measuring the frame loop (see `benchmarks/replay.py`), and are normally left alone:
+# `clock` is called instead of `pygame.time.get_ticks` for the time in milliseconds,
+# `events` is called instead of `pygame.event.get` for the window's events,
+# `governor` is the `FrameGovernor` to use instead of a fresh one,
+# and `on_frame`, if given, is called after every frame with how long the work of that frame took, in seconds.
+def run_audio_visualizer(filename, bar_color, bg_color, backend="librosa", streamer=None, analyzer=None, on_first_frame=None, playback=None, bar_style=None,
+        visual=None, outputs=(), clock=None, events=None, governor=None, on_frame=None):
+    get_ticks = clock if clock is not None else pygame.time.get_ticks
+    get_events = events if events is not None else pygame.event.get
 
     # Initialize audio analyzer
-    anal = AudioAnalyzer(filename)
+    anal = analyzer if analyzer is not None else create_analyzer(filename, backend)
 
     # Initialize Pygame
     pygame.init()
     pygame.mixer.init()
     window_width = 800
     window_height = 600
-    screen_height = window_height
     screen = pygame.display.set_mode((window_width, window_height), pygame.RESIZABLE)
 
-    # Initialize array of bars
-    bars = []
-    frequencies = np.arange(100, 8000, 100)
-    barNum = len(frequencies)
+    # Initialize the visualizer
+    visualizer = create_visual(visual, anal, bar_color, bg_color, window_width, window_height, bar_style)
 
-    for i, freq in enumerate(frequencies):
-        x = (i * window_width) // barNum
-        bars.append(AudioBar(x, 300, freq, converted_bar_color, max_height=400))
+    # The window's visual, and any other outputs, all get their features from one bus.
+    bus = FeatureBus(anal, [visualizer] + list(outputs))
 
-    pygame.mixer.music.load(filename)
-    pygame.mixer.music.play(0)
+    # The governor lowers the quality if frames start taking too long. See `FrameGovernor`.
+    if governor is None:
+        governor = FrameGovernor()
+    pygame.display.set_caption("PyViz - " + governor.describe())
 
-    t = pygame.time.get_ticks()
+    # When streaming, or drawing at less than full size, we draw into a frame buffer,
+    # and copy (or stretch) that to the window. Otherwise, we draw straight onto the window.
+    framebuffer = FrameBuffer(window_width, window_height)
+
+    # Size the visualizer and frame buffer to the window, at the current quality level.
+    def _fit():
+        scale = governor.quality["render_scale"]
+        width, height = int(screen.get_width() * scale), int(screen.get_height() * scale)
+        framebuffer.resize(width, height)
+        visualizer.resize(framebuffer.width, framebuffer.height)
+
+    # Start out at the governor's current level. (A fresh governor starts at full quality.)
+    visualizer.set_quality(governor.quality)
+    _fit()
+
+    if playback is None:
+        playback = create_playback(anal, filename)
+    if isinstance(playback, PlaylistPlayback):
+        playback.follow(bus)
+    playback.play()
+
+    t = get_ticks()
     getTicksLastFrame = t
-    pygame.mixer.music.load(filename)
-    pygame.mixer.music.play(0)
     running = True
     while running:
-        t = pygame.time.get_ticks()
+        t = get_ticks()
         deltaTime = (t - getTicksLastFrame) / 1000.0
         getTicksLastFrame = t
-        for event in pygame.event.get():
+        for event in get_events():
             if event.type == pygame.QUIT:
                 running = False
             elif event.type == pygame.VIDEORESIZE:
                 screen = pygame.display.set_mode((event.w, event.h), pygame.RESIZABLE)
-                for i, freq in enumerate(frequencies):
-                    x = (i * event.w) // barNum
-                    bars[i].x = x
-                screen_height = screen.get_height()
+                _fit()
 
-        screen.fill(converted_bg_color)
+        # Time just the work of the frame, not the wait for the screen.
+        frame_start = time.perf_counter()
 
-        for i, bar in enumerate(bars):
-            barWidth = window_width // barNum
-            bar.update(deltaTime, anal.get_decibel(pygame.mixer.music.get_pos() / 1000.0, bar.freq), screen_height)
-            bar.render(screen, barWidth)
+        position = playback.get_position()
+        bus.step(deltaTime, position)
+        scale = governor.quality["render_scale"]
+        if streamer is not None or scale != 1.0:
+            visualizer.render(framebuffer.surface)
+            if scale != 1.0:
+                pygame.transform.scale(framebuffer.surface, screen.get_size(), screen)
+            else:
+                screen.blit(framebuffer.surface, (0, 0))
+            if streamer is not None:
+                streamer.publish(framebuffer, position)
+        else:
+            visualizer.render(screen)
+
+        frame_time = time.perf_counter() - frame_start
+        if governor.record(frame_time):
+            visualizer.set_quality(governor.quality)
+            _fit()
+            pygame.display.set_caption("PyViz - " + governor.describe())
 
         pygame.display.flip()
 
-    pygame.quit()
+        if on_frame is not None:
+            on_frame(frame_time)
+
+        if on_first_frame is not None:
+            on_first_frame()
+            on_first_frame = None
+
+    playback.stop()
+    pygame.quit()
\ No newline at end of file